@@ -2,8 +2,10 @@
 # * coding: utf8 *
 """
 UDOT Right of Way (ROW) Parcel Number Extraction
-Right of way module containing methods
+Right of way module containing the methods shared by the jobs. the circle detection and mosaic job is in row_mosaic
+and the ocr job is in row_ocr so each job only imports the libraries it needs
 """
+import json
 import logging
 import math
 from io import BytesIO
@@ -12,207 +14,144 @@ from os import environ
 from pathlib import Path
 from time import perf_counter
 
-import cv2
-import google.cloud.documentai
-import google.cloud.logging
-import google.cloud.storage
-import numpy as np
-import pandas as pd
-from google.api_core.client_options import ClientOptions
-from google.api_core.exceptions import InternalServerError, InvalidArgument, RetryError
-from pdf2image import convert_from_bytes
-from pdf2image.exceptions import PDFInfoNotInstalledError, PDFPageCountError, PDFSyntaxError
-from PIL.Image import DecompressionBombError
+import row_download
+import row_logging
+import row_queue
+import row_store
+from row_metrics import METRICS
 
 if "PY_ENV" in environ and environ["PY_ENV"] == "production":
+    import google.cloud.logging
+
     LOGGING_CLIENT = google.cloud.logging.Client()
-    STORAGE_CLIENT = google.cloud.storage.Client()
 
     LOGGING_CLIENT.setup_logging()
 
-TASK_RESULTS = []
+    #: ship the records from a background thread so the detection loop never waits on logging
+    LOG_SHIPPER = row_logging.ship_logs_in_background(
+        sample_rate=float(environ.get("LOG_DETAIL_SAMPLE_RATE", row_logging.PRODUCTION_SAMPLE_RATE))
+    )
 
+#: the storage client is created on first use by `get_storage_client`
+STORAGE_CLIENT = None
 
-def mosaic_all_circles(job_name, input_bucket, output_location, file_index, task_index, task_count, total_size):
-    """the code to run in the cloud run job
+#: a work unit for part of a document is written in the index as the object name, this marker and a one based page
+#: range, `file.pdf#pages=1-50`
+PAGE_RANGE_MARKER = "#pages="
 
-    Args:
-        job_name (str): the name of the run job. typically named after an animal in alphabetical order
-        input_bucket (str): the bucket to get files from using the format `gs://bucket-name`
-        output_location (str): the location to save the results to. omit the `gs://` prefix
-        file_index (str): the path to the folder containing an `index.txt` file listing all the images in a bucket.
-                          `gs://bucket-name`
-        task_index (int): the index of the task running
-        task_count (int): the number of containers running the job
-        total_size (int): the total number of files to process
+#: mosaics packed with the crops of many documents are saved in this folder of the job's mosaics and their sidecar
+#: manifests, mapping each tile to its document and page, in the same folder of the job's manifests
+PACKED_MOSAIC_FOLDER = "_packed"
+
+#: a tile of a mosaic queued to be read again is written as the mosaic blob name, this marker and the tile's index in
+#: the mosaic's manifest, `job/mosaics/file.pdf#tile=3`
+TILE_MARKER = "#tile="
+
+
+def get_storage_client():
+    """get the cloud storage client, creating it the first time it is needed
 
     Returns:
-        None
+        google.cloud.storage.Client: the storage client
     """
-    #: Get files to process for this job
-    files = get_files_from_index(file_index, task_index, task_count, total_size)
-    logging.info("job name: %s task: %i processing %s files", job_name, task_index, files)
-
-    #: Initialize GCP storage client and bucket
-    bucket = STORAGE_CLIENT.bucket(input_bucket[5:])
-
-    #: Iterate over objects to detect circles and perform OCR
-    for object_name in files:
-        object_start = perf_counter()
-        object_name = object_name.rstrip()
-        extension = Path(object_name).suffix.casefold()
-
-        if extension == ".pdf":
-            conversion_start = perf_counter()
-            images, count, messages = convert_pdf_to_jpg_bytes(
-                bucket.blob(object_name).download_as_bytes(), object_name
-            )
-            logging.info(
-                "job name: %s task: %i conversion time %s: %s",
-                job_name,
-                task_index,
-                format_time(perf_counter() - conversion_start),
-                {"file": object_name, "pages": count, "message": messages},
-            )
-
-        elif extension in [".jpg", ".jpeg", ".tif", ".tiff", ".png"]:
-            images = list([bucket.blob(object_name).download_as_bytes()])
-        else:
-            logging.info('job name: %s task: %i not a valid document or image: "%s"', job_name, task_index, object_name)
+    global STORAGE_CLIENT  # pylint: disable=global-statement
 
-            continue
+    if STORAGE_CLIENT is None:
+        from google.cloud import storage  # pylint: disable=import-outside-toplevel
 
-        #: Process images to get detected circles
-        logging.info("job name: %s task: %i detecting circles in %s", job_name, task_index, object_name)
-        all_detected_circles = []
-        circle_start = perf_counter()
-
-        for image in images:
-            circle_images = get_circles_from_image_bytes(image, None, object_name)
-            all_detected_circles.extend(circle_images)  #: extend because circle_images will be a list
-
-        logging.info(
-            "job name: %s task: %i circle detection time taken %s: %s",
-            job_name,
-            task_index,
-            object_name,
-            format_time(perf_counter() - circle_start),
-        )
+        STORAGE_CLIENT = storage.Client()
 
-        circle_count = len(all_detected_circles)
-        if circle_count == 0:
-            logging.warning("job name: %s task: %i 0 circles detected in %s", job_name, task_index, object_name)
+    return STORAGE_CLIENT
 
-        #: Process detected circle images into a mosaic
-        logging.info("job name: %s task: %i mosaicking images in %s", job_name, task_index, object_name)
-        mosaic_start = perf_counter()
 
-        mosaic = build_mosaic_image(all_detected_circles, object_name, None)
+def to_bool(value):
+    """convert an environment variable or cli value to a boolean
 
-        logging.info(
-            "job name: %s task: %i image mosaic time taken %s: %s",
-            job_name,
-            task_index,
-            object_name,
-            format_time(perf_counter() - mosaic_start),
-        )
+    Args:
+        value (str|bool): the value to convert. 1, true, yes and on are truthy
 
-        logging.info(
-            "job name: %s task: %i total time taken for entire task %s",
-            job_name,
-            task_index,
-            format_time(perf_counter() - object_start),
-        )
+    Returns:
+        bool: the value as a boolean
+    """
+    if isinstance(value, str):
+        return value.strip().casefold() in ("1", "true", "yes", "on")
+
+    return bool(value)
+
+
+def upload_profile(report, bucket_name, object_name, job_name):
+    """upload the profile of a slow object next to the job output
+
+    Args:
+        report (str): the profile report
+        bucket_name (str): the name of the destination bucket
+        object_name (str): the name of the profiled object
+        job_name (str): the name of the run job
+    """
+    file_name = f"{job_name}/profiles/{object_name}.txt"
+    logging.info("uploading profile for %s to %s/%s", object_name, bucket_name, file_name)
 
-        upload_mosaic(mosaic, output_location, object_name, job_name)
+    blob = get_storage_client().bucket(bucket_name).blob(file_name)
+    blob.upload_from_string(report, content_type="text/plain")
 
 
-def ocr_all_mosaics(inputs):
-    """the code to run in the cloud run job
+def download_object(bucket, object_name):
+    """download an object and record its size and download time. large objects are downloaded as concurrent byte
+    range chunks by `row_download`
 
     Args:
-        inputs (class): the inputs to the function
-            job_name (str): the name of the run job. typically named after an animal in alphabetical order
-            input_bucket (str): the bucket to get files from using the format `gs://bucket-name`
-            output_location (str): the location to save the results to. omit the `gs://` prefix
-            file_index (str): the path to the folder containing an `index.txt` file listing all the images in a bucket.
-                            `gs://bucket-name`
-            task_index (int): the index of the task running
-            task_count (int): the number of containers running the job
-            total_size (int): the total number of files to process
-            project_number (int): the number of the gcp project
-            processor_id (str): the id of the documentai processor
+        bucket (google.cloud.storage.Bucket): the bucket containing the object
+        object_name (str): the name of the object
 
     Returns:
-        A list of lists with the results of the OCR
+        bytes|bytearray: the object content
     """
-    #: Get files to process for this job
-    files = get_files_from_index(inputs.file_index, inputs.task_index, inputs.task_count, inputs.total_size)
-    logging.info("job name: %s task: %i processing %s files", inputs.job_name, inputs.task_index, files)
+    start = perf_counter()
+    content = row_download.download(bucket, object_name)
 
-    #: Initialize GCP storage client and bucket
-    bucket = STORAGE_CLIENT.bucket(inputs.input_bucket[5:])
+    METRICS.observe("download_seconds", perf_counter() - start)
+    METRICS.observe("download_bytes", len(content))
 
-    options = ClientOptions(api_endpoint="us-documentai.googleapis.com")
-    ai_client = google.cloud.documentai.DocumentProcessorServiceClient(client_options=options)
+    return content
 
-    processor_name = ai_client.processor_path(inputs.project_number, "us", inputs.processor_id)
 
-    #: Iterate over objects to detect circles and perform OCR
-    for object_name in files:
-        object_start = perf_counter()
-        object_name = object_name.rstrip()
+def emit_metrics(job_type, job_name, task_index, output_location):
+    """log the task metrics as one structured record and save them with the job output so the tasks of a run can be
+    merged with `download_metrics`
 
-        image_content = bucket.blob(object_name).download_as_bytes()
+    Args:
+        job_type (str): mosaic, ocr, fused or reocr
+        job_name (str): the name of the run job
+        task_index (int): the index of the task running
+        output_location (str): the bucket to save the metrics to. omit the `gs://` prefix
 
-        logging.info(
-            "job name: %s task: %i download finished %s: %s",
-            inputs.job_name,
-            inputs.task_index,
-            format_time(perf_counter() - object_start),
-            {"file": object_name},
-        )
+    Returns:
+        dict: the metrics record
+    """
+    record = METRICS.to_record(job=job_name, job_type=job_type, task=str(task_index))
 
-        raw_document = google.cloud.documentai.RawDocument(content=image_content, mime_type="image/jpeg")
-        request = google.cloud.documentai.ProcessRequest(name=processor_name, raw_document=raw_document)
-
-        result = None
-        try:
-            result = ai_client.process_document(request=request)
-            logging.info(
-                "job name: %s task: %i ocr finished %s: %s",
-                inputs.job_name,
-                inputs.task_index,
-                format_time(perf_counter() - object_start),
-                {"file": object_name},
-            )
-        except (RetryError, InternalServerError) as error:
-            logging.warning(
-                "job name: %s task %i: ocr failed on %s. %s",
-                inputs.job_name,
-                inputs.task_index,
-                object_name,
-                error.message,
-            )
+    logging.info("job name: %s task: %i metrics", job_name, task_index, extra={"json_fields": record})
 
-            continue
-        except (InvalidArgument) as error:
-            logging.warning(
-                "job name: %s task %i: ocr failed on %s. %s\n%s",
-                inputs.job_name,
-                inputs.task_index,
-                object_name,
-                error.message,
-                error.details,
-            )
+    bucket = get_storage_client().bucket(output_location)
+    blob = bucket.blob(f"{job_name}/metrics/{job_type}-task-{task_index}.json")
+    blob.upload_from_string(json.dumps(record), content_type="application/json")
+
+    return record
 
-            continue
 
-        TASK_RESULTS.append([object_name, result.document.text])
+def download_metrics(bucket_name, run_name):
+    """download the metric records of every task of a run
 
-    upload_results(TASK_RESULTS, inputs.output_location, f"task-{inputs.task_index}", inputs.job_name)
+    Args:
+        bucket_name (str): the name of the bucket. omit the `gs://` prefix
+        run_name (str): the name of the run
+
+    Returns:
+        list(dict): the metric records
+    """
+    blobs = get_storage_client().bucket(bucket_name).list_blobs(prefix=f"{run_name}/metrics/")
 
-    return TASK_RESULTS
+    return [json.loads(blob.download_as_bytes()) for blob in blobs if blob.name.endswith(".json")]
 
 
 def generate_index(from_location, prefix, save_location):
@@ -231,7 +170,7 @@ def generate_index(from_location, prefix, save_location):
 
     logging.info('reading files from "%s"', from_location)
     if from_location.startswith("gs://"):
-        iterator = STORAGE_CLIENT.list_blobs(from_location[5:], max_results=None, versions=False, prefix=prefix)
+        iterator = get_storage_client().list_blobs(from_location[5:], max_results=None, versions=False, prefix=prefix)
 
         files = [blob.name.removeprefix(prefix).strip() for blob in iterator]
     else:
@@ -252,9 +191,22 @@ def generate_index(from_location, prefix, save_location):
     if save_location is None:
         return files
 
+    save_index(files, save_location)
+
+    return files
+
+
+def save_index(files, save_location, file_name="index.txt"):
+    """write a list of files or work units to an index file. Cloud storage buckets must start with `gs://`
+
+    Args:
+        files (list(str)): the file names or work units
+        save_location (str): the directory or bucket to save the index to. directories are created when missing
+        file_name (str): the name of the index file
+    """
     if save_location.startswith("gs://"):
-        bucket = STORAGE_CLIENT.bucket(save_location[5:])
-        blob = bucket.blob("index.txt")
+        bucket = get_storage_client().bucket(save_location[5:])
+        blob = bucket.blob(file_name)
 
         with BytesIO() as data:
             for item in files:
@@ -267,11 +219,167 @@ def generate_index(from_location, prefix, save_location):
         if not save_location.exists():
             save_location.mkdir(parents=True, exist_ok=True)
 
-        with save_location.joinpath("index.txt").open("w", encoding="utf-8", newline="") as output:
+        with save_location.joinpath(file_name).open("w", encoding="utf-8", newline="") as output:
             for item in files:
                 output.write(str(item) + "\n")
 
-    return files
+
+def parse_work_unit(entry):
+    """split an index entry into the object name and the page range to work on
+
+    Args:
+        entry (str): an object name or a page range of it, `file.pdf#pages=1-50`
+
+    Returns:
+        tuple(str, tuple): the object name and the one based, inclusive (first, last) pages or None for every page
+    """
+    entry = entry.strip()
+    object_name, marker, pages = entry.rpartition(PAGE_RANGE_MARKER)
+
+    if not marker:
+        return entry, None
+
+    first, _, last = pages.partition("-")
+
+    try:
+        first = int(first)
+        last = int(last or first)
+    except ValueError:
+        raise ValueError(f"invalid page range: {entry}") from None
+
+    if first < 1 or last < first:
+        raise ValueError(f"invalid page range: {entry}")
+
+    return object_name, (first, last)
+
+
+def format_work_unit(object_name, pages=None):
+    """write an object name and page range as an index entry
+
+    Args:
+        object_name (str): the object name
+        pages (tuple): the one based, inclusive (first, last) pages or None for every page
+
+    Returns:
+        str: the index entry
+    """
+    if pages is None:
+        return object_name
+
+    return f"{object_name}{PAGE_RANGE_MARKER}{pages[0]}-{pages[1]}"
+
+
+def split_into_page_ranges(object_name, page_count, pages_per_unit):
+    """split a document into work units of at most `pages_per_unit` pages so its pages can be spread across tasks
+
+    Args:
+        object_name (str): the object name
+        page_count (int): the number of pages in the document
+        pages_per_unit (int): the most pages in a work unit
+
+    Returns:
+        list(str): the index entries. documents that fit in one unit are kept whole
+    """
+    if page_count <= pages_per_unit:
+        return [object_name]
+
+    return [
+        format_work_unit(object_name, (first, min(first + pages_per_unit - 1, page_count)))
+        for first in range(1, page_count + 1, pages_per_unit)
+    ]
+
+
+def is_packed_mosaic(mosaic_name):
+    """check if a mosaic holds the crops of many documents
+
+    Args:
+        mosaic_name (str): the mosaic blob name, `job/mosaics/...`
+
+    Returns:
+        bool: True for a packed mosaic
+    """
+    return f"/mosaics/{PACKED_MOSAIC_FOLDER}/" in mosaic_name
+
+
+def get_manifest_name(mosaic_name):
+    """get the blob name of a mosaic's manifest
+
+    Args:
+        mosaic_name (str): the mosaic blob name, `job/mosaics/name.pdf` or `job/mosaics/_packed/name.jpg`
+
+    Returns:
+        str: the manifest blob name, `job/manifests/name.pdf.json` or `job/manifests/_packed/name.jpg.json`
+    """
+    job_name, _, name = mosaic_name.partition("/mosaics/")
+
+    return f"{job_name}/manifests/{name}.json"
+
+
+def get_packed_documents(mosaics_location, mosaic_names):
+    """read the names of the documents packed into mosaics from the mosaics' manifests
+
+    Args:
+        mosaics_location (str): the mosaics folder, `gs://bucket/job/mosaics` or a local directory
+        mosaic_names (list(str)): the packed mosaic names relative to the mosaics folder, `_packed/0-ab12cd34-0000.jpg`
+
+    Returns:
+        set(str): the document and work unit names
+    """
+    documents = set()
+    bucket = None
+    folder = mosaics_location.rstrip("/")
+
+    if folder.startswith("gs://"):
+        bucket_name, _, folder = folder[5:].partition("/")
+        bucket = get_storage_client().bucket(bucket_name)
+
+    for mosaic_name in mosaic_names:
+        manifest_name = get_manifest_name(f"{folder}/{mosaic_name}")
+
+        if bucket is not None:
+            blob = bucket.get_blob(manifest_name)
+            content = blob.download_as_bytes() if blob is not None else None
+        else:
+            content = Path(manifest_name).read_bytes() if Path(manifest_name).exists() else None
+
+        if content is None:
+            logging.warning("the manifest of packed mosaic %s does not exist", mosaic_name)
+
+            continue
+
+        documents.update(tile["file_name"].partition("/mosaics/")[2] for tile in json.loads(content)["tiles"])
+
+    return documents
+
+
+def format_tile_item(mosaic_name, tile):
+    """write a mosaic tile as a queue item
+
+    Args:
+        mosaic_name (str): the mosaic blob name
+        tile (int): the index of the tile in the mosaic's manifest
+
+    Returns:
+        str: the queue item, `job/mosaics/file.pdf#tile=3`
+    """
+    return f"{mosaic_name}{TILE_MARKER}{tile}"
+
+
+def parse_tile_item(item):
+    """split a queue item into the mosaic and tile to read again
+
+    Args:
+        item (str): the queue item from `format_tile_item`
+
+    Returns:
+        tuple(str, int): the mosaic blob name and the index of the tile in its manifest
+    """
+    mosaic_name, marker, tile = item.strip().rpartition(TILE_MARKER)
+
+    if not marker or not tile.isdigit():
+        raise ValueError(f"invalid tile item: {item}")
+
+    return mosaic_name, int(tile)
 
 
 def download_file_from(bucket_name, file_name):
@@ -290,7 +398,7 @@ def download_file_from(bucket_name, file_name):
 
         return None
 
-    bucket = STORAGE_CLIENT.bucket(bucket_name[5:])
+    bucket = get_storage_client().bucket(bucket_name[5:])
 
     blob = bucket.blob(file_name)
 
@@ -384,7 +492,7 @@ def get_files_from_index(from_location, task_index, task_count, total_size):
     return file_list
 
 
-def generate_remaining_index(full_index_location, processed_index_location, save_location):
+def generate_remaining_index(full_index_location, processed_index_location, save_location, mosaics_location=None):
     """reads file names from the `from_location` and optionally saves the list to the `save_location` as an index.txt
     file. Cloud storage buckets must start with `gs://`
     Args:
@@ -393,6 +501,8 @@ def generate_remaining_index(full_index_location, processed_index_location, save
                                         Prefix GSC buckets with gs://.
         save_location (str): the directory to save the list of files to. An index.txt file will be created within this
                              directory
+        mosaics_location (str): the mosaics folder the processed index was generated from, `gs://bucket/job/mosaics`.
+                                the documents in its packed mosaics are read from their manifests and are processed
     Returns:
         list(str): a list of file names
     """
@@ -419,15 +529,26 @@ def generate_remaining_index(full_index_location, processed_index_location, save
 
     logging.info("number of already-processed files %i", len(processed_files))
 
-    #: Get the difference to determine what remaining files need to be processed
-    remaining_files = all_files - processed_files
+    packed = [name for name in processed_files if name.startswith(f"{PACKED_MOSAIC_FOLDER}/")]
+
+    if packed and mosaics_location is None:
+        logging.warning(
+            "%i packed mosaics were processed but their documents stay remaining without the mosaics location",
+            len(packed),
+        )
+    elif packed:
+        processed_files |= get_packed_documents(mosaics_location, packed)
+
+    #: Get the difference to determine what remaining files need to be processed. a merged mosaic is only written
+    #: once every page range of its document finished so the ranges are processed when the document is
+    remaining_files = {item for item in all_files - processed_files if parse_work_unit(item)[0] not in processed_files}
     logging.info("number of remaining files to process %i", len(remaining_files))
 
     if save_location is None:
         return remaining_files
 
     if save_location.startswith("gs://"):
-        bucket = STORAGE_CLIENT.bucket(save_location[5:])
+        bucket = get_storage_client().bucket(save_location[5:])
         blob = bucket.blob("remaining_index.txt")
 
         with BytesIO() as data:
@@ -450,242 +571,34 @@ def generate_remaining_index(full_index_location, processed_index_location, save
     return remaining_files
 
 
-def convert_pdf_to_jpg_bytes(pdf_as_bytes, object_name):
-    """convert pdf to jpg images
+def get_record_store(location):
+    """create a keyed record store for a local directory or a `gs://` bucket location
 
     Args:
-        pdf_as_bytes: a pdf as bytes
-
-    Returns:
-        tuple(list, number): A tuple of a list of images and the count of images
-    """
-    dpi = 300
-    images = []
-    messages = ""
+        location (str): the directory or bucket location with an optional prefix
 
-    try:
-        images = convert_from_bytes(pdf_as_bytes, dpi)
-    except (TypeError, PDFInfoNotInstalledError, PDFPageCountError, PDFSyntaxError, DecompressionBombError) as error:
-        logging.error("error in %s, %s", object_name, error, exc_info=True)
-        messages = error
-
-    count = len(images)
-
-    def convert_to_bytes(image):
-        with BytesIO() as byte_array:
-            image.save(byte_array, format="JPEG")
-
-            return byte_array.getvalue()
-
-    images = (convert_to_bytes(image) for image in images if image is not None)
-
-    return (images, count, messages)
-
-
-def get_circles_from_image_bytes(byte_img, output_path, file_name):
-    """detect circles in an image (bytes) and export them as a list of cropped images
-
-    Args:
-        byte_img (bytes): The image to detect circles in
-        output_path (Path): The output directory for cropped images of detected circles to be stored
-        file_name (str): The name of the file to be stored
     Returns:
-        list: a list of cv2 images
+        LocalStore|BucketStore: the store
     """
+    if location.startswith("gs://"):
+        return row_store.get_store(location, get_storage_client())
 
-    #: read in image from bytes
-    img = None
-    try:
-        img = cv2.imdecode(np.frombuffer(byte_img, dtype=np.uint8), 1)  # 1 means flags=cv2.IMREAD_COLOR
-    except Exception as ex:
-        logging.error("unable to read image from bytes: %s, %s", file_name, ex)
-
-        return []
-
-    if img is None:
-        logging.error("unable to read image from bytes: %s", file_name)
-
-        return []
-
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    gray_blur = cv2.blur(gray, (5, 5))
-
-    #: to calculate circle radius, get input image size
-    [height, width, _] = img.shape
-
-    #: original multiplier of 0.01, bigger seems to work better (0.025)
-    multipliers = [
-        [0.010, 12],
-        [0.035, 12],
-        [0.015, 12],
-        [0.0325, 12],
-        [0.0175, 12],
-        [0.025, 10],
-    ]
-
-    i = 0
-    count_down = len(multipliers)
-    circle_count = 0
-    detected_circles = None
-    inset = 0
-
-    while (circle_count > 100 or circle_count == 0) and count_down > 0:
-        i += 1
-
-        [ratio_multiplier, fudge_value] = multipliers[count_down - 1]
-
-        min_rad = max(math.ceil(ratio_multiplier * height) - fudge_value, 15)
-        max_rad = max(math.ceil(ratio_multiplier * height) + fudge_value, 30)
-
-        #: original inset multiplier of 0.075, bigger seems to work better (0.1)
-        inset = int(0.1 * max_rad)
-
-        #: apply Hough transform on the blurred image.
-        detected_circles = cv2.HoughCircles(
-            image=gray_blur,
-            method=cv2.HOUGH_GRADIENT,
-            dp=1,
-            minDist=min_rad,  #: space out circles to prevent multiple detections on the same object
-            param1=50,
-            param2=50,  #: increased from 30 to 50 to weed out some false circles (seems to work well)
-            minRadius=min_rad,
-            maxRadius=max_rad,
-        )
-
-        if detected_circles is None:
-            circle_count = 0
-        else:
-            circle_count = len(detected_circles[0])
-
-        logging.info(
-            "run: %i found %i circles %s",
-            i,
-            circle_count,
-            {
-                "multiplier": ratio_multiplier,
-                "fudge": fudge_value,
-                "diameter": f"{min_rad}-{max_rad}",
-                "inset": inset,
-                "dimensions": f"{height}x{width}",
-            },
-        )
-
-        count_down -= 1
-
-    logging.info("final circles count: %i", circle_count)
-
-    return export_circles_from_image(
-        detected_circles,
-        output_path,
-        file_name,
-        img,
-        height,
-        width,
-        inset,
-    )
+    return row_store.get_store(location)
 
 
-def convert_to_cv2_image(image):
-    """convert image (bytes) to a cv2 image object
+def get_work_queue(location):
+    """create a work queue for a local sqlite file or a `gs://` bucket location
 
     Args:
-        image (bytes): The image (bytes) to convert
-
-    Returns:
-        cv2.Image: A cv2 image object
-    """
-    return cv2.imdecode(np.frombuffer(image, dtype=np.uint8), 1)  # 1 means flags=cv2.IMREAD_COLOR
-
-
-def export_circles_from_image(circles, out_dir, file_name, cv2_image, height, width, inset_distance):
-    """export detected circles from an image as jpegs to the out_dir
-
-        Args:
-            circles (array): Circle locations returned from cv2.HoughCircles algorithm
-            out_dir (Path): The output directory for cropped images of detected circles
-            file_name (str): The name of the image file
-            cv2_image (numpy.ndarray): The image as a numpy array
-            height (number): The height of original image
-            width (number): The width of original image
-            inset_distance (number): The inset distance in pixels to aid image cropping
+        location (str): the sqlite file or bucket location with an optional prefix
 
     Returns:
-        list: a list of cv2 images
+        SqliteQueue|BucketQueue: the queue
     """
-    if circles is None:
-        logging.info("no circles detected for %s", file_name)
-
-        return []
-
-    #: round the values to the nearest integer
-    circles = np.uint16(np.around(circles))
-
-    color = (255, 255, 255)
-    thickness = -1
-
-    if out_dir:
-        if not out_dir.exists():
-            out_dir.mkdir(parents=True)
-
-    masked_images = []
+    if location.startswith("gs://"):
+        return row_queue.get_queue(location, get_storage_client())
 
-    for i, data in enumerate(circles[0, :]):  # type: ignore
-        # #: prepare a black canvas on which to draw circles
-        canvas = np.zeros((height, width))
-        #: draw a white circle on the canvas where detected:
-        center_x = data[0]
-        center_y = data[1]
-
-        radius = data[2] - inset_distance  #: inset the radius by number of pixels to remove the circle and noise
-
-        cv2.circle(canvas, (center_x, center_y), radius, color, thickness)
-
-        #: create a copy of the input (3-band image) and mask input to white from the canvas:
-        image_copy = cv2_image.copy()
-        image_copy[canvas == 0] = (255, 255, 255)
-
-        #: crop image to the roi:
-        crop_x = min(max(center_x - radius - 20, 0), width)
-        crop_y = min(max(center_y - radius - 20, 0), height)
-        crop_height = 2 * radius + 40
-        crop_width = 2 * radius + 40
-
-        masked_image = image_copy[crop_y : crop_y + crop_height, crop_x : crop_x + crop_width]
-
-        if out_dir:
-            original_basename = Path(file_name).stem
-            out_file = out_dir / f"{original_basename}_{i}.jpg"
-            cv2.imwrite(str(out_file), masked_image)
-
-        masked_images.append(masked_image)
-
-    return masked_images
-
-
-def upload_results(data, bucket_name, out_name, job_name):
-    """upload results dataframe to a GCP bucket as a gzip file
-
-    Args:
-        data (list): a list containing the results for the task (a list of lists. the first index being the file name
-                     and the second being the text found)
-        bucket_name (str): the name of the destination bucket
-        out_name (str): the name of the gzip file
-
-    Returns:
-        nothing
-    """
-    file_name = f"{job_name}/{out_name}.gz"
-    logging.info("uploading %s to %s/%s", out_name, bucket_name, file_name)
-
-    bucket = STORAGE_CLIENT.bucket(bucket_name)
-    new_blob = bucket.blob(file_name)
-
-    frame = pd.DataFrame(data, columns=["file_name", "text"])
-
-    with BytesIO() as parquet:
-        frame.to_parquet(parquet, compression="gzip")
-
-        new_blob.upload_from_string(parquet.getvalue(), content_type="application/gzip")
+    return row_queue.get_queue(location)
 
 
 def format_time(seconds):
@@ -708,7 +621,7 @@ def format_time(seconds):
 
 
 def download_run(bucket, run_name):
-    """download a runs worth of results from a GCP bucket
+    """download a runs worth of results and the token and reocr files of its tiles from a GCP bucket
 
     Args:
         bucket (str): the name of the bucket
@@ -717,7 +630,7 @@ def download_run(bucket, run_name):
     Returns:
         str: the location of the files
     """
-    bucket = STORAGE_CLIENT.bucket(bucket)
+    bucket = get_storage_client().bucket(bucket)
     blobs = bucket.list_blobs(prefix=run_name)
     location = Path(__file__).parent / "data"
 
@@ -725,7 +638,9 @@ def download_run(bucket, run_name):
         location.joinpath(run_name).mkdir(parents=True)
 
     for blob in blobs:
-        if blob.name.endswith(".gz"):
+        #: the token and reocr files are needed to replace the text of the tiles that were read again
+        if blob.name.endswith(".gz") or Path(blob.name).parent.name in ("tokens", "reocr"):
+            location.joinpath(blob.name).parent.mkdir(parents=True, exist_ok=True)
             blob.download_to_filename(location / blob.name)
 
     return location.joinpath(run_name)
@@ -744,119 +659,3 @@ def summarize_run(folder, run_name):
     logging.info("summarizing %s", run_name)
 
     folder = Path(folder) / run_name
-
-
-def build_mosaic_image(images, object_name, out_dir):
-    """build a mosaic image from a list of cv2 images
-
-    Args:
-        images (list): list of cv2 images to mosaic together
-        object_name (str): the name of the image object (original filename)
-        out_dir (Path): location to save the result
-
-    Returns:
-        mosaic_image (np.ndarray): composite mosaic of smaller images
-    """
-    if images is None or len(images) == 0:
-        logging.info("no images to mosaic for %s", object_name)
-
-        return np.array(None)
-
-    object_path = Path(object_name)
-    max_dim = 0
-    buffer = 5
-
-    #: Loop through all images to get dimensions, save largest dimension
-    all_widths = []
-    all_heights = []
-    for img in images:
-        all_widths.append(img.shape[1])
-        all_heights.append(img.shape[0])
-
-    max_dim = max([max(all_widths), max(all_heights)])
-
-    #: Set up parameters for mosaic, calculate number of cols/rows
-    number_images = len(images)
-    number_columns = math.floor(math.sqrt(number_images))
-    number_rows = math.ceil(number_images / number_columns)
-
-    #: Build mosaic image with white background
-    tile_width = max_dim + 2 * buffer
-    total_height = tile_width * number_rows
-    total_width = tile_width * number_columns
-
-    logging.info(
-        "mosaicking %i images into %i column by %i row grid, %s",
-        number_images,
-        number_columns,
-        number_rows,
-        {"square pixels": tile_width, "file name": object_name},
-    )
-
-    mosaic_image = np.zeros((total_height, total_width, 3), dtype=np.uint8)
-    mosaic_image[:, :] = (255, 255, 255)
-
-    if total_height * total_width > 40_000_000:
-        logging.error('mosaic image size is too large: "%s"', object_name)
-
-        return np.array(None)
-
-    i = 0
-    for img in images:
-        #: Resize all images by inserting them into the same template tile size
-        [img_height, img_width, _] = img.shape
-
-        buffered_image = np.zeros((tile_width, tile_width, 3), np.uint8)
-        buffered_image[:, :] = (255, 255, 255)
-        buffered_image[buffer : buffer + img_height, buffer : buffer + img_width] = img.copy()
-
-        #: Add buffered image into the mosaic
-        row_start = (math.floor(i / number_columns)) * tile_width
-        col_start = (i % number_columns) * tile_width
-        mosaic_image[row_start : row_start + tile_width, col_start : col_start + tile_width] = buffered_image
-
-        i += 1
-
-    if out_dir:
-        if not out_dir.exists():
-            out_dir.mkdir(parents=True)
-
-        mosaic_outfile = out_dir / f"{object_path.stem}.jpg"
-        logging.info("saving to %s", mosaic_outfile)
-        cv2.imwrite(str(mosaic_outfile), mosaic_image)
-
-    else:
-        return mosaic_image
-
-
-def upload_mosaic(image, bucket_name, object_name, job_name):
-    """upload mosaic image to a GCP bucket as a jpeg mime type
-
-    Args:
-        image (np.array): the mosaic image bytes
-        bucket_name (str): the name of the destination bucket
-        object_name (str): the name of the image object (original filename)
-
-    Returns:
-        bool: True if successful, False otherwise
-    """
-    #: Upload mosaic image to GCP bucket
-    if image is None or not image.any():
-        logging.info('no mosaic image created or uploaded: "%s"', object_name)
-
-        return False
-
-    file_name = f"{job_name}/mosaics/{object_name}"
-    logging.info("uploading %s to %s/%s", object_name, bucket_name, file_name)
-
-    bucket = STORAGE_CLIENT.bucket(bucket_name)
-    new_blob = bucket.blob(str(file_name))
-
-    is_success, buffer = cv2.imencode(".jpg", image)
-
-    if not is_success:
-        logging.error("unable to encode image: %s", object_name)
-
-    new_blob.upload_from_string(buffer.tobytes(), content_type="image/jpeg")
-
-    return True
@@ -0,0 +1,759 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+"""
+UDOT Right of Way (ROW) Parcel Number Extraction
+Synthetic plan sheets and stage benchmarks for the circle detection pipeline
+"""
+
+import json
+import logging
+import platform
+import subprocess
+import sys
+import tracemalloc
+from functools import partial
+from io import BytesIO
+from pathlib import Path
+from statistics import median
+from time import perf_counter
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import row
+import row_detect
+import row_logging
+import row_mosaic
+import row_pack
+import row_render
+
+#: sheet sizes in inches, width by height
+SHEET_SIZES = {
+    "letter": (8.5, 11),
+    "tabloid": (11, 17),
+    "arch-d": (24, 36),
+}
+
+#: the default benchmark cases as (sheet size, dpi, circle count)
+DEFAULT_CASES = [
+    ("letter", 150, 10),
+    ("letter", 300, 10),
+    ("tabloid", 150, 25),
+    ("tabloid", 300, 25),
+]
+
+#: the modules an entry point imports for each job type
+IMPORT_CASES = {
+    "shared": ["row"],
+    "mosaic": ["row", "row_mosaic"],
+    "ocr": ["row", "row_ocr"],
+    "fused": ["row", "row_fused"],
+    "reocr": ["row", "row_reocr"],
+    "all": ["row", "row_mosaic", "row_ocr"],
+}
+
+#: the slow to import libraries that should only be loaded by the jobs that use them
+HEAVY_LIBRARIES = ("cv2", "numpy", "pandas", "pdf2image", "PIL", "google.cloud.documentai", "google.cloud.storage")
+
+
+def parse_cases(text):
+    """read benchmark cases from the command line
+
+    Args:
+        text (str): comma separated cases as size:dpi:circles, eg letter:300:10,arch-d:150:40
+
+    Returns:
+        list(tuple): the (sheet size, dpi, circle count) of each case
+    """
+    cases = []
+
+    for case in text.split(","):
+        parts = case.strip().split(":")
+
+        if len(parts) != 3 or parts[0] not in SHEET_SIZES or not parts[1].isdigit() or not parts[2].isdigit():
+            raise ValueError(
+                f'"{case}" is not a benchmark case. use size:dpi:circles where size is one of '
+                f"{', '.join(SHEET_SIZES)}, eg letter:300:10"
+            )
+
+        cases.append((parts[0], int(parts[1]), int(parts[2])))
+
+    return cases
+
+
+def generate_synthetic_page(size="letter", dpi=300, circle_count=10, seed=0):
+    """draw a deterministic plan sheet with labeled parcel circles, line work and note text
+
+    Args:
+        size (str): one of the `SHEET_SIZES`
+        dpi (int): the resolution the sheet is drawn at
+        circle_count (int): the number of labeled circles to draw
+        seed (int): the random seed. the same arguments always draw the same sheet
+
+    Returns:
+        tuple(np.ndarray, list): the 3 band page and a list of (x, y, radius, label) tuples for the circles
+    """
+    width_inches, height_inches = SHEET_SIZES[size]
+    width = int(width_inches * dpi)
+    height = int(height_inches * dpi)
+    rng = np.random.default_rng(seed)
+
+    page = np.full((height, width, 3), 255, dtype=np.uint8)
+    line_width = max(1, dpi // 100)
+
+    #: property lines and a road alignment as clutter
+    for _ in range(12):
+        start = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        end = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        cv2.line(page, start, end, (0, 0, 0), line_width)
+
+    cv2.rectangle(page, (dpi // 4, dpi // 4), (width - dpi // 4, height - dpi // 4), (0, 0, 0), line_width * 2)
+
+    #: the detector searches for radii around 2.5% of the page height
+    base_radius = round(0.025 * height)
+    font_scale = base_radius / 45
+    labels = []
+    attempts = 0
+
+    while len(labels) < circle_count and attempts < circle_count * 200:
+        attempts += 1
+        radius = base_radius + int(rng.integers(-6, 7))
+        x = int(rng.integers(2 * radius, width - 2 * radius))
+        y = int(rng.integers(2 * radius, height - 2 * radius))
+
+        if any(
+            (x - other_x) ** 2 + (y - other_y) ** 2 < (2.5 * (radius + other_radius)) ** 2
+            for other_x, other_y, other_radius, _ in labels
+        ):
+            continue
+
+        label = f"{int(rng.integers(1, 999))}{'' if rng.random() < 0.6 else ':' + 'ABCE'[int(rng.integers(0, 4))]}"
+        labels.append((x, y, radius, label))
+
+    for x, y, radius, label in labels:
+        cv2.circle(page, (x, y), radius, (255, 255, 255), -1)
+        cv2.circle(page, (x, y), radius, (0, 0, 0), line_width * 2)
+
+        (text_width, text_height), _ = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, font_scale, line_width * 2)
+        origin = (x - text_width // 2, y + text_height // 2)
+        cv2.putText(page, label, origin, cv2.FONT_HERSHEY_SIMPLEX, font_scale, (0, 0, 0), line_width * 2)
+
+    #: a block of notes in the lower corner
+    for line in range(6):
+        origin = (dpi // 2, height - dpi // 2 - line * int(dpi * 0.2))
+        cv2.putText(page, f"NOTE {line + 1}: SEE SHEET R-{line + 10}", origin, cv2.FONT_HERSHEY_PLAIN, dpi / 150, 0, 1)
+
+    return page, labels
+
+
+def generate_synthetic_text_page(size="letter", dpi=300, seed=0):
+    """draw a deterministic narrative sheet with a title and paragraphs of text but no parcel circles
+
+    Args:
+        size (str): one of the `SHEET_SIZES`
+        dpi (int): the resolution the sheet is drawn at
+        seed (int): the random seed
+
+    Returns:
+        np.ndarray: the 3 band page
+    """
+    width_inches, height_inches = SHEET_SIZES[size]
+    width = int(width_inches * dpi)
+    height = int(height_inches * dpi)
+    rng = np.random.default_rng(seed)
+    words = ["RIGHT", "OF", "WAY", "PARCEL", "NO.", "grantor", "conveys", "the", "described", "tract", "of", "land"]
+    words += ["0.25", "acres", "S89°", "E", "123.45", "feet", "beginning", "at", "a", "point", "on", "said", "line"]
+
+    page = np.full((height, width, 3), 255, dtype=np.uint8)
+    line_width = max(1, dpi // 150)
+
+    cv2.putText(page, "WARRANTY DEED", (dpi, dpi), cv2.FONT_HERSHEY_SIMPLEX, dpi / 60, (0, 0, 0), line_width * 3)
+
+    y = int(dpi * 1.6)
+    while y < height - dpi:
+        words_per_line = int((width - 2 * dpi) / (dpi * 0.55))
+        cv2.putText(
+            page,
+            " ".join(rng.choice(words, words_per_line)),
+            (dpi, y),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            dpi / 200,
+            0,
+            line_width,
+        )
+
+        y += int(dpi * 0.25)
+        if rng.random() < 0.1:
+            y += dpi // 3
+
+    return page
+
+
+def generate_synthetic_pdf(pages, dpi=300):
+    """save synthetic pages as a pdf with one page per image
+
+    Args:
+        pages (list): 3 band cv2 page images
+        dpi (int): the resolution the pages were drawn at so the pdf page size matches the sheet size
+
+    Returns:
+        bytes: the pdf
+    """
+    images = [Image.fromarray(cv2.cvtColor(page, cv2.COLOR_BGR2RGB)) for page in pages]
+
+    with BytesIO() as pdf:
+        images[0].save(pdf, format="PDF", resolution=dpi, save_all=True, append_images=images[1:])
+
+        return pdf.getvalue()
+
+
+def match_circles(circles, labels):
+    """match detected circles to the labeled circles. a detection matches a label when its center is within half of
+    the labeled radius and each label can only be matched once. when only the number of circles on a page is known,
+    every detection up to that number is counted as a match
+
+    Args:
+        circles (np.ndarray): the circles from cv2.HoughCircles or None
+        labels (list|int): (x, y, radius, ...) tuples of the known circles or the number of circles
+
+    Returns:
+        dict: the true positive, false positive and false negative counts with the recall and precision
+    """
+    detections = [] if circles is None else np.asarray(circles).reshape(-1, 3).tolist()
+
+    if isinstance(labels, int):
+        true_positives = min(len(detections), labels)
+
+        return {
+            "true positives": true_positives,
+            "false positives": len(detections) - true_positives,
+            "false negatives": labels - true_positives,
+            "recall": true_positives / labels if labels else 1.0,
+            "precision": true_positives / len(detections) if detections else 1.0,
+        }
+
+    unmatched = list(labels)
+    true_positives = 0
+
+    for x, y, _ in detections:
+        for label in unmatched:
+            if (x - label[0]) ** 2 + (y - label[1]) ** 2 <= (label[2] / 2) ** 2:
+                unmatched.remove(label)
+                true_positives += 1
+
+                break
+
+    false_positives = len(detections) - true_positives
+
+    return {
+        "true positives": true_positives,
+        "false positives": false_positives,
+        "false negatives": len(unmatched),
+        "recall": true_positives / len(labels) if labels else 1.0,
+        "precision": true_positives / len(detections) if detections else 1.0,
+    }
+
+
+def measure(function, repeat=3):
+    """time a function and trace its peak python and numpy memory allocations. the timed calls run without tracing
+    because tracemalloc slows down every allocation. the memory is traced in one more call
+
+    Args:
+        function (callable): the function to measure. it is called with no arguments
+        repeat (int): the number of times to time the function
+
+    Returns:
+        tuple(object, dict): the result of the last call and the `seconds`, `min seconds` and `peak bytes`
+    """
+    timings = []
+    result = None
+
+    for _ in range(repeat):
+        start = perf_counter()
+
+        result = function()
+
+        timings.append(perf_counter() - start)
+
+    tracemalloc.start()
+
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return result, {"seconds": median(timings), "min seconds": min(timings), "peak bytes": peak}
+
+
+def measure_imports(cases=None, repeat=3):
+    """time the imports of each job type in a fresh interpreter. this is the cold start a task pays before it does
+    any work
+
+    Args:
+        cases (dict): the modules to import for each case. defaults to `IMPORT_CASES`
+        repeat (int): the number of interpreters to time for each case
+
+    Returns:
+        dict: the `seconds`, `min seconds` and the `HEAVY_LIBRARIES` that were loaded for each case
+    """
+    if cases is None:
+        cases = IMPORT_CASES
+
+    results = {}
+
+    for case, modules in cases.items():
+        code = (
+            "import json, sys\n"
+            "from time import perf_counter\n"
+            "start = perf_counter()\n"
+            + "".join(f"import {module}\n" for module in modules)
+            + "seconds = perf_counter() - start\n"
+            f"print(json.dumps([seconds, [name for name in {HEAVY_LIBRARIES!r} if name in sys.modules]]))\n"
+        )
+        timings = []
+        libraries = []
+
+        for _ in range(repeat):
+            output = subprocess.run(
+                [sys.executable, "-c", code], capture_output=True, check=True, text=True, cwd=Path(__file__).parent
+            )
+            seconds, libraries = json.loads(output.stdout.strip().splitlines()[-1])
+            timings.append(seconds)
+
+        results[case] = {
+            "modules": modules,
+            "seconds": median(timings),
+            "min seconds": min(timings),
+            "libraries": libraries,
+        }
+
+    return results
+
+
+def benchmark_case(size, dpi, circle_count, repeat=3, seed=0):
+    """benchmark each pipeline stage on a synthetic sheet
+
+    Args:
+        size (str): one of the `SHEET_SIZES`
+        dpi (int): the resolution of the sheet
+        circle_count (int): the number of labeled circles
+        repeat (int): the number of timed runs per stage
+        seed (int): the random seed for the sheet
+
+    Returns:
+        dict: the case description, the measurements for each stage and the detection accuracy
+    """
+    page, labels = generate_synthetic_page(size, dpi, circle_count, seed)
+    height, width = page.shape[:2]
+    _, encoded = cv2.imencode(".png", page)
+    page_bytes = encoded.tobytes()
+    pdf_bytes = generate_synthetic_pdf([page], dpi)
+
+    stages = {}
+
+    rendered, stages["convert_pdf_to_jpg_bytes"] = measure(
+        lambda: list(row_render.convert_pdf_to_jpg_bytes(pdf_bytes, "benchmark.pdf")[0]), repeat
+    )
+    if not rendered:
+        stages["convert_pdf_to_jpg_bytes"]["error"] = "the pdf could not be rendered"
+
+    crops, stages["get_circles_from_image_bytes"] = measure(
+        lambda: row_mosaic.get_circles_from_image_bytes(page_bytes, None, "benchmark.png"), repeat
+    )
+
+    #: detection is measured on its own for the accuracy and so export is not timed twice
+    (circles, inset), stages["detect_circles"] = measure(lambda: row_detect.detect_circles(page), repeat)
+
+    _, stages["export_circles_from_image"] = measure(
+        lambda: row_mosaic.export_circles_from_image(circles, None, "benchmark.png", page, height, width, inset), repeat
+    )
+
+    _, stages["build_mosaic_image"] = measure(lambda: row_pack.build_mosaic_image(crops, "benchmark.png", None), repeat)
+
+    return {
+        "case": f"{size}-{dpi}dpi-{circle_count}",
+        "size": size,
+        "dpi": dpi,
+        "circles": circle_count,
+        "pixels": width * height,
+        "stages": stages,
+        "detection": match_circles(circles, labels),
+    }
+
+
+def load_labeled_pages(location):
+    """read labeled pages for `compare_detectors`. the labels are a json object with the image file names, relative
+    to the labels file, as keys and a list of [x, y, radius] circles or the number of circles on the page as values
+
+    Args:
+        location (str): the labels json file
+
+    Returns:
+        list(tuple): (name, page, labels) for each image
+    """
+    location = Path(location)
+    pages = []
+
+    for name, circles in json.loads(location.read_text(encoding="utf-8")).items():
+        page = cv2.imread(str(location.parent / name), cv2.IMREAD_COLOR)
+
+        if page is None:
+            logging.warning("unable to read labeled page %s", name)
+
+            continue
+
+        if isinstance(circles, int):
+            pages.append((name, page, circles))
+        else:
+            pages.append((name, page, [tuple(circle[:3]) for circle in circles]))
+
+    return pages
+
+
+def compare_detectors(cases=None, detectors=None, repeat=3, pages=None, seeds=3):
+    """compare the speed, recall and precision of the circle detectors on synthetic and labeled pages
+
+    Args:
+        cases (list): (sheet size, dpi, circle count) tuples. defaults to `DEFAULT_CASES`
+        detectors (list): the names of the detectors to compare. defaults to every one of the `CIRCLE_DETECTORS`
+        repeat (int): the number of timed runs per page
+        pages (list): (name, page, labels) tuples from `load_labeled_pages` to compare on as well
+        seeds (int): the number of synthetic pages drawn for each case
+
+    Returns:
+        dict: the totals for each detector and the results for each page
+    """
+    if cases is None:
+        cases = DEFAULT_CASES
+
+    if detectors is None:
+        detectors = list(row_detect.CIRCLE_DETECTORS)
+
+    pages = list(pages or [])
+    for size, dpi, circle_count in cases:
+        for seed in range(seeds):
+            page, labels = generate_synthetic_page(size, dpi, circle_count, seed)
+            pages.append((f"{size}-{dpi}dpi-{circle_count}-{seed}", page, labels))
+
+    results = []
+    totals = {
+        detector: {"seconds": 0.0, "true positives": 0, "false positives": 0, "false negatives": 0}
+        for detector in detectors
+    }
+
+    for name, page, labels in pages:
+        for detector in detectors:
+            (circles, _), measurement = measure(partial(row_detect.detect_circles, page, detector), repeat)
+            detection = match_circles(circles, labels)
+
+            results.append({"page": name, "detector": detector, **measurement, **detection})
+
+            total = totals[detector]
+            total["seconds"] += measurement["min seconds"]
+            for key in ("true positives", "false positives", "false negatives"):
+                total[key] += detection[key]
+
+    for total in totals.values():
+        found = total["true positives"] + total["false positives"]
+        labeled = total["true positives"] + total["false negatives"]
+
+        total["recall"] = total["true positives"] / labeled if labeled else 1.0
+        total["precision"] = total["true positives"] / found if found else 1.0
+
+    return {"detectors": totals, "pages": results}
+
+
+def measure_triage(cases=None, text_pages=3, detector="hough", repeat=1, seeds=3):
+    """measure how many pages the triage skips, how much faster detection gets and whether any circles are lost on
+    synthetic plan sheets and narrative pages
+
+    Args:
+        cases (list): (sheet size, dpi, circle count) tuples for the plan sheets. defaults to `DEFAULT_CASES`
+        text_pages (int): the number of narrative pages without circles
+        detector (str): one of the `CIRCLE_DETECTORS`
+        repeat (int): the number of timed runs per page
+        seeds (int): the number of plan sheets drawn for each case
+
+    Returns:
+        dict: the totals with and without triage and the results for each page
+    """
+    if cases is None:
+        cases = DEFAULT_CASES
+
+    pages = []
+    for size, dpi, circle_count in cases:
+        for seed in range(seeds):
+            page, labels = generate_synthetic_page(size, dpi, circle_count, seed)
+            pages.append((f"{size}-{dpi}dpi-{circle_count}-{seed}", page, labels))
+
+    for seed in range(text_pages):
+        pages.append((f"text-{seed}", generate_synthetic_text_page("letter", 300, seed), []))
+
+    results = []
+    totals = {
+        triage: {"seconds": 0.0, "pages": len(pages), "skipped": 0, "true positives": 0, "false negatives": 0}
+        for triage in ("without triage", "with triage")
+    }
+
+    for name, page, labels in pages:
+        for triage, total in zip((False, True), totals.values()):
+            row_mosaic.METRICS.reset()
+            (circles, _), measurement = measure(partial(row_detect.detect_circles, page, detector, triage), repeat)
+            detection = match_circles(circles, labels)
+            skipped = row_mosaic.METRICS.counters.get("pages_triage_skipped", 0) > 0
+
+            results.append({"page": name, "triage": triage, "skipped": skipped, **measurement, **detection})
+
+            total["seconds"] += measurement["min seconds"]
+            total["skipped"] += skipped
+            total["true positives"] += detection["true positives"]
+            total["false negatives"] += detection["false negatives"]
+
+    for total in totals.values():
+        labeled = total["true positives"] + total["false negatives"]
+
+        total["skip rate"] = total["skipped"] / total["pages"] if total["pages"] else 0.0
+        total["recall"] = total["true positives"] / labeled if labeled else 1.0
+
+    return {"totals": totals, "pages": results}
+
+
+def measure_decoding(cases=None, reductions=(1, 2, 4), text_pages=3, repeat=3, seeds=2):
+    """compare decoding a jpeg page in color for detection against the grayscale and reduced grayscale decodes that
+    only decode the color page when circles are found
+
+    Args:
+        cases (list): (sheet size, dpi, circle count) tuples for the plan sheets. defaults to `DEFAULT_CASES`
+        reductions (tuple): the `DECODE_REDUCTIONS` to compare
+        text_pages (int): the number of narrative pages without circles
+        repeat (int): the number of timed runs per page
+        seeds (int): the number of plan sheets drawn for each case
+
+    Returns:
+        dict: the seconds, peak bytes and recall of each mode and the results for each page
+    """
+    if cases is None:
+        cases = DEFAULT_CASES
+
+    pages = []
+    for size, dpi, circle_count in cases:
+        for seed in range(seeds):
+            page, labels = generate_synthetic_page(size, dpi, circle_count, seed)
+            pages.append((f"{size}-{dpi}dpi-{circle_count}-{seed}", page, labels))
+
+    for seed in range(text_pages):
+        pages.append((f"text-{seed}", generate_synthetic_text_page("letter", 300, seed), []))
+
+    def color_decode(content):
+        img = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_COLOR)
+        circles, inset = row_detect.detect_circles(img)
+        crops = row_mosaic.export_circles_from_image(circles, None, "color", img, *img.shape[:2], inset)
+
+        return circles, crops
+
+    def gray_decode(content, reduction):
+        page, circles, inset = row_mosaic.read_and_detect_circles(content, "gray", None, "hough", False, reduction)
+        crops = []
+        if circles is not None:
+            crops = row_mosaic.export_circles_from_image(circles, None, "gray", page.color(), *page.shape, inset)
+
+        return circles, crops
+
+    modes = {"color": color_decode}
+    modes.update(
+        {
+            f"gray 1/{reduction}": lambda content, reduction=reduction: gray_decode(content, reduction)
+            for reduction in reductions
+        }
+    )
+
+    results = []
+    totals = {mode: {"seconds": 0.0, "peak bytes": 0, "true positives": 0, "false negatives": 0} for mode in modes}
+
+    for name, page, labels in pages:
+        content = cv2.imencode(".jpg", page, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+
+        for mode, decode in modes.items():
+            (circles, crops), measurement = measure(partial(decode, content), repeat)
+            detection = match_circles(circles, labels)
+
+            results.append({"page": name, "mode": mode, "crops": len(crops), **measurement, **detection})
+
+            totals[mode]["seconds"] += measurement["min seconds"]
+            totals[mode]["peak bytes"] = max(totals[mode]["peak bytes"], measurement["peak bytes"])
+            totals[mode]["true positives"] += detection["true positives"]
+            totals[mode]["false negatives"] += detection["false negatives"]
+
+    for total in totals.values():
+        labeled = total["true positives"] + total["false negatives"]
+        total["recall"] = total["true positives"] / labeled if labeled else 1.0
+
+    return {"totals": totals, "pages": results}
+
+
+def measure_logging(pages=None, latency=0.002, record_latency=0.0001, sample_rate=None, repeat=5):
+    """measure the time logging adds to circle detection when every record is shipped to a slow sink as it is logged,
+    when the records are shipped in batches from a background thread and when the detail records are also sampled
+
+    Args:
+        pages (list(np.ndarray)): the pages to detect circles on. defaults to plan sheets and narrative pages
+        latency (float): the seconds the stand in sink waits for each call
+        record_latency (float): the seconds the stand in sink waits for each record
+        sample_rate (float): the share of detail records kept by the sampled mode. defaults to the production rate
+        repeat (int): the number of timed rounds. the modes take turns in each round and the fastest round is kept
+
+    Returns:
+        dict: the detection seconds, the overhead over not logging and the records and sink calls for each mode
+    """
+    if pages is None:
+        #: small pages keep the detection time close to the logging time. the narrative pages run every pass
+        pages = [generate_synthetic_page("letter", 72, 6, seed)[0] for seed in range(10)]
+        pages += [generate_synthetic_text_page("letter", 72, seed) for seed in range(10)]
+
+    if sample_rate is None:
+        sample_rate = row_logging.PRODUCTION_SAMPLE_RATE
+
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    modes = ("silent", "blocking", "queued", "sampled")
+    results = {mode: {"seconds": None} for mode in modes}
+
+    def detect_all():
+        for page in pages:
+            row_detect.detect_circles(page)
+
+    try:
+        for round_index in range(repeat + 1):
+            for mode in modes:
+                sink = row_logging.LocalSink(latency, record_latency)
+                shipper = None
+
+                for handler in root.handlers[:]:
+                    root.removeHandler(handler)
+
+                root.setLevel(logging.WARNING if mode == "silent" else logging.INFO)
+                row_logging.sample_detail_logs(1.0)
+
+                if mode == "blocking":
+                    root.addHandler(row_logging.SinkHandler(sink))
+                elif mode != "silent":
+                    shipper = row_logging.ship_logs_in_background(sink, 1.0 if mode == "queued" else sample_rate)
+
+                start = perf_counter()
+                detect_all()
+                seconds = perf_counter() - start
+
+                if shipper is not None:
+                    shipper.close()
+
+                #: the first round warms up the detector and is not counted
+                if round_index and (results[mode]["seconds"] is None or seconds < results[mode]["seconds"]):
+                    results[mode] = {"seconds": seconds, "records": len(sink.lines), "sink calls": sink.calls}
+    finally:
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+
+        for handler in handlers:
+            root.addHandler(handler)
+
+        root.setLevel(level)
+        row_logging.sample_detail_logs(1.0)
+
+    for result in results.values():
+        result["overhead seconds"] = result["seconds"] - results["silent"]["seconds"]
+
+    return results
+
+
+def run_benchmarks(cases=None, repeat=3):
+    """run the stage benchmarks for a list of cases
+
+    Args:
+        cases (list): (sheet size, dpi, circle count) tuples. defaults to `DEFAULT_CASES`
+        repeat (int): the number of timed runs per stage
+
+    Returns:
+        dict: the environment and the results for each case
+    """
+    if cases is None:
+        cases = DEFAULT_CASES
+
+    results = []
+    for size, dpi, circle_count in cases:
+        logging.info("benchmarking %s at %i dpi with %i circles", size, dpi, circle_count)
+        results.append(benchmark_case(size, dpi, circle_count, repeat))
+
+    return {
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "machine": platform.machine(),
+        "cases": results,
+    }
+
+
+def compare_benchmarks(results, baseline, tolerance=0.2, recall_tolerance=0.01):
+    """compare benchmark results to a stored baseline
+
+    Args:
+        results (dict): the results from `run_benchmarks`
+        baseline (dict): the baseline results from `run_benchmarks`
+        tolerance (float): the allowed fractional slow down or memory growth
+        recall_tolerance (float): the allowed recall loss. the synthetic pages are deterministic so any real drop is
+                                  a regression
+
+    Returns:
+        list(str): a description of every regression. empty when nothing regressed
+    """
+    baseline_cases = {case["case"]: case for case in baseline["cases"]}
+    regressions = []
+
+    for case in results["cases"]:
+        previous = baseline_cases.get(case["case"])
+
+        if previous is None:
+            continue
+
+        for stage, measurement in case["stages"].items():
+            before = previous["stages"].get(stage)
+
+            if before is None:
+                continue
+
+            if measurement["min seconds"] > before["min seconds"] * (1 + tolerance):
+                regressions.append(
+                    f"{case['case']} {stage} slowed from {row.format_time(before['min seconds'])} "
+                    f"to {row.format_time(measurement['min seconds'])}"
+                )
+
+            if measurement["peak bytes"] > before["peak bytes"] * (1 + tolerance):
+                regressions.append(
+                    f"{case['case']} {stage} peak memory grew from {before['peak bytes']:,} "
+                    f"to {measurement['peak bytes']:,} bytes"
+                )
+
+        if case["detection"]["recall"] < previous["detection"]["recall"] - recall_tolerance:
+            regressions.append(
+                f"{case['case']} recall dropped from {previous['detection']['recall']:.1%} "
+                f"to {case['detection']['recall']:.1%}"
+            )
+
+    return regressions
+
+
+def save_benchmarks(results, location):
+    """write benchmark results as json
+
+    Args:
+        results (dict): the results from `run_benchmarks`
+        location (str): the file to write
+
+    Returns:
+        Path: the file written
+    """
+    location = Path(location)
+    location.parent.mkdir(parents=True, exist_ok=True)
+    location.write_text(json.dumps(results, indent=2), encoding="utf-8")
+
+    return location
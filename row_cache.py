@@ -0,0 +1,435 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+"""
+UDOT Right of Way (ROW) Parcel Number Extraction
+The page caches. the page hash index reuses the detections of pages that look the same and the detection cache
+keeps the crops of each page so documents seen before are mosaicked without being rendered again
+"""
+
+import base64
+import json
+import logging
+from urllib.parse import quote
+from uuid import uuid4
+
+import cv2
+import numpy as np
+
+import row
+import row_detect
+from row_metrics import METRICS
+
+
+def get_page_caches(options):
+    """create the page hash index and the detection cache the options ask for
+
+    Args:
+        options (SimpleNamespace): the mosaic options from `row_mosaic.get_mosaic_options`
+
+    Returns:
+        tuple(PageHashIndex, DetectionCache): the index and the cache. either is None when it is not used
+    """
+    hash_index = None
+    if options.hash_index:
+        hash_index = PageHashIndex(
+            row.get_record_store(options.hash_index), options.detector, options.detection_parameters
+        )
+
+    detection_cache = None
+    if options.detection_cache:
+        detection_cache = DetectionCache(row.get_record_store(options.detection_cache), options)
+
+    return hash_index, detection_cache
+
+
+def log_page_cache_summaries(job_name, task_index, hash_index, detection_cache):
+    """log how often the page hash index and the detection cache were hit in a task
+
+    Args:
+        job_name (str): the name of the run job
+        task_index (int): the index of the task running
+        hash_index (PageHashIndex): the index or None
+        detection_cache (DetectionCache): the cache or None
+    """
+    if hash_index is not None:
+        METRICS.increment("duplicate_pages", hash_index.hits)
+        logging.info("job name: %s task: %i page dedup summary: %s", job_name, task_index, hash_index.summary())
+
+    if detection_cache is not None:
+        logging.info(
+            "job name: %s task: %i detection cache summary: %s", job_name, task_index, detection_cache.summary()
+        )
+
+
+def get_page_signature(img):
+    """compute a perceptual signature for a page. the hash is a 256 bit difference hash of a 17x16 downsample used as
+    the lookup key and the 64x64 thumbnail is kept to confirm a match
+
+    Args:
+        img (np.ndarray): the page image
+
+    Returns:
+        dict: the `hash`, `thumbnail` and `shape` of the page
+    """
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+    small = cv2.resize(gray, (17, 16), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+
+    return {
+        "hash": np.packbits(bits).tobytes().hex(),
+        "thumbnail": cv2.resize(gray, (64, 64), interpolation=cv2.INTER_AREA),
+        "shape": gray.shape[:2],
+    }
+
+
+class PageHashIndex:
+    """an index of page signatures and the circles detected on them. pages that look the same as a page already in
+    the index reuse its circle positions, scaled to the page size. only the positions are reused, the crops are always
+    cut from the page being processed so look alike sheets with different text still produce their own crops. a page
+    whose hash is not in the index is compared to the pages sharing a band of its hash so rescanned or re-exported
+    copies with a few different hash bits are still found
+    """
+
+    #: the largest mean thumbnail difference, in gray levels, for two pages to be considered duplicates
+    tolerance = 6.0
+
+    #: the largest share of thumbnail pixels that can differ by more than four times the tolerance. a mostly blank
+    #: page is close to a blank one on average so the few pixels its marks change have to be checked as well
+    outliers = 0.002
+
+    #: the number of bands the hash is split into. pages sharing any band are candidates
+    bands = 8
+
+    #: the most hash bits a candidate can differ by before its thumbnail is compared
+    max_distance = 24
+
+    def __init__(self, store, detector="hough", parameters=None):
+        self.store = store
+        #: each detector and detection profile keeps its own records. hough with the default parameters keeps the
+        #: original keys so existing indexes stay valid
+        self.prefix = "" if detector == "hough" else f"{detector}/"
+
+        parameters_key = row_detect.get_parameters_key(parameters)
+        if parameters_key:
+            self.prefix = f"{self.prefix}{parameters_key}/"
+        self.hits = 0
+        self.misses = 0
+        self._cache = {}
+        self._bands = {}
+
+    def lookup(self, signature):
+        """find the detections for a duplicate page. the records with the same hash are compared first and the
+        records sharing a band with it when none of them match
+
+        Args:
+            signature (dict): the page signature from `get_page_signature`
+
+        Returns:
+            tuple(np.ndarray, int): the circles and inset scaled to the page or None when the page is not known
+        """
+        record = self._find(signature, [signature["hash"]]) or self._find(signature, self._neighbours(signature))
+
+        if record is None:
+            self.misses += 1
+
+            return None
+
+        self.hits += 1
+
+        scale = signature["shape"][0] / record["height"]
+        inset = int(record["inset"] * scale)
+
+        if not record["circles"]:
+            return None, inset
+
+        circles = np.array([record["circles"]], dtype=np.float32) * scale
+
+        return circles, inset
+
+    def record(self, signature, circles, inset):
+        """add the detections for a page to the index. each record and band entry is its own object so tasks sharing
+        the index add to it without replacing what the other tasks wrote. pages with the same hash that do not look
+        the same are kept side by side
+
+        Args:
+            signature (dict): the page signature from `get_page_signature`
+            circles (np.ndarray): the circles from cv2.HoughCircles or None
+            inset (int): the inset distance in pixels
+        """
+        page_hash = signature["hash"]
+        height, width = signature["shape"]
+
+        record = {
+            "height": int(height),
+            "width": int(width),
+            "inset": int(inset),
+            "circles": [] if circles is None else np.asarray(circles[0]).tolist(),
+            "thumbnail": base64.b64encode(signature["thumbnail"].tobytes()).decode("ascii"),
+        }
+
+        records = self._records(page_hash)
+        self.store.put(f"{self.prefix}{page_hash}/{uuid4().hex}.json", json.dumps(record).encode("utf-8"))
+        self._cache[page_hash] = [*records, record]
+
+        for key in self._band_keys(page_hash):
+            self.store.put(f"{key}/{page_hash}", b"")
+
+            if key in self._bands and page_hash not in self._bands[key]:
+                self._bands[key].append(page_hash)
+
+    def summary(self):
+        """summarize the dedup hit rate
+
+        Returns:
+            dict: the hits, misses and hit rate
+        """
+        total = self.hits + self.misses
+
+        return {"hits": self.hits, "misses": self.misses, "hit rate": round(self.hits / total, 4) if total else 0}
+
+    def _find(self, signature, hashes):
+        best, closest = None, None
+
+        for page_hash in hashes:
+            for record in self._records(page_hash):
+                difference = self._difference(record, signature)
+
+                if difference is not None and (closest is None or difference < closest):
+                    best, closest = record, difference
+
+        return best
+
+    def _records(self, page_hash):
+        #: only the records that were found are cached so a page another task adds later is still seen
+        records = self._cache.get(page_hash)
+
+        if records is None:
+            records = [json.loads(self.store.get(key)) for key in self.store.list(f"{self.prefix}{page_hash}")]
+
+            #: indexes written before each record was its own object hold every record of a hash in one file
+            content = self.store.get(f"{self.prefix}{page_hash}.json")
+            if content:
+                legacy = json.loads(content)
+                records = [*(legacy if isinstance(legacy, list) else [legacy]), *records]
+
+            if records:
+                self._cache[page_hash] = records
+
+        return records
+
+    def _band_keys(self, page_hash):
+        size = len(page_hash) // self.bands
+
+        return [f"{self.prefix}bands/{band}-{page_hash[band * size:(band + 1) * size]}" for band in range(self.bands)]
+
+    def _band(self, key):
+        #: the hashes in a band are found by listing its folder. only bands with hashes are cached so the hashes other
+        #: tasks add to an empty band are still found
+        if key in self._bands:
+            return self._bands[key]
+
+        hashes = [name.rpartition("/")[2] for name in self.store.list(key)]
+
+        if hashes:
+            self._bands[key] = hashes
+
+        return hashes
+
+    def _neighbours(self, signature):
+        page_hash = signature["hash"]
+        value = int(page_hash, 16)
+        seen = {page_hash}
+
+        for key in self._band_keys(page_hash):
+            for other in self._band(key):
+                if other in seen:
+                    continue
+
+                seen.add(other)
+
+                if bin(value ^ int(other, 16)).count("1") <= self.max_distance:
+                    yield other
+
+    def _difference(self, record, signature):
+        height, width = signature["shape"]
+
+        if abs(record["width"] / record["height"] - width / height) > 0.01:
+            return None
+
+        thumbnail = np.frombuffer(base64.b64decode(record["thumbnail"]), dtype=np.uint8).reshape(64, 64)
+        differences = np.abs(thumbnail.astype(np.int16) - signature["thumbnail"].astype(np.int16))
+        difference = differences.mean()
+
+        if difference > self.tolerance or (differences > self.tolerance * 4).mean() > self.outliers:
+            return None
+
+        return difference
+
+
+class DetectionCache:
+    """the circles detected on each page of a document and their crops, keyed by the content hash of the document
+    and the page number under the detector version and settings. a document whose pages are all cached is mosaicked
+    from its cached crops without being downloaded, rendered or searched for circles
+    """
+
+    def __init__(self, store, options):
+        self.store = store
+        self.detector = options.detector
+        self.parameters = {**row_detect.DETECTION_PARAMETERS, **(options.detection_parameters or {})}
+        self.prefix = f"v{row_detect.DETECTOR_VERSION}/{get_detection_settings_key(options)}/"
+        self.hits = 0
+        self.misses = 0
+
+    def get_source(self, bucket, object_name):
+        """identify the content of a document from its metadata without downloading it. the md5 or crc32c hash is
+        used so copies of a document share their records. the name and generation are the fallback
+
+        Args:
+            bucket (google.cloud.storage.Bucket): the bucket containing the object
+            object_name (str): the name of the object
+
+        Returns:
+            str: the source key or None when the object does not exist
+        """
+        blob = bucket.get_blob(object_name)
+
+        if blob is None:
+            return None
+
+        for attribute, name in (("md5_hash", "md5"), ("crc32c", "crc32c")):
+            value = getattr(blob, attribute, None)
+
+            if value:
+                return f"{name}-{base64.b64decode(value).hex()}"
+
+        return f"generation/{quote(object_name, safe='')}-{blob.generation}"
+
+    def load(self, source, pages=None):
+        """read the crops of every page of a document or page range
+
+        Args:
+            source (str): the source key from `get_source`
+            pages (tuple): the (first, last) page range or None for the whole document
+
+        Returns:
+            list(tuple): the page number and crops of each page or None when any page is not cached
+        """
+        content = self.store.get(f"{self.prefix}{source}/{get_unit_key(pages)}.json") if source else None
+
+        if content is None:
+            self.misses += 1
+
+            return None
+
+        cached = []
+
+        for page in json.loads(content)["pages"]:
+            record = self.store.get(f"{self.prefix}{source}/{page}.page")
+
+            if record is None:
+                self.misses += 1
+
+                return None
+
+            header, _, crops = bytes(record).partition(b"\n")
+            offsets = np.cumsum([0] + json.loads(header)["crops"])
+
+            cached.append(
+                (
+                    page,
+                    [
+                        cv2.imdecode(np.frombuffer(crops[start:end], dtype=np.uint8), cv2.IMREAD_COLOR)
+                        for start, end in zip(offsets[:-1], offsets[1:])
+                    ],
+                )
+            )
+
+        self.hits += 1
+
+        return cached
+
+    def save_page(self, source, page, circles, inset, crops):
+        """record the detections and crops of a page. the crops are kept as lossless pngs after a json header
+
+        Args:
+            source (str): the source key from `get_source`
+            page (int): the one based page number in the document
+            circles (np.ndarray): the circles on the page or None
+            inset (int): the inset distance in pixels
+            crops (list): the circle crops from `row_mosaic.export_circles_from_image`
+        """
+        if source is None:
+            return
+
+        encoded = [cv2.imencode(".png", crop)[1].tobytes() for crop in crops]
+        header = {
+            "version": row_detect.DETECTOR_VERSION,
+            "detector": self.detector,
+            "parameters": self.parameters,
+            "circles": [] if circles is None else np.asarray(circles).reshape(-1, 3).round(2).tolist(),
+            "inset": int(inset),
+            "crops": [len(crop) for crop in encoded],
+        }
+
+        self.store.put(
+            f"{self.prefix}{source}/{page}.page", json.dumps(header).encode("utf-8") + b"\n" + b"".join(encoded)
+        )
+
+    def save_unit(self, source, pages, page_numbers):
+        """record the pages of a document or page range once every one of them was detected and saved
+
+        Args:
+            source (str): the source key from `get_source`
+            pages (tuple): the (first, last) page range or None for the whole document
+            page_numbers (list): the page numbers that were detected
+        """
+        if source is None:
+            return
+
+        self.store.put(
+            f"{self.prefix}{source}/{get_unit_key(pages)}.json", json.dumps({"pages": page_numbers}).encode("utf-8")
+        )
+
+    def summary(self):
+        """summarize the cache hit rate
+
+        Returns:
+            dict: the hits, misses and hit rate
+        """
+        total = self.hits + self.misses
+
+        return {"hits": self.hits, "misses": self.misses, "hit rate": round(self.hits / total, 4) if total else 0}
+
+
+def get_unit_key(pages):
+    """the name of a work unit's cache record
+
+    Args:
+        pages (tuple): the (first, last) page range or None for the whole document
+
+    Returns:
+        str: `all` or `first-last`
+    """
+    return "all" if pages is None else f"{pages[0]}-{pages[1]}"
+
+
+def get_detection_settings_key(options):
+    """the settings that change the detections or the crops of a page
+
+    Args:
+        options (SimpleNamespace): the mosaic options from `row_mosaic.get_mosaic_options`
+
+    Returns:
+        str: the detector, dpi, decode reduction, triage and a hash of any non default parameters
+    """
+    key = f"{options.detector}-{options.dpi}dpi-{options.decode_reduction}x"
+
+    if options.triage:
+        key = f"{key}-triage"
+
+    parameters_key = row_detect.get_parameters_key(options.detection_parameters)
+    if parameters_key:
+        key = f"{key}-{parameters_key}"
+
+    return key
@@ -5,40 +5,142 @@ UDOT Right of Way (ROW) Parcel Number Extraction
 
 Usage:
     row_cli.py storage generate-index (--from=location) [--prefix=prefix --save-to=location]
-    row_cli.py storage generate-remaining-index (--full-index=location --processed-index=location) [--save-to=location]
+    row_cli.py storage generate-remaining-index (--full-index=location --processed-index=location) [--save-to=location --mosaics=location]
     row_cli.py index filter <file_name>
     row_cli.py storage pick-range (--from=location --task-index=index --file-count=count --instances=size)
-    row_cli.py process images --job=name --from=location --save-to=location --index=location --task-index=index --file-count=count --instances=size
+    row_cli.py storage split-index (--from=location --index=location) [--pages=count --min-size=mb --save-to=location]
+    row_cli.py process images --job=name --from=location --save-to=location --index=location --task-index=index --file-count=count --instances=size [--color-mode=mode --codec=codec --quality=quality --filter-crops --hash-index=location --profile --profile-seconds=seconds --profile-memory=mb --dpi=dpi --memory-budget=mb --detector=name --triage --decode-reduction=factor --detection-profile=location --detection-cache=location --pack-pixels=pixels]
+    row_cli.py process fused --job=name --from=location --save-to=location --index=location --task-index=index --file-count=count --instances=size --project=number --processor=id [--upload-mosaics --color-mode=mode --codec=codec --quality=quality --filter-crops --hash-index=location --profile --profile-seconds=seconds --profile-memory=mb --dpi=dpi --memory-budget=mb --detector=name --triage --decode-reduction=factor --detection-profile=location --detection-cache=location --pack-pixels=pixels]
     row_cli.py process circles --job=name --from=location --save-to=location --index=location --task-index=index --file-count=count --instances=size --project=number --processor=id
     row_cli.py image convert <file_name> (--save-to=location)
-    row_cli.py detect circles <file_name> (--save-to=location) [--mosaic]
+    row_cli.py detect circles <file_name> (--save-to=location) [--mosaic --color-mode=mode --detector=name --triage --decode-reduction=factor --detection-profile=location]
+    row_cli.py mosaic benchmark <file_names>... [--project=number --processor=id]
+    row_cli.py mosaic merge --job=name --save-to=location --index=location [--codec=codec --quality=quality]
+    row_cli.py benchmark stages [--cases=cases --repeat=count --save-to=location --baseline=location]
+    row_cli.py benchmark imports [--repeat=count]
+    row_cli.py benchmark detectors [--cases=cases --repeat=count --detectors=names --labels=location]
+    row_cli.py benchmark triage [--cases=cases --repeat=count --detector=name]
+    row_cli.py benchmark decode [--cases=cases --repeat=count]
+    row_cli.py benchmark logging [--sink-latency=seconds --sample-rate=rate --repeat=count]
+    row_cli.py plan (--from=location --index=location) [--sample=count --target-hours=hours --save-to=location --color-mode=mode --codec=codec --quality=quality --filter-crops --dpi=dpi --memory-budget=mb --detector=name --triage --decode-reduction=factor --detection-profile=location --pack-pixels=pixels]
+    row_cli.py tune detection (--save-to=location) [--labels=location --cases=cases --detector=name --trials=count --workers=count --repeat=count]
+    row_cli.py benchmark service [--cases=cases --workers=count --requests=count --concurrency=counts --url=url]
+    row_cli.py serve [--port=port --workers=count --max-in-flight=count]
+    row_cli.py simulate (--workspace=location) [--files=count --tasks=counts --parallelism=count --storage-latency=seconds --ocr-latency=seconds --ocr-failure-rate=rate]
+    row_cli.py simulate queue (--workspace=location) [--files=count --tasks=counts --parallelism=count --storage-latency=seconds --ocr-latency=seconds --ocr-failure-rate=rate]
+    row_cli.py simulate download (--workspace=location) [--size=mb --storage-latency=seconds --slow-rate=rate --slow-latency=seconds]
+    row_cli.py queue fill <queue> (--index=location)
+    row_cli.py queue tiles <queue> <run_name> (--from=location) [--threshold=confidence]
+    row_cli.py queue status <queue>
     row_cli.py results download <run_name> (--from=location)
     row_cli.py results summarize <run_name> (--from=location)
+    row_cli.py results metrics <run_name> (--from=location) [--openmetrics]
+    row_cli.py results merge <run_name> (--from=location) [--save-to=location]
+    row_cli.py results index <run_name> (--from=location)
+    row_cli.py results lookup <run_name> <parcel> (--from=location)
 
 Options:
     --from=location                 The bucket or directory to operate on
     --task-index=index              The index of the task running
     --instances=size                The number of containers running the job [default: 10]
     --save-to=location              The location to output the stuff
+    --mosaics=location              The mosaics folder the processed index was generated from, gs://bucket-name/job/mosaics
+    --color-mode=mode               The mosaic color mode: color, gray or binary
+    --codec=codec                   The mosaic codec: jpg, png, tiff-lzw or tiff-ccitt
+    --quality=quality               The mosaic jpeg quality from 0 to 100
+    --filter-crops                  Drop circle crops without text before mosaicking
+    --pages=count                   The most pages in a page range work unit [default: 50]
+    --min-size=mb                   The smallest pdf or tiff in megabytes to split into page ranges [default: 20]
+    --cases=cases                   Comma separated benchmark cases as size:dpi:circles, eg letter:300:10,arch-d:150:40
+    --repeat=count                  The number of timed runs for each benchmark stage or import [default: 3]
+    --baseline=location             A benchmark results file to compare against
+    --detectors=names               Comma separated circle detectors to compare: hough, hough-alt or contour
+    --labels=location               A json file of image names and their [x, y, radius] circles to compare detectors on
+    --detector=name                 The circle detector: hough, hough-alt or contour
+    --triage                        Skip blank pages and only search the regions of a page with candidate circles
+    --decode-reduction=factor       Detect circles on a grayscale page decoded at 1/1, 1/2 or 1/4 of its size
+    --detection-profile=location    The file or bucket object of a detection profile from `tune detection` with the detector, dpi and parameters to use
+    --detection-cache=location      The directory or bucket caching the detections and crops of each page to rebuild mosaics from
+    --pack-pixels=pixels            Pack the crops of documents with few circles into shared mosaics of up to this many pixels
+    --threshold=confidence          The token confidence below which a tile is read again, defaults to 0.8
+    --upload-mosaics                Also upload the mosaics a fused run reads from memory
+    --sample=count                  The number of documents to render and detect when planning a run [default: 30]
+    --target-hours=hours            The hours the planned mosaic job should finish in [default: 1]
+    --trials=count                  The most detection parameter sets to try [default: 60]
+    --sink-latency=seconds          The seconds the stand in log sink waits for each call [default: 0.002]
+    --sample-rate=rate              The share of detail log records to keep, defaults to the production rate
+    --workspace=location            The directory for the simulated buckets. it is emptied first when the simulator created it
+    --files=count                   The number of synthetic files to simulate [default: 100]
+    --tasks=counts                  Comma separated task counts to simulate [default: 1,2,4,8]
+    --parallelism=count             The number of simulated tasks to run at once, defaults to the cpu count
+    --storage-latency=seconds       The simulated latency of every storage request [default: 0.05]
+    --ocr-latency=seconds           The simulated median ocr latency [default: 0.5]
+    --size=mb                       The megabytes of the simulated object to download [default: 256]
+    --slow-rate=rate                The simulated share of storage requests that are slow [default: 0.05]
+    --slow-latency=seconds          The seconds added to a slow storage request [default: 2]
+    --ocr-failure-rate=rate         The simulated share of ocr requests that fail [default: 0.01]
+    --openmetrics                   Print the metrics in the OpenMetrics text format instead of json
+    --port=port                     The port the detection service listens on [default: 8080]
+    --workers=count                 The number of detection or tuning worker processes, defaults to the cpu count
+    --max-in-flight=count           The requests handled or waiting for a worker at once, defaults to twice the workers
+    --requests=count                The number of requests sent at each concurrency [default: 40]
+    --concurrency=counts            Comma separated numbers of concurrent clients [default: 1,2,4]
+    --url=url                       The url of a running detection service to load instead of starting one
+    --hash-index=location           The directory or bucket holding the page hash index shared by the tasks
+    --profile                       Profile each object and save a report for the slow or memory hungry ones
+    --profile-seconds=seconds       The seconds an object must take to save its profile [default: 300]
+    --profile-memory=mb             The peak traced megabytes an object must use to save its profile [default: 2048]
+    --dpi=dpi                       The resolution to render pdf pages at. defaults to 300 or the detection profile's
+    --memory-budget=mb              The megabytes a pdf page may use before it is rendered at a lower resolution. defaults to half of the container memory limit
 Examples:
     python row_cli.py storage generate-index --from=./test-data --prefix=elephant/mosaics/ --save-to=./data
     python row_cli.py storage generate-remaining-index --full-index=./test-data --processed-index=./test-data --save-to=./data
+    python row_cli.py storage generate-remaining-index --full-index=gs://bucket-name --processed-index=gs://bucket-name --mosaics=gs://bucket-name/bobcat/mosaics
     python row_cli.py storage pick-range --from=.ephemeral --task-index=0 --instances=10 --file-count=100
+    python row_cli.py storage split-index --from=gs://bucket-name --index=gs://bucket-name --pages=50 --save-to=./data
     python row_cli.py image convert ./test-data/multiple_page.pdf --save-to=./test
     python row_cli.py detect circles ./test-data/five_circles_with_text.png --save-to=./test --mosaic
+    python row_cli.py mosaic benchmark ./test-data/five_circles_with_text.png ./test-data/multiple_page.pdf
     python row_cli.py process images --job=test --from=./test-data --save-to=./.ephemeral --index=./test-data --task-index=0 --file-count=1 --instances=1
     python row_cli.py process circles ---job=test --from=./test-data --save-to=./.ephemeral --index=./test-data --task-index=0 --file-count=1 --instances=1 --project=123456789 --processor=123456789
+    python row_cli.py process fused --job=test --from=./test-data --save-to=./.ephemeral --index=./test-data --task-index=0 --file-count=1 --instances=1 --project=123456789 --processor=123456789
+    python row_cli.py plan --from=gs://bucket-name --index=gs://bucket-name --sample=40 --target-hours=2 --save-to=./data/plan.json
+    python row_cli.py mosaic merge --job=bobcat --save-to=bucket-name --index=gs://bucket-name
+    python row_cli.py benchmark stages --save-to=./data/benchmark.json --baseline=./data/baseline.json
+    python row_cli.py benchmark imports --repeat=5
+    python row_cli.py benchmark detectors --detectors=hough,contour --labels=./data/labels.json
+    python row_cli.py benchmark triage --cases=letter:300:10,arch-d:150:40
+    python row_cli.py benchmark decode --cases=letter:300:10,tabloid:300:25
+    python row_cli.py benchmark logging --sink-latency=0.005 --sample-rate=0.05
+    python row_cli.py tune detection --labels=./data/labels.json --trials=100 --save-to=./data/detection-profile.json
+    python row_cli.py benchmark service --workers=4 --concurrency=1,4,8 --requests=100
+    python row_cli.py serve --port=8080 --workers=4
+    python row_cli.py simulate --workspace=./.ephemeral/simulation --files=200 --tasks=1,4,16 --ocr-latency=1.5
+    python row_cli.py simulate queue --workspace=./.ephemeral/simulation --files=200 --tasks=40 --parallelism=4
+    python row_cli.py simulate download --workspace=./.ephemeral/download --size=512 --slow-rate=0.1
+    python row_cli.py queue fill gs://bucket-name/queues/bobcat --index=gs://bucket-name
+    python row_cli.py queue tiles gs://bucket-name/queues/bobcat-tiles bobcat --from=bucket-name --threshold=0.7
+    python row_cli.py queue status ./.ephemeral/bobcat.sqlite
     python row_cli.py results download bobcat --from=bucket-name
+    python row_cli.py results metrics bobcat --from=bucket-name --openmetrics
+    python row_cli.py results merge bobcat --from=./data
+    python row_cli.py results index bobcat-merged --from=./data
+    python row_cli.py results lookup bobcat 0015:E --from=./data
 """
+# pylint: disable=import-outside-toplevel
 
+import json
 import logging
 from pathlib import Path
 from sys import stdout
+from tempfile import TemporaryDirectory
+from time import perf_counter
 from types import SimpleNamespace
 
 from docopt import docopt
 
 import row
+import row_metrics
 
 logging.basicConfig(
     stream=stdout,
@@ -62,7 +164,7 @@ def main():
 
     if args["storage"] and args["generate-remaining-index"]:
         remaining_index = row.generate_remaining_index(
-            args["--full-index"], args["--processed-index"], args["--save-to"]
+            args["--full-index"], args["--processed-index"], args["--save-to"], args["--mosaics"]
         )
         print(remaining_index)
         print(f"remaining job size: {len(remaining_index)}")
@@ -76,13 +178,15 @@ def main():
         return
 
     if args["image"] and args["convert"]:
+        import row_render
+
         pdf = Path(args["<file_name>"])
         if not pdf.exists():
             print("file does not exist")
 
             return
 
-        images, count, messages = row.convert_pdf_to_jpg_bytes(pdf.read_bytes(), "cli")
+        images, count, messages = row_render.convert_pdf_to_jpg_bytes(pdf.read_bytes(), "cli")
         print(f"{pdf.name} contained {count} pages and converted with message {messages}")
 
         if args["--save-to"]:
@@ -94,13 +198,16 @@ def main():
 
                 return
 
-            for index, image in enumerate(images):
-                path = Path(directory / f"{pdf.stem}_{index+1}.jpg")
+            for page, image in images:
+                path = Path(directory / f"{pdf.stem}_{page}.jpg")
                 path.write_bytes(image)
 
         return
 
     if args["detect"] and args["circles"]:
+        import row_mosaic
+        import row_pack
+
         output_directory = None
         if args["--save-to"]:
             output_directory = Path(args["--save-to"])
@@ -117,17 +224,515 @@ def main():
 
             return
 
-        circles = row.get_circles_from_image_bytes(item_path.read_bytes(), output_directory, item_path.name)
+        options = row_mosaic.get_mosaic_options(
+            detector=args["--detector"],
+            triage=args["--triage"],
+            decode_reduction=args["--decode-reduction"],
+            detection_profile=args["--detection-profile"],
+        )
+
+        circles = row_mosaic.get_circles_from_image_bytes(
+            item_path.read_bytes(),
+            output_directory,
+            item_path.name,
+            detector=options.detector,
+            triage=options.triage,
+            decode_reduction=options.decode_reduction,
+            parameters=options.detection_parameters,
+        )
 
         if args["--mosaic"]:
-            row.build_mosaic_image(circles, item_path.name, output_directory)
+            row_pack.build_mosaic_image(circles, item_path.name, output_directory, args["--color-mode"] or "color")
 
             return
 
         return circles
 
-    if args["process"] and args["images"]:
-        return row.mosaic_all_circles(
+    if args["mosaic"] and args["benchmark"]:
+        import row_mosaic
+        import row_pack
+        import row_render
+
+        ocr = None
+        if args["--project"] and args["--processor"]:
+            import row_ocr
+
+            ocr = row_ocr.get_ocr_text_function(int(args["--project"]), args["--processor"])
+
+        for file_name in args["<file_names>"]:
+            item_path = Path(file_name)
+
+            if not item_path.exists():
+                print(f"{file_name} does not exist")
+
+                continue
+
+            if item_path.suffix.casefold() == ".pdf":
+                images, _, _ = row_render.convert_pdf_to_jpg_bytes(item_path.read_bytes(), item_path.name)
+            elif item_path.suffix.casefold() in [".tif", ".tiff"]:
+                images, _, _ = row_render.convert_tiff_to_images(item_path.read_bytes(), item_path.name)
+            else:
+                images = [(1, item_path.read_bytes())]
+
+            circles = []
+            for _, image in images:
+                circles.extend(row_mosaic.get_circles_from_image_bytes(image, None, item_path.name))
+
+            for result in row_pack.benchmark_mosaic_encodings(circles, item_path.name, ocr):
+                print(
+                    f'{result["file"]} {result["color mode"]:>6} {result["codec"]:>10} q{result["quality"] or "-":<3} '
+                    f'{result["bytes"]:>10,} bytes {row.format_time(result["encode seconds"]):>8} encode'
+                    + (f' {result["agreement"]:.1%} text agreement' if "agreement" in result else "")
+                )
+
+        return
+
+    if args["benchmark"] and args["stages"]:
+        import row_bench
+
+        cases = row_bench.parse_cases(args["--cases"]) if args["--cases"] else None
+
+        results = row_bench.run_benchmarks(cases, int(args["--repeat"]))
+
+        for case in results["cases"]:
+            timings = ", ".join(
+                f"{stage} {row.format_time(measurement['min seconds'])} {measurement['peak bytes'] / 1e6:.1f} MB"
+                for stage, measurement in case["stages"].items()
+            )
+            print(f'{case["case"]} recall {case["detection"]["recall"]:.1%}: {timings}')
+
+        if args["--save-to"]:
+            print(f'results saved to {row_bench.save_benchmarks(results, args["--save-to"])}')
+
+        if args["--baseline"]:
+            baseline = json.loads(Path(args["--baseline"]).read_text(encoding="utf-8"))
+            regressions = row_bench.compare_benchmarks(results, baseline)
+
+            for regression in regressions:
+                print(f"regression: {regression}")
+
+            if regressions:
+                raise SystemExit(1)
+
+            print("no regressions against the baseline")
+
+        return
+
+    if args["benchmark"] and args["detectors"]:
+        import row_bench
+
+        cases = row_bench.parse_cases(args["--cases"]) if args["--cases"] else None
+
+        results = row_bench.compare_detectors(
+            cases,
+            args["--detectors"].split(",") if args["--detectors"] else None,
+            int(args["--repeat"]),
+            row_bench.load_labeled_pages(args["--labels"]) if args["--labels"] else None,
+        )
+
+        for detector, total in results["detectors"].items():
+            print(
+                f'{detector:>10}: {row.format_time(total["seconds"]):>8} '
+                f'recall {total["recall"]:.1%} precision {total["precision"]:.1%}'
+            )
+
+        return
+
+    if args["benchmark"] and args["triage"]:
+        import row_bench
+
+        cases = row_bench.parse_cases(args["--cases"]) if args["--cases"] else None
+
+        results = row_bench.measure_triage(cases, detector=args["--detector"] or "hough", repeat=int(args["--repeat"]))
+
+        for name, total in results["totals"].items():
+            print(
+                f'{name:>14}: {row.format_time(total["seconds"]):>8} for {total["pages"]} pages, '
+                f'skip rate {total["skip rate"]:.1%} recall {total["recall"]:.1%}'
+            )
+
+        return
+
+    if args["benchmark"] and args["decode"]:
+        import row_bench
+
+        cases = row_bench.parse_cases(args["--cases"]) if args["--cases"] else None
+
+        results = row_bench.measure_decoding(cases, repeat=int(args["--repeat"]))
+
+        for mode, total in results["totals"].items():
+            print(
+                f'{mode:>9}: {row.format_time(total["seconds"]):>8} '
+                f'peak {total["peak bytes"] / 1024 / 1024:.1f} MB recall {total["recall"]:.1%}'
+            )
+
+        return
+
+    if args["benchmark"] and args["logging"]:
+        import row_bench
+
+        results = row_bench.measure_logging(
+            latency=float(args["--sink-latency"]),
+            sample_rate=float(args["--sample-rate"]) if args["--sample-rate"] else None,
+            repeat=int(args["--repeat"]),
+        )
+
+        for mode, result in results.items():
+            print(
+                f'{mode:>8}: {row.format_time(result["seconds"]):>8}, overhead {row.format_time(result["overhead seconds"])}, '
+                f'{result["records"]} records in {result["sink calls"]} sink calls'
+            )
+
+        return
+
+    if args["plan"]:
+        import row_mosaic
+        import row_plan
+
+        options = row_mosaic.get_mosaic_options(
+            color_mode=args["--color-mode"],
+            codec=args["--codec"],
+            quality=args["--quality"],
+            filter_crops=args["--filter-crops"],
+            dpi=args["--dpi"],
+            memory_budget_mb=args["--memory-budget"],
+            detector=args["--detector"],
+            triage=args["--triage"],
+            decode_reduction=args["--decode-reduction"],
+            detection_profile=args["--detection-profile"],
+            pack_pixels=args["--pack-pixels"],
+        )
+        entries = row.get_index(args["--index"]).read_text(encoding="utf-8").splitlines()
+
+        report = row_plan.plan_run(
+            args["--from"], entries, options, int(args["--sample"]), float(args["--target-hours"]) * 3600
+        )
+        totals = report["totals"]
+        recommendation = report["recommendation"]
+
+        for stratum in report["strata"]:
+            print(
+                f'{stratum["type"]:>10} {stratum["size"]:>8}: {stratum["entries"]} entries, {stratum["sampled"]} '
+                f'sampled, {row.format_time(stratum["seconds"])}, {stratum["ocr requests"]:.0f} ocr requests'
+            )
+
+        print(
+            f'TOTAL_FILES={report["total files"]}: {row.format_time(totals["seconds"])} of rendering and detection, '
+            f'{totals["cpu seconds"] / 3600:.1f} cpu hours, {totals["pages"]:.0f} pages, '
+            f'{totals["mosaic bytes"] / 1024**3:.2f}GiB of mosaics, {totals["ocr requests"]:.0f} ocr requests, '
+            f'{totals["peak rss bytes"] / 1024**2:.0f}MiB peak memory'
+        )
+        print(
+            f'recommended: {recommendation["tasks"]} tasks with {recommendation["cpus"]} cpu and '
+            f'{recommendation["memory"]} memory finishing in {row.format_time(recommendation["task seconds"])} '
+            f'for about ${recommendation["mosaic cost usd"]:.2f} of mosaic tasks and '
+            f'${recommendation["ocr cost usd"]:.2f} of ocr'
+        )
+
+        for warning in recommendation["warnings"]:
+            print(f"warning: {warning}")
+
+        if args["--save-to"]:
+            Path(args["--save-to"]).parent.mkdir(parents=True, exist_ok=True)
+            Path(args["--save-to"]).write_text(json.dumps(report, indent=2), encoding="utf-8")
+
+        return
+
+    if args["tune"] and args["detection"]:
+        import row_bench
+        import row_tune
+
+        pages = []
+        if args["--labels"]:
+            pages = row_bench.load_labeled_pages(args["--labels"])
+        else:
+            cases = row_bench.parse_cases(args["--cases"]) if args["--cases"] else row_bench.DEFAULT_CASES
+
+            #: the synthetic pages are drawn at the sample resolution so the lower resolutions can be searched
+            for size, _, circles in cases:
+                page, labels = row_bench.generate_synthetic_page(size, row_tune.SAMPLE_DPI, circles)
+                pages.append((f"{size}-{circles}", page, labels))
+
+        results = row_tune.tune_detection(
+            pages,
+            args["--detector"] or "hough",
+            int(args["--trials"]),
+            int(args["--workers"]) if args["--workers"] else None,
+            int(args["--repeat"]),
+        )
+
+        for result in results["front"]:
+            marker = "*" if result is results["chosen"] else " "
+            print(
+                f'{marker} {row.format_time(result["seconds"]):>8} recall {result["recall"]:.1%} '
+                f'precision {result["precision"]:.1%} dpi {result["dpi"]} blur {result["blur"]} '
+                f'param1 {result["param1"]} param2 {result["param2"]} first range {result["multipliers"][-1]}'
+            )
+
+        default = results["default"]
+        print(
+            f'  default {row.format_time(default["seconds"])} recall {default["recall"]:.1%} '
+            f'precision {default["precision"]:.1%}'
+        )
+
+        row_tune.save_profile(results["profile"], args["--save-to"])
+
+        return
+
+    if args["benchmark"] and args["service"]:
+        import cv2
+
+        import row_bench
+        import row_service
+
+        cases = [("letter", 150, 10), ("tabloid", 200, 20)]
+        if args["--cases"]:
+            cases = row_bench.parse_cases(args["--cases"])
+
+        payloads = []
+        for size, dpi, circles in cases:
+            page, _ = row_bench.generate_synthetic_page(size, dpi, circles)
+            payloads.append((f"{size}-{dpi}dpi-{circles}.jpg", cv2.imencode(".jpg", page)[1].tobytes()))
+
+        with TemporaryDirectory() as folder:
+            sample = Path(folder) / payloads[0][0]
+            sample.write_bytes(payloads[0][1])
+            cold = row_service.measure_cold_detection(sample)
+
+        print(f'   cold cli: p50 {row.format_time(cold["latency p50"]):>8} for one {payloads[0][0]} lookup')
+
+        results = row_service.benchmark_service(
+            payloads,
+            int(args["--workers"]) if args["--workers"] else None,
+            int(args["--requests"]),
+            [int(concurrency) for concurrency in args["--concurrency"].split(",")],
+            url=args["--url"],
+        )
+
+        for result in results:
+            print(
+                f'{result["concurrency"]:>3} clients: p50 {row.format_time(result["latency p50"]):>8} '
+                f'p90 {row.format_time(result["latency p90"]):>8} p99 {row.format_time(result["latency p99"]):>8} '
+                f'{result["requests per second"]:.2f} requests/s {result["statuses"]}'
+            )
+
+        return
+
+    if args["serve"]:
+        import row_service
+
+        server = row_service.create_server(
+            int(args["--port"]),
+            int(args["--workers"]) if args["--workers"] else None,
+            int(args["--max-in-flight"]) if args["--max-in-flight"] else None,
+        )
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            server.service.close()
+
+        return
+
+    if args["benchmark"] and args["imports"]:
+        import row_bench
+
+        for case, result in row_bench.measure_imports(repeat=int(args["--repeat"])).items():
+            print(
+                f'{case:>8}: {row.format_time(result["min seconds"]):>8} to import {", ".join(result["modules"])} '
+                f'loading {", ".join(result["libraries"]) or "no heavy libraries"}'
+            )
+
+        return
+
+    if args["simulate"] and args["queue"]:
+        import row_sim
+
+        report = row_sim.compare_worker_modes(
+            args["--workspace"],
+            file_count=int(args["--files"]),
+            task_count=int(args["--tasks"].split(",")[-1]),
+            parallelism=int(args["--parallelism"]) if args["--parallelism"] else None,
+            storage_latency=float(args["--storage-latency"]),
+            ocr_settings={
+                "latency": float(args["--ocr-latency"]),
+                "failure_rate": float(args["--ocr-failure-rate"]),
+            },
+        )
+
+        for mode in ("tasks", "queue"):
+            print(
+                f'{mode:>5}: {report[mode]["processes"]:>4} processes, '
+                f'makespan {row.format_time(report[mode]["makespan seconds"])}, '
+                f'{report[mode]["files per second"]:.2f} files/s'
+            )
+
+        print(f'the queue workers are {report["speed up"]:.2f}x the throughput of a process per task')
+
+        return
+
+    if args["simulate"] and args["download"]:
+        import row_sim
+
+        report = row_sim.compare_downloads(
+            args["--workspace"],
+            size_mb=int(args["--size"]),
+            latency=float(args["--storage-latency"]),
+            slow_rate=float(args["--slow-rate"]),
+            slow_latency=float(args["--slow-latency"]),
+        )
+
+        for mode in ("single", "ranged"):
+            print(
+                f'{mode:>6}: {report[mode]["MB/s"]:.1f} MB/s, slowest {row.format_time(max(report[mode]["seconds"]))}, '
+                f'{report[mode]["hedges"]} hedges'
+            )
+
+        print(f'the ranged downloads are {report["speed up"]:.2f}x faster than a single stream')
+
+        return
+
+    if args["queue"] and args["fill"]:
+        queue = row.get_work_queue(args["<queue>"])
+        files = [name for name in row.get_index(args["--index"]).read_text(encoding="utf-8").splitlines() if name]
+
+        print(f"added {queue.add(files)} of {len(files)} files to the queue")
+        queue.close()
+
+        return
+
+    if args["queue"] and args["tiles"]:
+        import row_ocr
+
+        tokens = row_ocr.load_tokens(args["--from"], args["<run_name>"])
+        tiles = row_ocr.select_low_confidence_tiles(
+            tokens, float(args["--threshold"]) if args["--threshold"] else row_ocr.LOW_CONFIDENCE
+        )
+        queue = row.get_work_queue(args["<queue>"])
+
+        print(f"added {queue.add(tiles)} low confidence tiles to the queue")
+        queue.close()
+
+        return
+
+    if args["queue"] and args["status"]:
+        queue = row.get_work_queue(args["<queue>"])
+
+        print(queue.counts())
+        queue.close()
+
+        return
+
+    if args["simulate"]:
+        import row_sim
+
+        reports = row_sim.simulate(
+            args["--workspace"],
+            file_count=int(args["--files"]),
+            task_counts=[int(count) for count in args["--tasks"].split(",")],
+            parallelism=int(args["--parallelism"]) if args["--parallelism"] else None,
+            storage_latency=float(args["--storage-latency"]),
+            ocr_settings={
+                "latency": float(args["--ocr-latency"]),
+                "failure_rate": float(args["--ocr-failure-rate"]),
+            },
+        )
+
+        for report in reports:
+            print(
+                f'{report["tasks"]:>4} tasks: makespan {row.format_time(report["makespan seconds"])}, '
+                f'{report["files per second"]:.2f} files/s, '
+                f'mosaic p50/p90/max {report["mosaic"]["task seconds p50"]:.1f}/'
+                f'{report["mosaic"]["task seconds p90"]:.1f}/{report["mosaic"]["task seconds max"]:.1f}s '
+                f'(straggler ratio {report["mosaic"]["straggler ratio"]:.2f}), '
+                f'ocr makespan {row.format_time(report["ocr"]["makespan seconds"])} '
+                f'with {report["ocr"]["failures"]} failures'
+            )
+
+        return
+
+    if args["storage"] and args["split-index"]:
+        import row_mosaic
+
+        entries = row.get_index(args["--index"]).read_text(encoding="utf-8").splitlines()
+        units = row_mosaic.split_index_by_pages(
+            row.get_storage_client().bucket(args["--from"][5:]),
+            entries,
+            int(args["--pages"]),
+            float(args["--min-size"]) * 1024 * 1024,
+        )
+
+        if args["--save-to"]:
+            row.save_index(units, args["--save-to"])
+
+        print(f"split {len([entry for entry in entries if entry.strip()])} files into {len(units)} work units")
+
+        return
+
+    if args["mosaic"] and args["merge"]:
+        import row_merge
+
+        entries = row.get_index(args["--index"]).read_text(encoding="utf-8").splitlines()
+        summary = row_merge.merge_partial_mosaics(
+            args["--job"], args["--save-to"], entries, args["--codec"] or "jpg", int(args["--quality"] or 95)
+        )
+
+        print(
+            f'merged {summary["partials"]} partial mosaics into {summary["merged"]} documents, '
+            f'{summary["kept"]} documents kept their partial mosaics and {summary["incomplete"]} have unfinished '
+            "page ranges"
+        )
+
+        return
+
+    if args["process"] and (args["images"] or args["fused"]):
+        import row_mosaic
+
+        options = row_mosaic.get_mosaic_options(
+            color_mode=args["--color-mode"],
+            codec=args["--codec"],
+            quality=args["--quality"],
+            filter_crops=args["--filter-crops"],
+            hash_index=args["--hash-index"],
+            profile=args["--profile"],
+            profile_seconds=args["--profile-seconds"],
+            profile_memory_mb=args["--profile-memory"],
+            dpi=args["--dpi"],
+            memory_budget_mb=args["--memory-budget"],
+            detector=args["--detector"],
+            triage=args["--triage"],
+            decode_reduction=args["--decode-reduction"],
+            detection_profile=args["--detection-profile"],
+            detection_cache=args["--detection-cache"],
+            pack_pixels=args["--pack-pixels"],
+        )
+
+        if args["fused"]:
+            import row_fused
+
+            inputs = SimpleNamespace(
+                job_name=args["--job"],
+                input_bucket=args["--from"],
+                output_location=args["--save-to"],
+                file_index=args["--index"],
+                task_index=int(args["--task-index"]),
+                task_count=int(args["--instances"]),
+                total_size=int(args["--file-count"]),
+                project_number=int(args["--project"]),
+                processor_id=args["--processor"],
+                upload_mosaics=args["--upload-mosaics"],
+            )
+
+            results = row_fused.fuse_all_objects(inputs, options)
+
+            print(f"read {len(results)} rows")
+
+            return
+
+        return row_mosaic.mosaic_all_circles(
             args["--job"],
             args["--from"],
             args["--save-to"],
@@ -135,9 +740,12 @@ def main():
             int(args["--task-index"]),
             int(args["--instances"]),
             int(args["--file-count"]),
+            options,
         )
 
     if args["process"] and args["circles"]:
+        import row_ocr
+
         inputs = SimpleNamespace(
             job_name=args["--job"],
             input_bucket=args["--from"],
@@ -150,7 +758,7 @@ def main():
             processor_id=args["--processor"],
         )
 
-        results = row.ocr_all_mosaics(inputs)
+        results = row_ocr.ocr_all_mosaics(inputs)
 
         print(f"operation finished with status {results}")
 
@@ -164,6 +772,61 @@ def main():
     if args["results"] and args["summarize"]:
         row.summarize_run(args["--from"], args["<run_name>"])
 
+    if args["results"] and args["metrics"]:
+        records = row.download_metrics(args["--from"], args["<run_name>"])
+
+        for job_type in sorted({record["labels"].get("job_type") for record in records}):
+            merged = row_metrics.merge_records(
+                [record for record in records if record["labels"].get("job_type") == job_type],
+                job=args["<run_name>"],
+                job_type=job_type,
+            )
+
+            if args["--openmetrics"]:
+                print(row_metrics.to_openmetrics(merged), end="")
+            else:
+                print(json.dumps(merged, indent=2))
+
+    if args["results"] and args["merge"]:
+        import row_ocr
+
+        output = (
+            Path(args["--save-to"]) / args["<run_name>"]
+            if args["--save-to"]
+            else Path(args["--from"]) / f'{args["<run_name>"]}-merged'
+        )
+        summary = row_ocr.merge_run_results(Path(args["--from"]) / args["<run_name>"], output)
+
+        print(f'merged {summary["rows"]:,} results into {summary["documents"]:,} documents in {summary["file"]}')
+
+        return
+
+    if args["results"] and args["index"]:
+        import row_parcels
+
+        manifest = row_parcels.build_parcel_index(Path(args["--from"]) / args["<run_name>"])
+
+        print(
+            f'indexed {manifest["parcels"]:,} parcel numbers in {manifest["documents"]:,} results from '
+            f'{len(manifest["files"])} files in {row.format_time(manifest["seconds"])}'
+        )
+
+        return
+
+    if args["results"] and args["lookup"]:
+        import row_parcels
+
+        start = perf_counter()
+        index = row_parcels.ParcelIndex(Path(args["--from"]) / args["<run_name>"] / row_parcels.INDEX_FOLDER)
+        mentions = index.lookup(args["<parcel>"])
+
+        for mention in mentions:
+            print(f'{mention["file_name"]} ({mention["file"]} row {mention["row"]})')
+
+        print(f'{len(mentions)} results mention {args["<parcel>"]}, found in {row.format_time(perf_counter() - start)}')
+
+        return
+
     if args["index"] and args["filter"]:
         index = Path(args["<file_name>"])
         total_lines = 0
@@ -175,7 +838,7 @@ def main():
             for line in index_file:
                 total_lines += 1
 
-                item = Path(line.strip())
+                item = Path(row.parse_work_unit(line)[0])
 
                 if "deed" in line.casefold() or item.suffix.casefold().casefold() not in (
                     ".pdf",
@@ -0,0 +1,510 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+"""
+UDOT Right of Way (ROW) Parcel Number Extraction
+The circle detectors. each page is searched with a series of radius ranges, optionally only in the regions
+where a cheap triage pass finds candidate circles
+"""
+
+import hashlib
+import json
+import logging
+import math
+from functools import partial
+
+import cv2
+import numpy as np
+
+import row_logging
+from row_metrics import METRICS
+
+#: the per page and per pass records. they are sampled in production runs
+DETAIL_LOG = logging.getLogger(row_logging.DETAIL_LOGGER)
+
+#: the radius ranges searched for circles as a share of the page height and a fudge in pixels. the last range is
+#: searched first and the others are tried in reverse order until a reasonable number of circles are found. original
+#: multiplier of 0.01, bigger seems to work better (0.025)
+RADIUS_MULTIPLIERS = [
+    [0.010, 12],
+    [0.035, 12],
+    [0.015, 12],
+    [0.0325, 12],
+    [0.0175, 12],
+    [0.025, 10],
+]
+
+#: the tunable circle detection settings. the blur kernel size, the hough edge (param1) and accumulator (param2)
+#: thresholds, the radius ranges, the inset as a share of the largest radius and the most circles a range may find
+#: before the next range is tried. param1 and param2 only apply to the hough detector. `row_tune` searches them and
+#: writes a profile that `row_mosaic.load_detection_profile` reads
+DETECTION_PARAMETERS = {
+    "blur": 5,
+    "param1": 50,
+    "param2": 50,
+    "multipliers": RADIUS_MULTIPLIERS,
+    "inset_ratio": 0.1,
+    "max_circles": 100,
+}
+
+#: the version of the detection code. bump it when a change moves the circles found on a page so cached detections
+#: from older versions are not reused
+DETECTOR_VERSION = 1
+
+#: page triage settings. pages are downsampled until the smallest radius searched is the triage radius and split into
+#: tiles. tiles need ink edges in the minimum number of the 8 orientation bins to take part in the coarse hough vote
+#: that locates candidate circles. candidates surrounded by more ink than the maximum share, like letters in a block
+#: of text, are dropped. pages with less ink than the minimum share are blank
+TRIAGE_RADIUS = 8
+TRIAGE_TILE = 16
+TRIAGE_MIN_ORIENTATIONS = 4
+TRIAGE_MIN_INK = 0.001
+TRIAGE_MAX_SURROUNDING_INK = 0.18
+TRIAGE_VOTES = 14
+
+#: the share of its enclosing circle a contour must fill and the ratio of its ellipse axes to be detected as a circle
+CONTOUR_MIN_FILL = 0.8
+CONTOUR_MIN_ROUNDNESS = 0.85
+
+
+def get_parameters_key(parameters):
+    """a short stable name for a set of detection parameters
+
+    Args:
+        parameters (dict): the detection parameters or None for the defaults
+
+    Returns:
+        str: an empty string for the defaults or a hash of the parameters
+    """
+    parameters = {**DETECTION_PARAMETERS, **(parameters or {})}
+
+    if parameters == DETECTION_PARAMETERS:
+        return ""
+
+    return hashlib.sha1(json.dumps(parameters, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+
+
+def detect_circles(img, detector="hough", triage=False, parameters=None):
+    """run the circle detector with a series of radius ranges until a reasonable number of circles are found
+
+    Args:
+        img (np.ndarray): the 3 band or grayscale image to detect circles in
+        detector (str): one of the `CIRCLE_DETECTORS`
+        triage (bool): skip pages without candidate circles and only search the regions with them
+        parameters (dict): the detection parameters to override. defaults to the `DETECTION_PARAMETERS`
+
+    Returns:
+        tuple(np.ndarray, int): the circles from cv2.HoughCircles (or None) and the inset distance in pixels
+    """
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+    #: to calculate circle radius, get input image size
+    [height, width] = img.shape[:2]
+
+    parameters = {**DETECTION_PARAMETERS, **(parameters or {})}
+    multipliers = parameters["multipliers"]
+    gray_blur = cv2.blur(gray, (parameters["blur"], parameters["blur"]))
+    create_detector = partial(CIRCLE_DETECTORS[detector], parameters=parameters)
+
+    if triage:
+        find_circles = TriageSearch(create_detector, gray, gray_blur)
+    else:
+        find_circles = create_detector(gray_blur)
+
+    i = 0
+    count_down = len(multipliers)
+    circle_count = 0
+    detected_circles = None
+    inset = 0
+
+    while (circle_count > parameters["max_circles"] or circle_count == 0) and count_down > 0:
+        i += 1
+
+        [ratio_multiplier, fudge_value] = multipliers[count_down - 1]
+
+        min_rad, max_rad = get_radius_range(height, ratio_multiplier, fudge_value)
+
+        #: original inset multiplier of 0.075, bigger seems to work better (0.1)
+        inset = int(parameters["inset_ratio"] * max_rad)
+
+        detected_circles = find_circles(min_rad, max_rad)
+
+        if detected_circles is None:
+            circle_count = 0
+        else:
+            circle_count = len(detected_circles[0])
+
+        DETAIL_LOG.info(
+            "run: %i found %i circles %s",
+            i,
+            circle_count,
+            {
+                "detector": detector,
+                "multiplier": ratio_multiplier,
+                "fudge": fudge_value,
+                "diameter": f"{min_rad}-{max_rad}",
+                "inset": inset,
+                "dimensions": f"{height}x{width}",
+            },
+        )
+
+        count_down -= 1
+
+    DETAIL_LOG.info("final circles count: %i", circle_count)
+
+    if triage:
+        METRICS.increment("pages_triaged")
+
+        if find_circles.searched == 0:
+            METRICS.increment("pages_triage_skipped")
+
+        DETAIL_LOG.info(
+            "triage summary: %s",
+            {"skipped": find_circles.searched == 0, "share searched": round(find_circles.searched / gray.size, 3)},
+        )
+
+    return detected_circles, inset
+
+
+def get_radius_range(height, ratio_multiplier, fudge_value):
+    """get the smallest and largest circle radius to search for on a page
+
+    Args:
+        height (int): the page height in pixels
+        ratio_multiplier (float): the expected radius as a share of the page height
+        fudge_value (int): the pixels to search on either side of the expected radius
+
+    Returns:
+        tuple(int, int): the minimum and maximum radius in pixels
+    """
+    min_rad = max(math.ceil(ratio_multiplier * height) - fudge_value, 15)
+    max_rad = max(math.ceil(ratio_multiplier * height) + fudge_value, 30)
+
+    return min_rad, max_rad
+
+
+def triage_page(gray, min_rad, max_rad):
+    """find the regions of a page that plausibly contain circles of a radius range using a downsampled copy. blank
+    pages are skipped with the ink density. tiles whose edges only run in a few directions, like line work, are left
+    out and a coarse hough vote over the rest locates the candidate circles
+
+    Args:
+        gray (np.ndarray): the single band page
+        min_rad (int): the smallest radius searched for
+        max_rad (int): the largest radius searched for
+
+    Returns:
+        list(tuple): (left, top, right, bottom) regions of the page to search. empty when there are no candidates
+    """
+    height, width = gray.shape
+    scale = min(TRIAGE_RADIUS / min_rad, 1)
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    ink = small < 200
+
+    if ink.mean() < TRIAGE_MIN_INK:
+        return []
+
+    #: the magnitude weighted histogram of edge orientations in each tile
+    gradient_x = cv2.Sobel(small, cv2.CV_32F, 1, 0, ksize=3)
+    gradient_y = cv2.Sobel(small, cv2.CV_32F, 0, 1, ksize=3)
+    magnitude = cv2.magnitude(gradient_x, gradient_y)
+    orientation = np.minimum(np.arctan2(gradient_y, gradient_x) % np.pi / np.pi * 8, 7).astype(np.uint8)
+
+    tile = TRIAGE_TILE
+    rows, columns = math.ceil(small.shape[0] / tile), math.ceil(small.shape[1] / tile)
+    padding = ((0, rows * tile - small.shape[0]), (0, columns * tile - small.shape[1]))
+    magnitude = np.pad(magnitude, padding).reshape(rows, tile, columns, tile)
+    orientation = np.pad(orientation, padding).reshape(rows, tile, columns, tile)
+
+    histogram = np.stack([(magnitude * (orientation == i)).sum(axis=(1, 3)) for i in range(8)], axis=-1)
+    total = histogram.sum(axis=-1)
+    orientations = (histogram >= 0.05 * total[..., np.newaxis]).sum(axis=-1)
+
+    curved = ((orientations >= TRIAGE_MIN_ORIENTATIONS) & (total > 0)).astype(np.uint8)
+
+    if not curved.any():
+        return []
+
+    curved = cv2.dilate(curved, np.ones((3, 3), dtype=np.uint8))
+    mask = np.kron(curved, np.ones((tile, tile), dtype=np.uint8))[: small.shape[0], : small.shape[1]]
+    small[mask == 0] = 255
+
+    candidates = cv2.HoughCircles(
+        small,
+        cv2.HOUGH_GRADIENT,
+        dp=1,
+        minDist=max(int(min_rad * scale), 1),
+        param1=60,
+        param2=TRIAGE_VOTES,
+        minRadius=max(int(min_rad * scale) - 1, 1),
+        maxRadius=math.ceil(max_rad * scale) + 1,
+    )
+
+    if candidates is None:
+        return []
+
+    #: parcel circles sit in open space crossed by a few lines. letters sit in lines of text
+    candidates = [
+        (x, y) for x, y, radius in candidates[0] if get_surrounding_ink(ink, x, y, radius) <= TRIAGE_MAX_SURROUNDING_INK
+    ]
+
+    if not candidates:
+        return []
+
+    #: search a window around each candidate that fits the largest circle of the range
+    margin = max_rad + 20
+    regions = merge_regions(
+        (
+            max(int(x / scale) - margin, 0),
+            max(int(y / scale) - margin, 0),
+            min(int(x / scale) + margin, width),
+            min(int(y / scale) + margin, height),
+        )
+        for x, y in candidates
+    )
+
+    #: searching most of the page in pieces is slower than searching the page
+    if sum((right - left) * (bottom - top) for left, top, right, bottom in regions) > 0.6 * height * width:
+        return [(0, 0, width, height)]
+
+    return regions
+
+
+def get_surrounding_ink(ink, x, y, radius):
+    """get the share of ink in the ring from 1.4 to 2.2 times the radius around a candidate circle
+
+    Args:
+        ink (np.ndarray): the boolean ink map
+        x (float): the candidate center column
+        y (float): the candidate center row
+        radius (float): the candidate radius
+
+    Returns:
+        float: the share of the ring that is ink
+    """
+    top, left = max(int(y - 2.2 * radius), 0), max(int(x - 2.2 * radius), 0)
+    window = ink[top : int(y + 2.2 * radius) + 1, left : int(x + 2.2 * radius) + 1]
+
+    rows, columns = np.ogrid[top : top + window.shape[0], left : left + window.shape[1]]
+    distance = np.hypot(columns - x, rows - y)
+    ring = (distance >= 1.4 * radius) & (distance <= 2.2 * radius)
+
+    if not ring.any():
+        return 0.0
+
+    return float(window[ring].mean())
+
+
+def merge_regions(regions):
+    """merge overlapping regions until none of them overlap
+
+    Args:
+        regions (iterable): (left, top, right, bottom) regions
+
+    Returns:
+        list(tuple): the merged regions
+    """
+    merged = []
+
+    for region in regions:
+        left, top, right, bottom = region
+        overlapping = True
+
+        while overlapping:
+            overlapping = False
+
+            for other in merged:
+                if left < other[2] and other[0] < right and top < other[3] and other[1] < bottom:
+                    merged.remove(other)
+                    left, top = min(left, other[0]), min(top, other[1])
+                    right, bottom = max(right, other[2]), max(bottom, other[3])
+                    overlapping = True
+
+                    break
+
+        merged.append((left, top, right, bottom))
+
+    return merged
+
+
+def restrict_detector(detector, gray_blur, regions):
+    """search only the regions of a page with a detector
+
+    Args:
+        detector (callable): one of the `CIRCLE_DETECTORS`
+        gray_blur (np.ndarray): the blurred single band page
+        regions (list): (left, top, right, bottom) regions to search
+
+    Returns:
+        callable: a function taking the minimum and maximum radius and returning the circles in page coordinates or
+                  None
+    """
+    finders = [(left, top, detector(gray_blur[top:bottom, left:right])) for left, top, right, bottom in regions]
+
+    def find_circles(min_rad, max_rad):
+        found = []
+
+        for left, top, find in finders:
+            circles = find(min_rad, max_rad)
+
+            if circles is not None:
+                found.append(circles[0] + np.array([left, top, 0], dtype=np.float32))
+
+        if not found:
+            return None
+
+        return np.concatenate(found)[np.newaxis]
+
+    return find_circles
+
+
+class TriageSearch:
+    """search each radius range only in the regions of the page where triage finds candidate circles. `searched` is
+    the number of page pixels handed to the detector, 0 when every range was skipped
+    """
+
+    def __init__(self, detector, gray, gray_blur):
+        self.detector = detector
+        self.gray = gray
+        self.gray_blur = gray_blur
+        self.searched = 0
+
+    def __call__(self, min_rad, max_rad):
+        with METRICS.timer("triage_seconds"):
+            regions = triage_page(self.gray, min_rad, max_rad)
+
+        if not regions:
+            return None
+
+        self.searched += sum((right - left) * (bottom - top) for left, top, right, bottom in regions)
+
+        return restrict_detector(self.detector, self.gray_blur, regions)(min_rad, max_rad)
+
+
+def hough_detector(gray_blur, parameters=None):
+    """the original detector. a hough transform on the blurred page
+
+    Args:
+        gray_blur (np.ndarray): the blurred single band page
+        parameters (dict): the detection parameters with the `param1` and `param2` thresholds
+
+    Returns:
+        callable: a function taking the minimum and maximum radius and returning the circles or None
+    """
+
+    parameters = parameters or DETECTION_PARAMETERS
+
+    def find_circles(min_rad, max_rad):
+        #: apply Hough transform on the blurred image.
+        return cv2.HoughCircles(
+            image=gray_blur,
+            method=cv2.HOUGH_GRADIENT,
+            dp=1,
+            minDist=min_rad,  #: space out circles to prevent multiple detections on the same object
+            param1=parameters["param1"],
+            #: increased from 30 to 50 to weed out some false circles (seems to work well)
+            param2=parameters["param2"],
+            minRadius=min_rad,
+            maxRadius=max_rad,
+        )
+
+    return find_circles
+
+
+def hough_alt_detector(gray_blur, parameters=None):  # pylint: disable=unused-argument
+    """a hough transform using the scharr gradient variant. param2 is how close to a perfect circle an edge must be
+
+    Args:
+        gray_blur (np.ndarray): the blurred single band page
+        parameters (dict): the detection parameters. the hough thresholds mean something else for this variant and
+                           are not used
+
+    Returns:
+        callable: a function taking the minimum and maximum radius and returning the circles or None
+    """
+
+    def find_circles(min_rad, max_rad):
+        return cv2.HoughCircles(
+            image=gray_blur,
+            method=cv2.HOUGH_GRADIENT_ALT,
+            dp=1.5,
+            minDist=min_rad,
+            param1=300,
+            param2=0.8,
+            minRadius=min_rad,
+            maxRadius=max_rad,
+        )
+
+    return find_circles
+
+
+def contour_detector(gray_blur, parameters=None):  # pylint: disable=unused-argument
+    """find circles by fitting ellipses to the contours of the binarized page. the page is traced once and every
+    radius range filters the same candidates. the convex hull of each contour is used so text touching the inside of
+    a circle does not break its outline. circles crossed by text and joined to line work on both edges are missed, which
+    happens more often below 150 dpi
+
+    Args:
+        gray_blur (np.ndarray): the blurred single band page
+        parameters (dict): the detection parameters. only the radius ranges apply and they are used by the caller
+
+    Returns:
+        callable: a function taking the minimum and maximum radius and returning the circles or None
+    """
+    binary = cv2.adaptiveThreshold(gray_blur, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 31, 15)
+    contours, _ = cv2.findContours(binary, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+    candidates = []
+
+    for contour in contours:
+        _, _, width, height = cv2.boundingRect(contour)
+
+        #: the smallest radius any range searches for is 15 pixels
+        if min(width, height) < 30:
+            continue
+
+        hull = cv2.convexHull(contour)
+        if len(hull) < 5:
+            continue
+
+        _, enclosing_radius = cv2.minEnclosingCircle(hull)
+
+        #: a circle fills its enclosing circle, a square only fills 64% of it
+        if cv2.contourArea(hull) < CONTOUR_MIN_FILL * math.pi * enclosing_radius**2:
+            continue
+
+        (x, y), (axis_a, axis_b), _ = cv2.fitEllipse(hull)
+
+        if min(axis_a, axis_b) / max(axis_a, axis_b) < CONTOUR_MIN_ROUNDNESS:
+            continue
+
+        candidates.append((x, y, (axis_a + axis_b) / 4))
+
+    #: the outer and inner edge of a circle are both candidates. keep the largest like the hough minimum distance
+    candidates.sort(key=lambda candidate: candidate[2], reverse=True)
+
+    def find_circles(min_rad, max_rad):
+        circles = []
+
+        for x, y, radius in candidates:
+            if radius < min_rad or radius > max_rad:
+                continue
+
+            if any((x - other_x) ** 2 + (y - other_y) ** 2 < min_rad**2 for other_x, other_y, _ in circles):
+                continue
+
+            circles.append((x, y, radius))
+
+        if not circles:
+            return None
+
+        return np.array([circles], dtype=np.float32)
+
+    return find_circles
+
+
+#: the circle detectors selectable with the `detector` mosaic option
+CIRCLE_DETECTORS = {
+    "hough": hough_detector,
+    "hough-alt": hough_alt_detector,
+    "contour": contour_detector,
+}
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+"""
+UDOT Right of Way (ROW) Parcel Number Extraction
+Download large objects as concurrent byte range chunks and hedge the chunks that are slower than usual
+"""
+
+import logging
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import perf_counter
+
+from google.api_core.exceptions import RequestRangeNotSatisfiable
+
+from row_metrics import METRICS
+
+#: the size of each byte range request. objects that fit in one chunk are downloaded with a single request
+CHUNK_BYTES = 16 * 1024 * 1024
+
+#: the number of chunk requests in flight at once
+WORKERS = 8
+
+#: a chunk that takes longer than this percentile of the recent chunk times is requested again
+HEDGE_PERCENTILE = 95
+
+#: the number of chunk times needed before chunks are hedged
+HEDGE_MIN_SAMPLES = 8
+
+#: the number of recent chunk times the percentile is taken from
+HEDGE_HISTORY = 200
+
+
+class RangedDownloader:
+    """download objects in byte range chunks written into one preallocated buffer. the chunk times are kept across
+    objects so a chunk that runs past the hedge percentile gets a duplicate request and whichever finishes first wins
+    """
+
+    def __init__(
+        self,
+        chunk_bytes=CHUNK_BYTES,
+        workers=WORKERS,
+        hedge_percentile=HEDGE_PERCENTILE,
+        hedge_min_samples=HEDGE_MIN_SAMPLES,
+    ):
+        self.chunk_bytes = chunk_bytes
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.times = deque(maxlen=HEDGE_HISTORY)
+
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="download")
+        #: hedges get their own threads so they do not queue behind the chunks that are still waiting to start
+        self.hedge_executor = ThreadPoolExecutor(max(1, workers // 4), thread_name_prefix="hedge")
+
+    def hedge_seconds(self):
+        """the chunk time after which a chunk is requested again
+
+        Returns:
+            float: the seconds or None until enough chunks have been timed
+        """
+        if self.hedge_percentile is None or len(self.times) < self.hedge_min_samples:
+            return None
+
+        times = sorted(self.times)
+        rank = max(0, min(len(times) - 1, -(-len(times) * self.hedge_percentile // 100) - 1))
+
+        return times[rank]
+
+    def download(self, bucket, object_name):
+        """download an object. the first chunk is read on its own and when it is full the object size is read from
+        its metadata and the rest of the chunks are requested concurrently
+
+        Args:
+            bucket (google.cloud.storage.Bucket): the bucket containing the object
+            object_name (str): the name of the object
+
+        Returns:
+            tuple: the content as bytes or bytearray and a dict with the chunk and hedge counts
+        """
+        try:
+            first = self._fetch(bucket, object_name, 0, self.chunk_bytes - 1, {}, None)
+        except RequestRangeNotSatisfiable:
+            #: an empty object has no first byte to range over
+            return b"", {"chunks": 1, "hedges": 0}
+
+        stats = {"chunks": 1, "hedges": 0}
+
+        if len(first) < self.chunk_bytes:
+            return first, stats
+
+        blob = bucket.get_blob(object_name)
+        size = blob.size if blob is not None else None
+
+        if not size or size <= len(first):
+            return first + bucket.blob(object_name).download_as_bytes(start=len(first)), stats
+
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        view[: len(first)] = first
+        del first
+
+        ranges = [
+            (start, min(start + self.chunk_bytes, size) - 1)
+            for start in range(self.chunk_bytes, size, self.chunk_bytes)
+        ]
+        started = {}
+        attempts = {}
+        hedged = set()
+        remaining = set(ranges)
+
+        for byte_range in ranges:
+            future = self.executor.submit(self._fetch, bucket, object_name, *byte_range, started, None)
+            attempts[future] = byte_range
+
+        try:
+            while remaining:
+                hedge_seconds = self.hedge_seconds()
+                timeout = None
+
+                if hedge_seconds is not None:
+                    now = perf_counter()
+                    deadlines = [
+                        started[(byte_range, None)] + hedge_seconds
+                        for byte_range in remaining - hedged
+                        if (byte_range, None) in started
+                    ]
+                    timeout = max(0.001, min(deadlines, default=now + hedge_seconds) - now)
+
+                done, _ = wait(list(attempts), timeout=timeout, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    byte_range = attempts.pop(future)
+
+                    if byte_range not in remaining:
+                        continue
+
+                    error = future.exception()
+                    if error is not None:
+                        if any(other == byte_range for other in attempts.values()):
+                            continue
+
+                        raise error
+
+                    start, end = byte_range
+                    view[start : end + 1] = future.result()
+                    remaining.discard(byte_range)
+
+                hedge_seconds = self.hedge_seconds()
+                if hedge_seconds is None:
+                    continue
+
+                now = perf_counter()
+                for byte_range in sorted(remaining - hedged):
+                    begun = started.get((byte_range, None))
+
+                    if begun is not None and now - begun > hedge_seconds:
+                        future = self.hedge_executor.submit(self._fetch, bucket, object_name, *byte_range, {}, "hedge")
+                        attempts[future] = byte_range
+                        hedged.add(byte_range)
+        finally:
+            #: the losing requests finish in the background and their chunks are dropped
+            for future in attempts:
+                future.cancel()
+
+            view.release()
+
+        stats["chunks"] += len(ranges)
+        stats["hedges"] = len(hedged)
+
+        #: the buffer is returned as is so a large document is never held twice
+        return buffer, stats
+
+    def _fetch(self, bucket, object_name, start, end, started, attempt):
+        began = perf_counter()
+        started[((start, end), attempt)] = began
+
+        content = bucket.blob(object_name).download_as_bytes(start=start, end=end)
+
+        self.times.append(perf_counter() - began)
+
+        return content
+
+    def close(self):
+        """stop the download threads"""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.hedge_executor.shutdown(wait=False, cancel_futures=True)
+
+
+#: the downloader is created on first use by `get_downloader` so its threads are shared by every download in a task
+DOWNLOADER = None
+
+
+def get_downloader():
+    """get the shared downloader, creating it the first time it is needed
+
+    Returns:
+        RangedDownloader: the downloader
+    """
+    global DOWNLOADER  # pylint: disable=global-statement
+
+    if DOWNLOADER is None:
+        DOWNLOADER = RangedDownloader()
+
+    return DOWNLOADER
+
+
+def download(bucket, object_name, downloader=None):
+    """download an object with the ranged downloader and log its throughput
+
+    Args:
+        bucket (google.cloud.storage.Bucket): the bucket containing the object
+        object_name (str): the name of the object
+        downloader (RangedDownloader): the downloader to use. defaults to the shared one
+
+    Returns:
+        bytes|bytearray: the object content
+    """
+    downloader = downloader or get_downloader()
+
+    start = perf_counter()
+    content, stats = downloader.download(bucket, object_name)
+    seconds = perf_counter() - start
+
+    METRICS.increment("download_chunks", stats["chunks"])
+    METRICS.increment("download_hedges", stats["hedges"])
+
+    logging.info(
+        "downloaded %s: %s",
+        object_name,
+        {
+            "bytes": len(content),
+            "seconds": round(seconds, 3),
+            "MB/s": round(len(content) / 1024 / 1024 / seconds, 2) if seconds > 0 else None,
+            **stats,
+        },
+    )
+
+    return content
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+"""
+UDOT Right of Way (ROW) Parcel Number Extraction
+The fused job. each document's mosaic is read by documentai straight from memory so a run needs neither the mosaic
+upload and download nor a mosaic index and a second job. the results have the same file names and text as the ocr job
+"""
+
+import logging
+
+import row
+import row_cache
+import row_mosaic
+import row_ocr
+import row_pack
+from row_metrics import METRICS
+
+
+def fuse_all_objects(inputs, options=None):
+    """the code to run in the cloud run job
+
+    Args:
+        inputs (class): the inputs to the function
+            job_name (str): the name of the run job
+            input_bucket (str): the bucket to get documents from using the format `gs://bucket-name`
+            output_location (str): the location to save the results and mosaics to. omit the `gs://` prefix
+            file_index (str): the path to the folder containing an `index.txt` file listing all the documents in a
+                              bucket. `gs://bucket-name`
+            task_index (int): the index of the task running
+            task_count (int): the number of containers running the job
+            total_size (int): the total number of files to process
+            project_number (int): the number of the gcp project
+            processor_id (str): the id of the documentai processor
+            upload_mosaics (bool): also upload the mosaics and their manifests so they can be inspected and their
+                                   low confidence tiles read again
+        options (SimpleNamespace): the mosaic options from `row_mosaic.get_mosaic_options`. the defaults are used when
+                                   omitted
+
+    Returns:
+        list(list): the rows of file name and text
+    """
+    if options is None:
+        options = row_mosaic.get_mosaic_options()
+
+    METRICS.reset()
+
+    hash_index, detection_cache = row_cache.get_page_caches(options)
+
+    #: Get files to process for this job
+    files = row.get_files_from_index(inputs.file_index, inputs.task_index, inputs.task_count, inputs.total_size)
+    logging.info("job name: %s task: %i processing %s files", inputs.job_name, inputs.task_index, files)
+
+    bucket = row.get_storage_client().bucket(inputs.input_bucket[5:])
+    ai_client = row_ocr.get_ai_client()
+    processor_name = ai_client.processor_path(inputs.project_number, "us", inputs.processor_id)
+    task_results = []
+    tokens = []
+
+    def read(mosaic_name, mosaic, manifest):
+        task_results.extend(
+            read_mosaic(ai_client, processor_name, mosaic_name, mosaic, inputs, options, manifest, tokens)
+        )
+
+    packer = None
+    if options.pack_pixels:
+        packer = row_pack.MosaicPacker(inputs.job_name, inputs.task_index, inputs.output_location, options, handle=read)
+
+    for object_name in files:
+        row_mosaic.profile_and_mosaic_object(
+            bucket,
+            object_name.rstrip(),
+            inputs.job_name,
+            inputs.task_index,
+            inputs.output_location,
+            options,
+            hash_index,
+            detection_cache,
+            packer,
+            handle=read,
+        )
+
+    if packer is not None:
+        packer.flush()
+
+    row_cache.log_page_cache_summaries(inputs.job_name, inputs.task_index, hash_index, detection_cache)
+
+    row_ocr.upload_results(task_results, inputs.output_location, f"task-{inputs.task_index}", inputs.job_name)
+    row_ocr.upload_tokens(tokens, inputs.output_location, f"task-{inputs.task_index}", inputs.job_name)
+    row.emit_metrics("fused", inputs.job_name, inputs.task_index, inputs.output_location)
+
+    return task_results
+
+
+def read_mosaic(ai_client, processor_name, mosaic_name, mosaic, inputs, options, manifest, tokens=None):
+    """encode a mosaic once and read its text, uploading it first when the inputs ask for the mosaics
+
+    Args:
+        ai_client (DocumentProcessorServiceClient): the documentai client
+        processor_name (str): the documentai processor path
+        mosaic_name (str): the document, work unit or packed mosaic name the mosaic would be uploaded as
+        mosaic (np.ndarray): the mosaic or None when the document had no mosaic
+        inputs (class): the job inputs from `fuse_all_objects`
+        options (SimpleNamespace): the mosaic options with the `codec` and `quality`
+        manifest (dict): the manifest of the mosaic's tiles
+        tokens (list): optional list the `row_ocr.TOKEN_COLUMNS` rows of the mosaic's tokens are added to
+
+    Returns:
+        list(list): the rows of file name and text. empty when there was no mosaic or the ocr failed
+    """
+    content, mime_type = row_pack.prepare_mosaic(mosaic, mosaic_name, options.codec, options.quality)
+
+    if content is None:
+        return []
+
+    if inputs.upload_mosaics:
+        row_pack.upload_mosaic_content(content, mime_type, inputs.output_location, mosaic_name, inputs.job_name)
+        row_pack.upload_manifest(manifest, inputs.output_location, mosaic_name, inputs.job_name)
+
+    #: the rows are named after the uploaded mosaic like the ocr job names them
+    file_name = f"{inputs.job_name}/mosaics/{mosaic_name}"
+    document = row_ocr.read_mosaic_text(ai_client, processor_name, file_name, content, inputs)
+
+    if document is None:
+        return []
+
+    if tokens is not None:
+        tokens.extend(row_ocr.get_token_rows(document, file_name, manifest))
+
+    return row_ocr.get_result_rows(document, file_name, manifest)
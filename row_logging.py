@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+"""
+UDOT Right of Way (ROW) Parcel Number Extraction
+Non blocking log shipping. records are put on a queue by the hot path and shipped in batches by a background thread,
+and the per pass detail records can be sampled
+"""
+
+import atexit
+import logging
+import sys
+from logging.handlers import QueueHandler
+from queue import Empty, Full, Queue
+from threading import Thread
+from time import perf_counter, sleep
+
+from row_metrics import METRICS
+
+#: the logger for the per page and per pass detail records. only these records are sampled, the per object summaries
+#: and every warning and error are always kept
+DETAIL_LOGGER = "row.detail"
+
+#: the share of detail records kept in production runs
+PRODUCTION_SAMPLE_RATE = 0.1
+
+#: the records shipped together and the longest a record waits for its batch
+BATCH_SIZE = 200
+FLUSH_SECONDS = 1.0
+
+#: the records waiting to be shipped before new ones are dropped instead of blocking the hot path
+MAX_QUEUE = 10_000
+
+
+class SamplingFilter(logging.Filter):
+    """keep an evenly spaced `rate` share of the info and debug records. warnings and errors are always kept"""
+
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = min(max(float(rate), 0.0), 1.0)
+        self.seen = 0
+        self.kept = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+
+        self.seen += 1
+
+        if int(self.seen * self.rate) > int((self.seen - 1) * self.rate):
+            self.kept += 1
+
+            return True
+
+        return False
+
+
+class NonBlockingHandler(QueueHandler):
+    """put records on the shipping queue without waiting. records are dropped and counted when the queue is full. the
+    dropped records are also counted in the task metrics so a run can tell its logs are incomplete
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+            METRICS.increment("log_records_dropped")
+
+
+class LogShipper:
+    """a background thread that takes records off a queue and ships them to a sink in batches of up to `batch_size`
+    records, or whatever arrived within `flush_seconds`
+    """
+
+    def __init__(self, sink, batch_size=BATCH_SIZE, flush_seconds=FLUSH_SECONDS, max_queue=MAX_QUEUE):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.queue = Queue(max_queue)
+        self.batches = 0
+        self.records = 0
+
+        self.thread = Thread(target=self._run, name="log-shipper", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        batch = []
+        deadline = None
+
+        while True:
+            try:
+                record = self.queue.get(timeout=max(deadline - perf_counter(), 0) if batch else None)
+            except Empty:
+                self._ship(batch)
+                batch = []
+
+                continue
+
+            if record is None:
+                if batch:
+                    self._ship(batch)
+
+                return
+
+            if not batch:
+                deadline = perf_counter() + self.flush_seconds
+
+            batch.append(record)
+
+            if len(batch) >= self.batch_size:
+                self._ship(batch)
+                batch = []
+
+    def _ship(self, batch):
+        try:
+            self.sink(batch)
+        except Exception:  # pylint: disable=broad-except
+            #: a failing sink must not stop the shipper. the error goes to the last resort handler instead of the
+            #: root logger, whose records would come back through this shipper
+            if logging.lastResort is not None:
+                logging.lastResort.handle(
+                    logging.makeLogRecord(
+                        {
+                            "name": __name__,
+                            "levelno": logging.ERROR,
+                            "levelname": "ERROR",
+                            "msg": "unable to ship %i log records",
+                            "args": (len(batch),),
+                            "exc_info": sys.exc_info(),
+                        }
+                    )
+                )
+
+        self.batches += 1
+        self.records += len(batch)
+
+    def close(self):
+        """ship the records still on the queue and stop the thread"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+class HandlerSink:
+    """ship batches through existing logging handlers. the handlers that only format records onto a stream, like
+    the cloud run structured log handler, get one write for the whole batch. the others handle each record
+    """
+
+    #: the handlers whose emit is a formatted write to their stream
+    STREAM_HANDLERS = ("StreamHandler", "StructuredLogHandler")
+
+    def __init__(self, handlers):
+        self.handlers = list(handlers)
+
+    def __call__(self, records):
+        for handler in self.handlers:
+            stream = getattr(handler, "stream", None)
+
+            if stream is None or type(handler).__name__ not in self.STREAM_HANDLERS:
+                for record in records:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+
+                continue
+
+            lines = [
+                handler.format(record)
+                for record in records
+                if record.levelno >= handler.level and handler.filter(record)
+            ]
+
+            if lines:
+                with handler.lock:
+                    stream.write(handler.terminator.join(lines) + handler.terminator)
+                    stream.flush()
+
+
+class LocalSink:
+    """a stand in for a remote log sink that keeps the formatted records. every call waits for `latency` seconds plus
+    `record_latency` seconds for each record to mimic the cost of sending them
+    """
+
+    def __init__(self, latency=0.0, record_latency=0.0, formatter=None):
+        self.latency = latency
+        self.record_latency = record_latency
+        self.formatter = formatter or logging.Formatter("%(levelname)s %(name)s %(message)s")
+        self.lines = []
+        self.calls = 0
+
+    def __call__(self, records):
+        delay = self.latency + self.record_latency * len(records)
+
+        if delay > 0:
+            sleep(delay)
+
+        self.calls += 1
+        self.lines.extend(self.formatter.format(record) for record in records)
+
+
+class SinkHandler(logging.Handler):
+    """ship every record to a sink on the calling thread as it is logged. the blocking behavior of a plain handler"""
+
+    def __init__(self, sink):
+        super().__init__()
+        self.sink = sink
+
+    def emit(self, record):
+        self.sink([record])
+
+
+def sample_detail_logs(rate):
+    """keep a share of the detail records
+
+    Args:
+        rate (float): the share of detail records to keep from 0 to 1
+
+    Returns:
+        SamplingFilter: the filter on the detail logger
+    """
+    logger = logging.getLogger(DETAIL_LOGGER)
+
+    for existing in [existing for existing in logger.filters if isinstance(existing, SamplingFilter)]:
+        logger.removeFilter(existing)
+
+    sampler = SamplingFilter(rate)
+    logger.addFilter(sampler)
+
+    return sampler
+
+
+def ship_logs_in_background(sink=None, sample_rate=1.0, batch_size=BATCH_SIZE, flush_seconds=FLUSH_SECONDS):
+    """move the root logger's handlers behind a queue so logging never waits on them. the current handlers become
+    the sink unless another one is given and the queue is drained when the process exits
+
+    Args:
+        sink (callable): called with each batch of records. defaults to the current root handlers
+        sample_rate (float): the share of detail records to keep
+        batch_size (int): the most records shipped together
+        flush_seconds (float): the longest a record waits for its batch
+
+    Returns:
+        LogShipper: the shipper
+    """
+    root = logging.getLogger()
+
+    if sink is None:
+        sink = HandlerSink(handler for handler in root.handlers if not isinstance(handler, NonBlockingHandler))
+
+    shipper = LogShipper(sink, batch_size, flush_seconds)
+    handler = NonBlockingHandler(shipper.queue)
+
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+
+    root.addHandler(handler)
+    sample_detail_logs(sample_rate)
+    atexit.register(shipper.close)
+
+    return shipper
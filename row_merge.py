@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+"""
+UDOT Right of Way (ROW) Parcel Number Extraction
+Merging the partial mosaics of the documents that were split into page range work units
+"""
+
+import json
+import logging
+
+import cv2
+import numpy as np
+
+import row
+import row_pack
+
+
+def get_unit_marker_name(object_name, job_name):
+    """get the blob name that records a page range work unit as finished
+
+    Args:
+        object_name (str): the work unit, `file.pdf#pages=1-50`
+        job_name (str): the name of the run job
+
+    Returns:
+        str: the marker blob name, `job/units/file.pdf#pages=1-50`
+    """
+    return f"{job_name}/units/{object_name}"
+
+
+def merge_partial_mosaics(
+    job_name, output_location, entries, codec="jpg", quality=95, max_pixels=row_pack.MAX_MOSAIC_PIXELS
+):
+    """stack the partial mosaics of each document split into page ranges into one mosaic named after the document
+    and remove the partials. a document is only merged once every one of its work units in the index has finished,
+    so the merged mosaic marks all of its page ranges as processed. documents whose stacked mosaic would be larger
+    than `max_pixels` keep their partials so they are read on their own and their text is combined with
+    `row_ocr.merge_partial_results`
+
+    Args:
+        job_name (str): the name of the run job
+        output_location (str): the bucket holding the mosaics. omit the `gs://` prefix
+        entries (list(str)): the index entries of the mosaic job with the page range work units
+        codec (str): one of the `row_pack.MOSAIC_CODECS` for the merged mosaics
+        quality (int): the jpeg quality
+        max_pixels (int): the most pixels in a merged mosaic
+
+    Returns:
+        dict: the number of documents merged, kept as partials and waiting for units and the partial mosaics merged
+    """
+    bucket = row.get_storage_client().bucket(output_location)
+    prefix = f"{job_name}/mosaics/"
+    marker_prefix = get_unit_marker_name("", job_name)
+    finished = {blob.name[len(marker_prefix) :] for blob in bucket.list_blobs(prefix=marker_prefix)}
+    units = {}
+    documents = {}
+
+    for entry in entries:
+        document_name, pages = row.parse_work_unit(entry.strip())
+
+        if pages is not None:
+            units.setdefault(document_name, set()).add(entry.strip())
+
+    for blob in bucket.list_blobs(prefix=prefix):
+        document_name, pages = row.parse_work_unit(blob.name[len(prefix) :])
+
+        if pages is not None:
+            documents.setdefault(document_name, []).append((pages, blob))
+
+    summary = {"merged": 0, "kept": 0, "incomplete": 0, "partials": 0}
+
+    for document_name, partials in sorted(documents.items()):
+        missing = units.get(document_name, set()) - finished
+
+        if missing or document_name not in units:
+            logging.warning(
+                "not merging a document with unfinished page ranges: %s",
+                {"file": document_name, "partials": len(partials), "unfinished": sorted(missing)},
+            )
+            summary["incomplete"] += 1
+
+            continue
+
+        partials.sort(key=lambda partial: partial[0])
+        images = [
+            cv2.imdecode(np.frombuffer(blob.download_as_bytes(), np.uint8), cv2.IMREAD_UNCHANGED)
+            for _, blob in partials
+        ]
+        unreadable = sum(image is None for image in images)
+
+        if unreadable:
+            #: a merge without a partial would lose its circles and misalign the merged manifest
+            logging.error(
+                "keeping the partial mosaics, some could not be read: %s",
+                {"file": document_name, "partials": len(partials), "unreadable": unreadable},
+            )
+            summary["kept"] += 1
+
+            continue
+
+        width = max((image.shape[1] for image in images), default=0)
+        height = sum(image.shape[0] for image in images)
+
+        if width * height > max_pixels:
+            logging.warning(
+                "keeping the partial mosaics: %s",
+                {"file": document_name, "partials": len(partials), "pixels": width * height},
+            )
+            summary["kept"] += 1
+
+            continue
+
+        mosaic = stack_mosaics(images)
+        content, mime_type = row_pack.encode_mosaic(mosaic, codec, quality)
+        manifest = merge_manifests(bucket, [blob.name for _, blob in partials], images, f"{prefix}{document_name}")
+
+        if content is None:
+            logging.error("unable to encode the merged mosaic: %s", document_name)
+            summary["kept"] += 1
+
+            continue
+
+        bucket.blob(f"{prefix}{document_name}").upload_from_string(content, content_type=mime_type)
+
+        if manifest is not None:
+            bucket.blob(row.get_manifest_name(f"{prefix}{document_name}")).upload_from_string(
+                json.dumps(manifest), content_type="application/json"
+            )
+
+        for _, blob in partials:
+            blob.delete()
+
+            if manifest is not None:
+                bucket.blob(row.get_manifest_name(blob.name)).delete()
+
+        for unit in units[document_name]:
+            bucket.blob(get_unit_marker_name(unit, job_name)).delete()
+
+        logging.info(
+            "merged partial mosaics: %s",
+            {"file": document_name, "pages": [pages for pages, _ in partials], "pixels": width * height},
+        )
+        summary["merged"] += 1
+        summary["partials"] += len(partials)
+
+    return summary
+
+
+def merge_manifests(bucket, mosaic_names, images, file_name):
+    """combine the manifests of partial mosaics into the manifest of the mosaic `stack_mosaics` builds from them
+
+    Args:
+        bucket (google.cloud.storage.Bucket): the bucket holding the mosaics and manifests
+        mosaic_names (list): the blob names of the partial mosaics in page order
+        images (list(np.ndarray)): the decoded partial mosaics
+        file_name (str): the name of the merged mosaic's ocr result row
+
+    Returns:
+        dict: the merged manifest or None when a partial has no manifest
+    """
+    tiles = []
+    top = 0
+
+    for mosaic_name, image in zip(mosaic_names, images):
+        blob = bucket.blob(row.get_manifest_name(mosaic_name))
+
+        if not blob.exists():
+            return None
+
+        for tile in json.loads(blob.download_as_bytes())["tiles"]:
+            left, tile_top, right, bottom = tile["box"]
+            tiles.append(
+                {"file_name": file_name, "page": tile["page"], "box": [left, tile_top + top, right, bottom + top]}
+            )
+
+        top += image.shape[0]
+
+    return {"version": 1, "width": max(image.shape[1] for image in images), "height": top, "tiles": tiles}
+
+
+def stack_mosaics(images):
+    """stack mosaics top to bottom on a white background
+
+    Args:
+        images (list(np.ndarray)): the mosaics. single band mosaics are converted to color when the others are color
+
+    Returns:
+        np.ndarray: the stacked mosaic
+    """
+    color = any(image.ndim == 3 for image in images)
+    width = max(image.shape[1] for image in images)
+    rows = []
+
+    for image in images:
+        if color and image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        elif image.ndim == 3 and image.shape[2] == 4:
+            image = cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+
+        padding = [(0, 0), (0, width - image.shape[1])] + [(0, 0)] * (image.ndim - 2)
+        rows.append(np.pad(image, padding, constant_values=255))
+
+    return np.vstack(rows)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+"""
+UDOT Right of Way (ROW) Parcel Number Extraction
+Per task counters and histograms that are emitted as one structured record and merged across the tasks of a run
+"""
+
+import math
+from contextlib import contextmanager
+from time import perf_counter
+
+#: the histogram bucket upper bounds picked by the metric name suffix
+SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+BYTES_BUCKETS = tuple(1024 * 4**power for power in range(11))
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+PREFIX = "row_"
+
+
+def get_buckets(name):
+    """pick the histogram buckets for a metric from its unit suffix
+
+    Args:
+        name (str): the metric name
+
+    Returns:
+        tuple: the bucket upper bounds
+    """
+    if name.endswith("_seconds"):
+        return SECONDS_BUCKETS
+
+    if name.endswith("_bytes"):
+        return BYTES_BUCKETS
+
+    return COUNT_BUCKETS
+
+
+class Metrics:
+    """counters and histograms aggregated in process for a single task"""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def reset(self):
+        """clear all of the metrics, for example when a process runs more than one task"""
+        self.counters = {}
+        self.histograms = {}
+
+    def increment(self, name, value=1):
+        """add to a counter
+
+        Args:
+            name (str): the counter name
+            value (number): the amount to add
+        """
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        """record a value in a histogram
+
+        Args:
+            name (str): the histogram name. `_seconds` and `_bytes` suffixes pick the matching buckets
+            value (number): the value to record
+        """
+        histogram = self.histograms.get(name)
+
+        if histogram is None:
+            buckets = get_buckets(name)
+            histogram = {
+                "buckets": list(buckets),
+                "counts": [0] * (len(buckets) + 1),
+                "sum": 0,
+                "count": 0,
+                "min": None,
+                "max": None,
+            }
+            self.histograms[name] = histogram
+
+        position = next(
+            (i for i, bound in enumerate(histogram["buckets"]) if value <= bound), len(histogram["buckets"])
+        )
+
+        histogram["counts"][position] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+        histogram["min"] = value if histogram["min"] is None else min(histogram["min"], value)
+        histogram["max"] = value if histogram["max"] is None else max(histogram["max"], value)
+
+    @contextmanager
+    def timer(self, name):
+        """observe the seconds spent in a `with` block
+
+        Args:
+            name (str): the histogram name, ending in `_seconds`
+        """
+        start = perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start)
+
+    def to_record(self, **labels):
+        """create a json serializable record of the metrics
+
+        Args:
+            labels (dict): labels describing the task, like the job name and task index
+
+        Returns:
+            dict: the labels, counters and histograms
+        """
+        return {
+            "labels": labels,
+            "counters": dict(self.counters),
+            "histograms": {
+                name: dict(histogram, counts=list(histogram["counts"])) for name, histogram in self.histograms.items()
+            },
+        }
+
+
+#: the metrics for the task running in this process
+METRICS = Metrics()
+
+
+def merge_records(records, **labels):
+    """merge the metric records of many tasks into one record
+
+    Args:
+        records (list): records from `Metrics.to_record`
+        labels (dict): the labels for the merged record
+
+    Returns:
+        dict: the merged record with a `tasks` count
+    """
+    merged = Metrics()
+
+    for record in records:
+        for name, value in record.get("counters", {}).items():
+            merged.increment(name, value)
+
+        for name, histogram in record.get("histograms", {}).items():
+            target = merged.histograms.get(name)
+
+            if target is None:
+                merged.histograms[name] = dict(histogram, counts=list(histogram["counts"]))
+
+                continue
+
+            if target["buckets"] != histogram["buckets"]:
+                raise ValueError(f"histogram {name} has different buckets between records")
+
+            target["counts"] = [left + right for left, right in zip(target["counts"], histogram["counts"])]
+            target["sum"] += histogram["sum"]
+            target["count"] += histogram["count"]
+            target["min"] = _combine(min, target["min"], histogram["min"])
+            target["max"] = _combine(max, target["max"], histogram["max"])
+
+    record = merged.to_record(**labels)
+    record["tasks"] = len(records)
+
+    return record
+
+
+def _combine(function, left, right):
+    if left is None:
+        return right
+
+    if right is None:
+        return left
+
+    return function(left, right)
+
+
+def to_openmetrics(record):
+    """format a metrics record in the OpenMetrics text format
+
+    Args:
+        record (dict): a record from `Metrics.to_record` or `merge_records`
+
+    Returns:
+        str: the OpenMetrics exposition
+    """
+    labels = ",".join(f'{key}="{_escape(value)}"' for key, value in sorted(record.get("labels", {}).items()))
+    lines = []
+
+    def sample(name, value, extra=""):
+        combined = ",".join(part for part in (labels, extra) if part)
+        lines.append(f"{name}{{{combined}}} {_number(value)}" if combined else f"{name} {_number(value)}")
+
+    for name, value in sorted(record.get("counters", {}).items()):
+        lines.append(f"# TYPE {PREFIX}{name} counter")
+        sample(f"{PREFIX}{name}_total", value)
+
+    for name, histogram in sorted(record.get("histograms", {}).items()):
+        lines.append(f"# TYPE {PREFIX}{name} histogram")
+
+        cumulative = 0
+        for bound, count in zip(list(histogram["buckets"]) + [math.inf], histogram["counts"]):
+            cumulative += count
+            sample(f"{PREFIX}{name}_bucket", cumulative, f'le="{"+Inf" if bound == math.inf else _number(bound)}"')
+
+        sample(f"{PREFIX}{name}_sum", histogram["sum"])
+        sample(f"{PREFIX}{name}_count", histogram["count"])
+
+    lines.append("# EOF")
+
+    return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+
+    return str(value)
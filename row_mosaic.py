@@ -0,0 +1,966 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+"""
+UDOT Right of Way (ROW) Parcel Number Extraction
+The mosaic job. each document is rendered, the circles on its pages are detected and cropped and the crops are
+mosaicked and uploaded with a manifest of their tiles
+"""
+import json
+import logging
+import math
+from pathlib import Path
+from time import perf_counter
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+
+import row
+import row_cache
+import row_detect
+import row_logging
+import row_merge
+import row_pack
+import row_profile
+import row_queue
+import row_render
+from row_metrics import METRICS
+
+#: the per page and per pass records. they are sampled in production runs
+DETAIL_LOG = logging.getLogger(row_logging.DETAIL_LOGGER)
+
+#: the default settings for the mosaic job. the defaults match the original 3 band jpeg output
+MOSAIC_OPTIONS = {
+    "color_mode": "color",
+    "codec": "jpg",
+    "quality": 95,
+    "filter_crops": False,
+    "hash_index": None,
+    "profile": False,
+    "profile_seconds": 300.0,
+    "profile_memory_mb": 2048.0,
+    "profile_top": 25,
+    "dpi": 300,
+    "memory_budget_mb": None,
+    "detector": "hough",
+    "triage": False,
+    "decode_reduction": 1,
+    "detection_profile": None,
+    "detection_cache": None,
+    "pack_pixels": None,
+}
+
+#: the grayscale decode modes for detection by how much they shrink each side of the page. jpegs are reduced while
+#: their dct blocks are decoded so the full page is never held in memory
+DECODE_REDUCTIONS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+}
+
+#: the pages in each work unit when a large pdf is split into page ranges and the smallest pdf that is split
+PAGES_PER_UNIT = 50
+SPLIT_MIN_BYTES = 20 * 1024 * 1024
+
+#: the cheap features a circle crop must satisfy to be mosaicked when crops are filtered. ink is the share of dark
+#: pixels, components are the connected blobs of ink and edge energy is the mean gradient magnitude of the crop
+CROP_FILTER_THRESHOLDS = {
+    "min_ink": 0.01,
+    "max_ink": 0.45,
+    "min_components": 1,
+    "max_components": 40,
+    "min_edge_energy": 1.5,
+}
+
+#: the version of the detection profile layout
+DETECTION_PROFILE_VERSION = 1
+
+
+def get_mosaic_options(**overrides):
+    """creates the options for the mosaic job from the defaults. `None` values are ignored so environment variables
+    and cli arguments can be passed through without checking them
+
+    Args:
+        overrides (dict): the option names and values to override the defaults with
+
+    Returns:
+        SimpleNamespace: the mosaic job options
+    """
+    unknown = set(overrides) - set(MOSAIC_OPTIONS)
+    if unknown:
+        raise ValueError(f"unknown mosaic options: {', '.join(sorted(unknown))}")
+
+    options = {**MOSAIC_OPTIONS, **{key: value for key, value in overrides.items() if value is not None}}
+
+    options["detection_parameters"] = None
+    if options["detection_profile"]:
+        profile = load_detection_profile(options["detection_profile"])
+        options["detection_parameters"] = profile["parameters"]
+
+        #: the profile was tuned for its detector at its render resolution. explicit options still win
+        for key in ("detector", "dpi"):
+            if overrides.get(key) is None:
+                options[key] = profile[key]
+
+    if options["color_mode"] not in row_pack.COLOR_MODES:
+        raise ValueError(f"unknown color mode: {options['color_mode']}")
+
+    if options["detector"] not in row_detect.CIRCLE_DETECTORS:
+        raise ValueError(f"unknown circle detector: {options['detector']}")
+
+    if options["codec"] not in row_pack.MOSAIC_CODECS:
+        raise ValueError(f"unknown codec: {options['codec']}")
+
+    options["quality"] = int(options["quality"])
+    options["filter_crops"] = row.to_bool(options["filter_crops"])
+    options["triage"] = row.to_bool(options["triage"])
+    options["profile"] = row.to_bool(options["profile"])
+    options["profile_seconds"] = float(options["profile_seconds"])
+    options["profile_memory_mb"] = float(options["profile_memory_mb"])
+    options["profile_top"] = int(options["profile_top"])
+    options["dpi"] = int(options["dpi"])
+    options["decode_reduction"] = int(options["decode_reduction"])
+    options["pack_pixels"] = int(options["pack_pixels"]) if options["pack_pixels"] else None
+
+    if options["pack_pixels"] and options["pack_pixels"] > row_pack.MAX_MOSAIC_PIXELS:
+        raise ValueError(f"packed mosaics can not be larger than {row_pack.MAX_MOSAIC_PIXELS} pixels")
+
+    if options["decode_reduction"] not in DECODE_REDUCTIONS:
+        raise ValueError(f"unknown decode reduction: {options['decode_reduction']}")
+
+    return SimpleNamespace(**options)
+
+
+def load_detection_profile(location):
+    """read a detection profile written by `row_tune.save_profile` from the record store of its folder, so the tasks of
+    a run can share a profile saved in a bucket
+
+    Args:
+        location (str): the profile json file or `gs://bucket-name/prefix/profile.json` object
+
+    Returns:
+        dict: the profile with its `parameters` filled in from the `row_detect.DETECTION_PARAMETERS`
+    """
+    folder, _, key = location.rpartition("/")
+    content = row.get_record_store(folder or ".").get(key)
+
+    if content is None:
+        raise FileNotFoundError(f"the detection profile {location} does not exist")
+
+    profile = json.loads(content)
+
+    if profile.get("version") != DETECTION_PROFILE_VERSION:
+        raise ValueError(f"the detection profile {location} is out of date, tune it again")
+
+    unknown = set(profile["parameters"]) - set(row_detect.DETECTION_PARAMETERS)
+    if unknown:
+        raise ValueError(f"unknown detection parameters: {', '.join(sorted(unknown))}")
+
+    profile["parameters"] = {**row_detect.DETECTION_PARAMETERS, **profile["parameters"]}
+    logging.info("using detection profile %s: %s", location, profile["parameters"])
+
+    return profile
+
+
+def mosaic_all_circles(
+    job_name, input_bucket, output_location, file_index, task_index, task_count, total_size, options=None
+):
+    """the code to run in the cloud run job
+
+    Args:
+        job_name (str): the name of the run job. typically named after an animal in alphabetical order
+        input_bucket (str): the bucket to get files from using the format `gs://bucket-name`
+        output_location (str): the location to save the results to. omit the `gs://` prefix
+        file_index (str): the path to the folder containing an `index.txt` file listing all the images in a bucket.
+                          `gs://bucket-name`
+        task_index (int): the index of the task running
+        task_count (int): the number of containers running the job
+        total_size (int): the total number of files to process
+        options (SimpleNamespace): the mosaic options from `get_mosaic_options`. the defaults are used when omitted
+
+    Returns:
+        None
+    """
+    if options is None:
+        options = get_mosaic_options()
+
+    METRICS.reset()
+
+    hash_index, detection_cache = row_cache.get_page_caches(options)
+
+    packer = row_pack.MosaicPacker(job_name, task_index, output_location, options) if options.pack_pixels else None
+
+    #: Get files to process for this job
+    files = row.get_files_from_index(file_index, task_index, task_count, total_size)
+    logging.info("job name: %s task: %i processing %s files", job_name, task_index, files)
+
+    #: Initialize GCP storage client and bucket
+    bucket = row.get_storage_client().bucket(input_bucket[5:])
+
+    #: Iterate over objects to detect circles and perform OCR
+    for object_name in files:
+        profile_and_mosaic_object(
+            bucket,
+            object_name.rstrip(),
+            job_name,
+            task_index,
+            output_location,
+            options,
+            hash_index,
+            detection_cache,
+            packer,
+        )
+
+    if packer is not None:
+        packer.flush()
+
+    row_cache.log_page_cache_summaries(job_name, task_index, hash_index, detection_cache)
+
+    row.emit_metrics("mosaic", job_name, task_index, output_location)
+
+
+def mosaic_queued_objects(job_name, input_bucket, output_location, queue, task_index, options=None, seconds=None):
+    """the code to run in a long running worker. objects are leased from the queue until it is drained or the time
+    budget runs out while the storage client and page hash index stay warm
+
+    Args:
+        job_name (str): the name of the run job
+        input_bucket (str): the bucket to get files from using the format `gs://bucket-name`
+        output_location (str): the location to save the results to. omit the `gs://` prefix
+        queue (SqliteQueue|BucketQueue): the queue of object names from `row.get_work_queue`
+        task_index (int): the index of the task running
+        options (SimpleNamespace): the mosaic options from `get_mosaic_options`. the defaults are used when omitted
+        seconds (float): the time budget. None to run until the queue is drained
+
+    Returns:
+        dict: the number of objects handled and failed and the seconds spent
+    """
+    if options is None:
+        options = get_mosaic_options()
+
+    METRICS.reset()
+
+    hash_index, detection_cache = row_cache.get_page_caches(options)
+
+    bucket = row.get_storage_client().bucket(input_bucket[5:])
+    packer = row_pack.MosaicPacker(job_name, task_index, output_location, options) if options.pack_pixels else None
+
+    #: packed objects are only completed once the mosaic holding their crops is uploaded
+    summary = row_queue.drain(
+        queue,
+        lambda object_name: profile_and_mosaic_object(
+            bucket, object_name, job_name, task_index, output_location, options, hash_index, detection_cache, packer
+        ),
+        f"{job_name}-{task_index}",
+        seconds,
+        flush=packer.flush if packer is not None else None,
+    )
+
+    METRICS.increment("queue_items", summary["items"])
+    METRICS.increment("queue_items_failed", summary["failed"])
+
+    row_cache.log_page_cache_summaries(job_name, task_index, hash_index, detection_cache)
+
+    row.emit_metrics("mosaic", job_name, task_index, output_location)
+
+    return summary
+
+
+def profile_and_mosaic_object(
+    bucket,
+    object_name,
+    job_name,
+    task_index,
+    output_location,
+    options,
+    hash_index=None,
+    detection_cache=None,
+    packer=None,
+    handle=None,
+):
+    """mosaic an object and upload its profile when it was slow or memory hungry
+
+    Args:
+        bucket (google.cloud.storage.Bucket): the bucket containing the object
+        object_name (str): the name of the object
+        job_name (str): the name of the run job
+        task_index (int): the index of the task running
+        output_location (str): the location to save the mosaic to. omit the `gs://` prefix
+        options (SimpleNamespace): the mosaic options from `get_mosaic_options`
+        hash_index (row_cache.PageHashIndex): optional index of pages already seen
+        detection_cache (row_cache.DetectionCache): optional cache of the detections and crops of documents already
+                                                    processed
+        packer (row_pack.MosaicPacker): optional packer sharing mosaics between small documents
+        handle (callable): called with the object name, mosaic and manifest instead of uploading them
+
+    Returns:
+        np.ndarray: the mosaic from `mosaic_object`
+    """
+    with row_profile.profile_object(object_name, options) as profiler:
+        mosaic = mosaic_object(
+            bucket,
+            object_name,
+            job_name,
+            task_index,
+            output_location,
+            options,
+            hash_index,
+            detection_cache=detection_cache,
+            packer=packer,
+            handle=handle,
+        )
+
+    if profiler is not None and profiler.report is not None:
+        row.upload_profile(profiler.report, output_location, object_name, job_name)
+
+    return mosaic
+
+
+def mosaic_object(
+    bucket,
+    object_name,
+    job_name,
+    task_index,
+    output_location,
+    options,
+    hash_index=None,
+    upload=True,
+    detection_cache=None,
+    packer=None,
+    handle=None,
+):
+    """detect the circles in a pdf or image object and mosaic them. a page range work unit, `file.pdf#pages=1-50`,
+    only renders those pages and its partial mosaic is uploaded under the work unit name for
+    `row_merge.merge_partial_mosaics`. the mosaic is uploaded with a manifest of its tiles so the ocr job can tell which
+    tile each token was read from
+
+    Args:
+        bucket (google.cloud.storage.Bucket): the bucket containing the object
+        object_name (str): the name of the object or a page range of it
+        job_name (str): the name of the run job
+        task_index (int): the index of the task running
+        output_location (str): the location to save the mosaic to. omit the `gs://` prefix
+        options (SimpleNamespace): the mosaic options from `get_mosaic_options`
+        hash_index (row_cache.PageHashIndex): optional index of pages already seen
+        upload (bool): upload the mosaic to the output location
+        detection_cache (row_cache.DetectionCache): optional cache of detections and crops. a document whose pages
+                                                    are all cached is mosaicked from its cached crops without rendering
+                                                    it
+        packer (row_pack.MosaicPacker): optional packer for the crops of documents with at most
+                                        `row_pack.PACK_MAX_TILES` circles
+        handle (callable): called with the object name, mosaic and manifest instead of uploading them
+
+    Returns:
+        np.ndarray: the mosaic or None when the object is not a document or image or its crops were packed
+    """
+    object_start = perf_counter()
+    document_name, pages = row.parse_work_unit(object_name)
+    extension = Path(document_name).suffix.casefold()
+    row_render.reset_peak_rss()
+
+    if pages is not None:
+        METRICS.increment("page_ranges")
+
+    source = None
+    cached_pages = None
+    if detection_cache is not None and extension in [".pdf", ".tif", ".tiff", ".jpg", ".jpeg", ".png"]:
+        source = detection_cache.get_source(bucket, document_name)
+        cached_pages = detection_cache.load(source, pages)
+
+    if cached_pages is not None:
+        images = cached_pages
+        METRICS.increment("pages_cached", len(cached_pages))
+
+        logging.info(
+            "job name: %s task: %i using cached detections: %s",
+            job_name,
+            task_index,
+            {"file": object_name, "pages": len(cached_pages)},
+        )
+
+    elif extension == ".pdf":
+        pdf = row.download_object(bucket, document_name)
+
+        conversion_start = perf_counter()
+        with METRICS.timer("render_seconds"):
+            images, count, messages = row_render.convert_pdf_to_jpg_bytes(
+                pdf, object_name, options.dpi, row_render.get_memory_budget(options.memory_budget_mb), pages
+            )
+
+        del pdf
+        METRICS.increment("pages_rendered", count)
+
+        logging.info(
+            "job name: %s task: %i conversion time %s: %s",
+            job_name,
+            task_index,
+            row.format_time(perf_counter() - conversion_start),
+            {"file": object_name, "pages": count, "message": messages},
+        )
+
+    elif extension in [".tif", ".tiff"]:
+        tiff = row.download_object(bucket, document_name)
+        images, count, messages = row_render.convert_tiff_to_images(tiff, object_name, pages)
+
+        del tiff
+        METRICS.increment("tiff_pages", count)
+
+        logging.info(
+            "job name: %s task: %i tiff pages: %s",
+            job_name,
+            task_index,
+            {"file": object_name, "pages": count, "message": messages},
+        )
+
+    elif extension in [".jpg", ".jpeg", ".png"]:
+        images = [(1, row.download_object(bucket, document_name))]
+        count = 1
+    else:
+        logging.info('job name: %s task: %i not a valid document or image: "%s"', job_name, task_index, object_name)
+        METRICS.increment("objects_skipped")
+
+        return None
+
+    METRICS.increment("objects")
+
+    #: Process images to get detected circles
+    logging.info("job name: %s task: %i detecting circles in %s", job_name, task_index, object_name)
+    all_detected_circles = []
+    dropped_circles = 0
+    circle_start = perf_counter()
+
+    hits_before = hash_index.hits if hash_index else 0
+    page_count = 0
+    page_numbers = []
+    crop_pages = []
+
+    for page_number, image in images:
+        page_count += 1
+
+        if cached_pages is not None:
+            circle_images = image
+        else:
+            detected_circles, inset, circle_images = detect_and_crop_circles(
+                image,
+                None,
+                object_name,
+                hash_index,
+                options.detector,
+                options.triage,
+                options.decode_reduction,
+                options.detection_parameters,
+            )
+
+            if detection_cache is not None:
+                detection_cache.save_page(source, page_number, detected_circles, inset, circle_images)
+                page_numbers.append(page_number)
+
+        METRICS.increment("pages")
+        METRICS.observe("circles_per_page", len(circle_images))
+
+        if options.filter_crops:
+            circle_images, dropped = filter_circle_crops(circle_images)
+            dropped_circles += dropped
+
+        all_detected_circles.extend(circle_images)  #: extend because circle_images will be a list
+        crop_pages.extend([page_number] * len(circle_images))
+        row_profile.checkpoint()
+
+    #: documents with pages that could not be read are not cached so they are tried again
+    if detection_cache is not None and page_numbers and len(page_numbers) == count:
+        detection_cache.save_unit(source, pages, page_numbers)
+
+    logging.info(
+        "job name: %s task: %i circle detection time taken %s: %s",
+        job_name,
+        task_index,
+        object_name,
+        row.format_time(perf_counter() - circle_start),
+    )
+
+    if hash_index is not None and hash_index.hits > hits_before:
+        logging.info(
+            "job name: %s task: %i duplicate pages found: %s",
+            job_name,
+            task_index,
+            {
+                "file": object_name,
+                "duplicate pages": hash_index.hits - hits_before,
+                "pages": page_count,
+                "duplicate document": hash_index.hits - hits_before == page_count,
+            },
+        )
+
+    METRICS.observe("detection_seconds", perf_counter() - circle_start)
+
+    if dropped_circles:
+        METRICS.increment("circles_dropped", dropped_circles)
+
+        logging.info(
+            "job name: %s task: %i dropped circles without text: %s",
+            job_name,
+            task_index,
+            {"file": object_name, "dropped": dropped_circles, "kept": len(all_detected_circles)},
+        )
+
+    circle_count = len(all_detected_circles)
+    METRICS.increment("circles", circle_count)
+
+    if circle_count == 0:
+        METRICS.increment("objects_without_circles")
+        logging.warning("job name: %s task: %i 0 circles detected in %s", job_name, task_index, object_name)
+
+    mosaic = None
+    packed = packer is not None and 0 < circle_count <= row_pack.PACK_MAX_TILES
+
+    if packed:
+        #: small documents share a mosaic and the packer uploads it once it is full
+        with METRICS.timer("mosaic_seconds"):
+            packer.add(object_name, all_detected_circles, crop_pages)
+
+        METRICS.increment("objects_packed")
+        logging.info("job name: %s task: %i packed %i circles from %s", job_name, task_index, circle_count, object_name)
+    else:
+        #: Process detected circle images into a mosaic
+        logging.info("job name: %s task: %i mosaicking images in %s", job_name, task_index, object_name)
+        mosaic_start = perf_counter()
+
+        with METRICS.timer("mosaic_seconds"):
+            mosaic = row_pack.build_mosaic_image(all_detected_circles, object_name, None, options.color_mode)
+
+        logging.info(
+            "job name: %s task: %i image mosaic time taken %s: %s",
+            job_name,
+            task_index,
+            object_name,
+            row.format_time(perf_counter() - mosaic_start),
+        )
+
+    logging.info(
+        "job name: %s task: %i total time taken for entire task %s",
+        job_name,
+        task_index,
+        row.format_time(perf_counter() - object_start),
+    )
+
+    if not packed and (upload or handle is not None):
+        manifest = row_pack.get_mosaic_manifest(f"{job_name}/mosaics/{object_name}", all_detected_circles, crop_pages)
+
+        if handle is not None:
+            handle(object_name, mosaic, manifest)
+        elif row_pack.upload_mosaic(mosaic, output_location, object_name, job_name, options.codec, options.quality):
+            row_pack.upload_manifest(manifest, output_location, object_name, job_name)
+
+    #: units without circles have no mosaic so every finished unit is recorded for `row_merge.merge_partial_mosaics`
+    if pages is not None and upload and handle is None:
+        row.get_storage_client().bucket(output_location).blob(
+            row_merge.get_unit_marker_name(object_name, job_name)
+        ).upload_from_string(b"")
+
+    METRICS.observe("object_seconds", perf_counter() - object_start)
+
+    peak_rss = row_render.get_peak_rss()
+    if peak_rss is not None:
+        METRICS.observe("object_peak_rss_bytes", peak_rss)
+        logging.info(
+            "job name: %s task: %i peak memory: %s", job_name, task_index, {"file": object_name, "bytes": peak_rss}
+        )
+
+    return mosaic
+
+
+def get_circles_from_image_bytes(
+    byte_img,
+    output_path,
+    file_name,
+    hash_index=None,
+    detector="hough",
+    triage=False,
+    decode_reduction=1,
+    parameters=None,
+):
+    """detect circles in an image (bytes) and export them as a list of cropped images
+
+    Args:
+        byte_img (bytes|np.ndarray): The encoded image or a decoded BGR image to detect circles in
+        output_path (Path): The output directory for cropped images of detected circles to be stored
+        file_name (str): The name of the file to be stored
+        hash_index (row_cache.PageHashIndex): optional index of pages already seen. known pages reuse their detections
+        detector (str): one of the `row_detect.CIRCLE_DETECTORS`
+        triage (bool): skip pages without candidate circles and only search the regions with them
+        decode_reduction (int): one of the `DECODE_REDUCTIONS` to detect on a smaller grayscale page
+        parameters (dict): the detection parameters from a profile. defaults to the `row_detect.DETECTION_PARAMETERS`
+    Returns:
+        list: a list of cv2 images
+    """
+    return detect_and_crop_circles(
+        byte_img, output_path, file_name, hash_index, detector, triage, decode_reduction, parameters
+    )[2]
+
+
+def detect_and_crop_circles(
+    byte_img,
+    output_path,
+    file_name,
+    hash_index=None,
+    detector="hough",
+    triage=False,
+    decode_reduction=1,
+    parameters=None,
+):
+    """detect circles in an image and crop them, keeping the detections. the arguments match
+    `get_circles_from_image_bytes`
+
+    Returns:
+        tuple(np.ndarray, int, list): the circles on the color page (or None), the inset distance in pixels and the
+                                      cropped cv2 images
+    """
+    page, detected_circles, inset = read_and_detect_circles(
+        byte_img, file_name, hash_index, detector, triage, decode_reduction, parameters
+    )
+
+    if page is None or detected_circles is None:
+        return detected_circles, inset, []
+
+    img = page.color()
+
+    if img is None:
+        return None, inset, []
+
+    [height, width, _] = img.shape
+
+    crops = export_circles_from_image(
+        detected_circles,
+        output_path,
+        file_name,
+        img,
+        height,
+        width,
+        inset,
+    )
+
+    return detected_circles, inset, crops
+
+
+class LazyPage:
+    """a page decoded in grayscale for detection. the color page is only decoded when it is needed for cropping, so
+    pages without circles never pay for a full color decode
+    """
+
+    def __init__(self, content, gray, reduction=1):
+        self.content = content
+        self.gray = gray
+        self.reduction = reduction
+        self._color = content if isinstance(content, np.ndarray) else None
+
+    def color(self):
+        """decode the full resolution color page
+
+        Returns:
+            np.ndarray: the BGR page or None when it can not be decoded
+        """
+        if self._color is None:
+            with METRICS.timer("color_decode_seconds"):
+                self._color = cv2.imdecode(np.frombuffer(self.content, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+            if self._color is None:
+                logging.error("unable to decode the color page")
+
+        return self._color
+
+    @property
+    def shape(self):
+        """the full resolution (height, width). estimated from the reduced page until the color page is decoded"""
+        if self._color is not None:
+            return self._color.shape[:2]
+
+        return self.gray.shape[0] * self.reduction, self.gray.shape[1] * self.reduction
+
+    def to_full_resolution(self, circles, inset):
+        """scale circles found on the reduced grayscale page to the color page, decoding it
+
+        Args:
+            circles (np.ndarray): the circles on the grayscale page or None
+            inset (int): the inset distance in grayscale pixels
+
+        Returns:
+            tuple(np.ndarray, int): the circles and inset on the color page
+        """
+        if circles is None or self.color() is None:
+            return circles, inset
+
+        scale = self._color.shape[0] / self.gray.shape[0]
+
+        if scale == 1:
+            return circles, inset
+
+        return circles * np.float32(scale), int(inset * scale)
+
+
+def decode_gray_page(byte_img, file_name, reduction=1):
+    """decode a page straight to grayscale for detection, optionally reduced
+
+    Args:
+        byte_img (bytes|np.ndarray): The encoded image or a decoded BGR image
+        file_name (str): The name of the file for logging
+        reduction (int): one of the `DECODE_REDUCTIONS`
+
+    Returns:
+        LazyPage: the page or None when it can not be read
+    """
+    if isinstance(byte_img, np.ndarray):
+        gray = byte_img if byte_img.ndim == 2 else cv2.cvtColor(byte_img, cv2.COLOR_BGR2GRAY)
+
+        if reduction > 1:
+            gray = cv2.resize(
+                gray,
+                (math.ceil(gray.shape[1] / reduction), math.ceil(gray.shape[0] / reduction)),
+                interpolation=cv2.INTER_AREA,
+            )
+
+        return LazyPage(byte_img, gray, reduction)
+
+    try:
+        with METRICS.timer("gray_decode_seconds"):
+            gray = cv2.imdecode(np.frombuffer(byte_img, dtype=np.uint8), DECODE_REDUCTIONS[reduction])
+    except Exception as ex:
+        logging.error("unable to read image from bytes: %s, %s", file_name, ex)
+
+        return None
+
+    if gray is None:
+        logging.error("unable to read image from bytes: %s", file_name)
+
+        return None
+
+    return LazyPage(byte_img, gray, reduction)
+
+
+def read_and_detect_circles(
+    byte_img, file_name, hash_index=None, detector="hough", triage=False, decode_reduction=1, parameters=None
+):
+    """decode a page in grayscale and detect its circles without cropping them. the color page is decoded only when
+    circles are found
+
+    Args:
+        byte_img (bytes|np.ndarray): The encoded image or a decoded BGR image to detect circles in
+        file_name (str): The name of the file for logging
+        hash_index (row_cache.PageHashIndex): optional index of pages already seen. known pages reuse their detections
+        detector (str): one of the `row_detect.CIRCLE_DETECTORS`
+        triage (bool): skip pages without candidate circles and only search the regions with them
+        decode_reduction (int): one of the `DECODE_REDUCTIONS` to detect on a smaller grayscale page
+        parameters (dict): the detection parameters from a profile. defaults to the `row_detect.DETECTION_PARAMETERS`
+
+    Returns:
+        tuple(LazyPage, np.ndarray, int): the page, the circles from cv2.HoughCircles (or None) and the inset
+                                           distance in pixels of the color page. the page is None when it can not be
+                                           read
+    """
+    page = decode_gray_page(byte_img, file_name, decode_reduction)
+
+    if page is None:
+        return None, None, 0
+
+    detection = None
+    signature = None
+
+    if hash_index is not None:
+        signature = row_cache.get_page_signature(page.gray)
+        detection = hash_index.lookup(signature)
+
+    if detection is None:
+        with METRICS.timer("hough_seconds"):
+            detected_circles, inset = row_detect.detect_circles(page.gray, detector, triage, parameters)
+
+        if hash_index is not None:
+            hash_index.record(signature, detected_circles, inset)
+    else:
+        detected_circles, inset = detection
+        DETAIL_LOG.info("reusing detections from a duplicate page: %s", file_name)
+
+    detected_circles, inset = page.to_full_resolution(detected_circles, inset)
+
+    return page, detected_circles, inset
+
+
+def convert_to_cv2_image(image):
+    """convert image (bytes) to a cv2 image object
+
+    Args:
+        image (bytes): The image (bytes) to convert
+
+    Returns:
+        cv2.Image: A cv2 image object
+    """
+    return cv2.imdecode(np.frombuffer(image, dtype=np.uint8), 1)  # 1 means flags=cv2.IMREAD_COLOR
+
+
+def export_circles_from_image(circles, out_dir, file_name, cv2_image, height, width, inset_distance):
+    """export detected circles from an image as jpegs to the out_dir
+
+        Args:
+            circles (array): Circle locations returned from cv2.HoughCircles algorithm
+            out_dir (Path): The output directory for cropped images of detected circles
+            file_name (str): The name of the image file
+            cv2_image (numpy.ndarray): The image as a numpy array
+            height (number): The height of original image
+            width (number): The width of original image
+            inset_distance (number): The inset distance in pixels to aid image cropping
+
+    Returns:
+        list: a list of cv2 images
+    """
+    if circles is None:
+        DETAIL_LOG.info("no circles detected for %s", file_name)
+
+        return []
+
+    #: round the values to the nearest integer
+    circles = np.around(circles).astype(int)
+
+    if out_dir:
+        if not out_dir.exists():
+            out_dir.mkdir(parents=True)
+
+    masked_images = []
+
+    for i, data in enumerate(circles[0, :]):  # type: ignore
+        center_x = int(data[0])
+        center_y = int(data[1])
+
+        #: inset the radius by number of pixels to remove the circle and noise
+        radius = max(int(data[2]) - inset_distance, 0)
+
+        #: crop image to the roi:
+        crop_x = min(max(center_x - radius - 20, 0), width)
+        crop_y = min(max(center_y - radius - 20, 0), height)
+        crop_height = 2 * radius + 40
+        crop_width = 2 * radius + 40
+
+        #: copy only the roi and mask it to white outside of the circle instead of masking a full page copy
+        masked_image = cv2_image[crop_y : crop_y + crop_height, crop_x : crop_x + crop_width].copy()
+        mask = np.zeros(masked_image.shape[:2], dtype=np.uint8)
+        cv2.circle(mask, (center_x - crop_x, center_y - crop_y), radius, 255, -1)
+        masked_image[mask == 0] = 255
+
+        if out_dir:
+            original_basename = Path(file_name).stem
+            out_file = out_dir / f"{original_basename}_{i}.jpg"
+            cv2.imwrite(str(out_file), masked_image)
+
+        masked_images.append(masked_image)
+
+    return masked_images
+
+
+def score_circle_crops(images, size=64):
+    """compute cheap text features for all of the circle crops of a page at once. the crops are resized to a common
+    size and stacked so the features are computed with array operations and a single connected components pass
+
+    Args:
+        images (list): the cv2 circle crops from `export_circles_from_image`
+        size (int): the side length in pixels the crops are resized to
+
+    Returns:
+        dict: `ink`, `components` and `edge_energy` arrays with a value for each crop
+    """
+    count = len(images)
+
+    if count == 0:
+        empty = np.zeros(0)
+
+        return {"ink": empty, "components": empty.astype(np.int64), "edge_energy": empty}
+
+    stack = np.empty((count, size, size), dtype=np.uint8)
+    for i, img in enumerate(images):
+        if img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+        stack[i] = cv2.resize(img, (size, size), interpolation=cv2.INTER_AREA)
+
+    ink_mask = stack < 128
+    ink = ink_mask.mean(axis=(1, 2))
+
+    pixels = stack.astype(np.int16)
+    edge_energy = np.abs(np.diff(pixels, axis=1)).mean(axis=(1, 2)) + np.abs(np.diff(pixels, axis=2)).mean(axis=(1, 2))
+
+    #: lay the ink masks side by side with a blank column between them so one labeling pass covers every crop
+    padded = np.zeros((count, size, size + 1), dtype=np.uint8)
+    padded[:, :, :size] = ink_mask
+    strip = padded.transpose(1, 0, 2).reshape(size, count * (size + 1))
+
+    labels, _, stats, _ = cv2.connectedComponentsWithStats(strip, connectivity=8)
+    owners = stats[1:labels, cv2.CC_STAT_LEFT] // (size + 1)
+    components = np.bincount(owners, minlength=count)
+
+    return {"ink": ink, "components": components, "edge_energy": edge_energy}
+
+
+def filter_circle_crops(images, thresholds=None):
+    """drop circle crops that are unlikely to contain a parcel number, like empty rings, solid stamps and noise
+
+    Args:
+        images (list): the cv2 circle crops from `export_circles_from_image`
+        thresholds (dict): overrides for `CROP_FILTER_THRESHOLDS`
+
+    Returns:
+        tuple(list, int): the crops to keep and the number of crops dropped
+    """
+    thresholds = {**CROP_FILTER_THRESHOLDS, **(thresholds or {})}
+    features = score_circle_crops(images)
+
+    keep = (
+        (features["ink"] >= thresholds["min_ink"])
+        & (features["ink"] <= thresholds["max_ink"])
+        & (features["components"] >= thresholds["min_components"])
+        & (features["components"] <= thresholds["max_components"])
+        & (features["edge_energy"] >= thresholds["min_edge_energy"])
+    )
+
+    kept = [image for image, passed in zip(images, keep) if passed]
+
+    return kept, len(images) - len(kept)
+
+
+def split_index_by_pages(bucket, entries, pages_per_unit=PAGES_PER_UNIT, min_bytes=SPLIT_MIN_BYTES):
+    """split the large pdfs and tiffs of an index into page range work units so a single document can be spread
+    across tasks. only documents of at least `min_bytes` are downloaded to count their pages
+
+    Args:
+        bucket (google.cloud.storage.Bucket): the bucket containing the documents
+        entries (list(str)): the index entries
+        pages_per_unit (int): the most pages in a work unit
+        min_bytes (int): the smallest document to split
+
+    Returns:
+        list(str): the index entries with the large documents replaced by their page ranges
+    """
+    units = []
+
+    for entry in entries:
+        entry = entry.strip()
+        object_name, pages = row.parse_work_unit(entry)
+
+        if not entry or pages is not None or Path(object_name).suffix.casefold() not in [".pdf", ".tif", ".tiff"]:
+            units.extend([entry] if entry else [])
+
+            continue
+
+        blob = bucket.get_blob(object_name)
+
+        if blob is None or (blob.size or 0) < min_bytes:
+            units.append(entry)
+
+            continue
+
+        page_count = row_render.count_document_pages(row.download_object(bucket, object_name), object_name)
+        document_units = row.split_into_page_ranges(object_name, page_count, pages_per_unit)
+
+        if len(document_units) > 1:
+            logging.info(
+                "split into page ranges: %s", {"file": object_name, "pages": page_count, "units": len(document_units)}
+            )
+
+        units.extend(document_units)
+
+    return units
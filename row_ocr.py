@@ -0,0 +1,699 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+"""
+UDOT Right of Way (ROW) Parcel Number Extraction
+The ocr job
+"""
+import json
+import logging
+import math
+from io import BytesIO
+from pathlib import Path
+from time import perf_counter
+from uuid import uuid4
+
+import google.cloud.documentai
+import pandas as pd
+from google.api_core import exceptions
+from google.api_core.client_options import ClientOptions
+from google.api_core.retry import Retry, if_exception_type
+
+import row
+import row_queue
+from row_metrics import METRICS
+
+#: the documentai client is created on first use by `get_ai_client`
+AI_CLIENT = None
+
+
+def _count_retry(_):
+    METRICS.increment("ocr_retries")
+
+
+#: the documentai client's default retry for process_document with every retried attempt counted
+OCR_RETRY = Retry(
+    initial=1.0,
+    maximum=90.0,
+    multiplier=9.0,
+    predicate=if_exception_type(
+        exceptions.DeadlineExceeded, exceptions.ResourceExhausted, exceptions.ServiceUnavailable
+    ),
+    timeout=300.0,
+    on_error=_count_retry,
+)
+
+#: the token confidence below which a tile is queued to be read again
+LOW_CONFIDENCE = 0.8
+
+#: the columns of the token files. the box is in mosaic pixels and tiles without tokens get one empty row with a 0
+#: confidence so a circle nothing was read from is read again too
+TOKEN_COLUMNS = ["mosaic", "tile", "file_name", "page", "text", "confidence", "left", "top", "right", "bottom"]
+
+#: the columns of the text each tile was given when it was read again
+REREAD_COLUMNS = ["mosaic", "tile", "text"]
+
+
+def ocr_all_mosaics(inputs):
+    """the code to run in the cloud run job
+
+    Args:
+        inputs (class): the inputs to the function
+            job_name (str): the name of the run job. typically named after an animal in alphabetical order
+            input_bucket (str): the bucket to get files from using the format `gs://bucket-name`
+            output_location (str): the location to save the results to. omit the `gs://` prefix
+            file_index (str): the path to the folder containing an `index.txt` file listing all the images in a bucket.
+                            `gs://bucket-name`
+            task_index (int): the index of the task running
+            task_count (int): the number of containers running the job
+            total_size (int): the total number of files to process
+            project_number (int): the number of the gcp project
+            processor_id (str): the id of the documentai processor
+
+    Returns:
+        A list of lists with the results of the OCR
+    """
+    METRICS.reset()
+
+    #: Get files to process for this job
+    files = row.get_files_from_index(inputs.file_index, inputs.task_index, inputs.task_count, inputs.total_size)
+    logging.info("job name: %s task: %i processing %s files", inputs.job_name, inputs.task_index, files)
+
+    #: Initialize GCP storage client and bucket
+    bucket = row.get_storage_client().bucket(inputs.input_bucket[5:])
+
+    ai_client = get_ai_client()
+
+    processor_name = ai_client.processor_path(inputs.project_number, "us", inputs.processor_id)
+    task_results = []
+    tokens = []
+
+    #: Iterate over objects to detect circles and perform OCR
+    for object_name in files:
+        result = ocr_object(bucket, ai_client, processor_name, object_name.rstrip(), inputs, tokens)
+
+        if result is not None:
+            task_results.extend(result)
+
+    upload_results(task_results, inputs.output_location, f"task-{inputs.task_index}", inputs.job_name)
+    upload_tokens(tokens, inputs.output_location, f"task-{inputs.task_index}", inputs.job_name)
+    row.emit_metrics("ocr", inputs.job_name, inputs.task_index, inputs.output_location)
+
+    return task_results
+
+
+def ocr_queued_mosaics(inputs, queue, seconds=None, batch_size=50):
+    """the code to run in a long running worker. mosaics are leased from the queue until it is drained or the time
+    budget runs out while the storage and documentai clients stay warm. the results are uploaded in batches and the
+    mosaics are only marked as done once their batch is saved
+
+    Args:
+        inputs (class): the inputs to the function. see `ocr_all_mosaics`, the index and task count are not used
+        queue (SqliteQueue|BucketQueue): the queue of mosaic names from `row.get_work_queue`
+        seconds (float): the time budget. None to run until the queue is drained
+        batch_size (int): the number of mosaics in each uploaded results file
+
+    Returns:
+        dict: the number of mosaics handled and failed and the seconds spent
+    """
+    METRICS.reset()
+
+    bucket = row.get_storage_client().bucket(inputs.input_bucket[5:])
+    ai_client = get_ai_client()
+    processor_name = ai_client.processor_path(inputs.project_number, "us", inputs.processor_id)
+
+    #: a worker id keeps the batches of a restarted worker from replacing the earlier ones
+    worker_id = uuid4().hex[:8]
+    results = []
+    tokens = []
+    batches = []
+
+    def handle(object_name):
+        result = ocr_object(bucket, ai_client, processor_name, object_name, inputs, tokens)
+
+        if result is not None:
+            results.extend(result)
+
+    def flush():
+        if results:
+            name = f"task-{inputs.task_index}-{worker_id}-{len(batches):04d}"
+            upload_results(results, inputs.output_location, name, inputs.job_name)
+            upload_tokens(tokens, inputs.output_location, name, inputs.job_name)
+            batches.append(name)
+            results.clear()
+            tokens.clear()
+
+    summary = row_queue.drain(
+        queue, handle, f"{inputs.job_name}-{inputs.task_index}", seconds, flush=flush, flush_every=batch_size
+    )
+
+    METRICS.increment("queue_items", summary["items"])
+    METRICS.increment("queue_items_failed", summary["failed"])
+    row.emit_metrics("ocr", inputs.job_name, inputs.task_index, inputs.output_location)
+
+    return summary
+
+
+def ocr_object(bucket, ai_client, processor_name, object_name, inputs, tokens=None):
+    """download a mosaic and read its text. the text of a packed mosaic is split back into a row for each document
+    with the token positions and the mosaic's manifest. the tokens are kept with the tile they were read from
+
+    Args:
+        bucket (google.cloud.storage.Bucket): the bucket containing the mosaic
+        ai_client (DocumentProcessorServiceClient): the documentai client
+        processor_name (str): the documentai processor path
+        object_name (str): the name of the mosaic
+        inputs (class): the job inputs with the `job_name` and `task_index` for logging
+        tokens (list): optional list the `TOKEN_COLUMNS` rows of the mosaic's tokens are added to
+
+    Returns:
+        list(list): the rows of file name and text or None when the ocr failed. a mosaic has one row named after
+                    itself and a packed mosaic has a row for each document in it
+    """
+    object_start = perf_counter()
+    image_content = row.download_object(bucket, object_name)
+
+    logging.info(
+        "job name: %s task: %i download finished %s: %s",
+        inputs.job_name,
+        inputs.task_index,
+        row.format_time(perf_counter() - object_start),
+        {"file": object_name},
+    )
+
+    document = read_mosaic_text(ai_client, processor_name, object_name, image_content, inputs)
+
+    if document is None:
+        return None
+
+    METRICS.observe("object_seconds", perf_counter() - object_start)
+
+    try:
+        manifest = json.loads(row.download_object(bucket, row.get_manifest_name(object_name)))
+    except exceptions.NotFound:
+        #: mosaics from before manifests were written. their tokens are kept without tiles
+        manifest = None
+
+    if tokens is not None:
+        tokens.extend(get_token_rows(document, object_name, manifest))
+
+    return get_result_rows(document, object_name, manifest)
+
+
+def read_mosaic_text(ai_client, processor_name, object_name, content, inputs):
+    """read the text of an encoded mosaic. failed requests are logged and counted instead of raised
+
+    Args:
+        ai_client (DocumentProcessorServiceClient): the documentai client
+        processor_name (str): the documentai processor path
+        object_name (str): the name of the mosaic for logging
+        content (bytes): the encoded mosaic
+        inputs (class): the job inputs with the `job_name` and `task_index` for logging
+
+    Returns:
+        Document: the documentai document or None when the ocr failed
+    """
+    ocr_start = perf_counter()
+    try:
+        result = ocr_image_bytes(ai_client, processor_name, content)
+        METRICS.observe("ocr_seconds", perf_counter() - ocr_start)
+        logging.info(
+            "job name: %s task: %i ocr finished %s: %s",
+            inputs.job_name,
+            inputs.task_index,
+            row.format_time(perf_counter() - ocr_start),
+            {"file": object_name},
+        )
+    except (exceptions.RetryError, exceptions.InternalServerError) as error:
+        METRICS.increment("ocr_retries_exhausted" if isinstance(error, exceptions.RetryError) else "ocr_server_errors")
+        logging.warning(
+            "job name: %s task %i: ocr failed on %s. %s",
+            inputs.job_name,
+            inputs.task_index,
+            object_name,
+            error.message,
+        )
+
+        return None
+    except (exceptions.InvalidArgument) as error:
+        METRICS.increment("ocr_invalid_arguments")
+        logging.warning(
+            "job name: %s task %i: ocr failed on %s. %s\n%s",
+            inputs.job_name,
+            inputs.task_index,
+            object_name,
+            error.message,
+            error.details,
+        )
+
+        return None
+
+    METRICS.increment("ocr_documents")
+
+    return result.document
+
+
+def get_result_rows(document, object_name, manifest=None):
+    """turn the text of a mosaic into result rows
+
+    Args:
+        document (Document): the documentai document of the mosaic
+        object_name (str): the name of the mosaic in its bucket
+        manifest (dict): the manifest of the mosaic. only the tiles of a packed mosaic are split into documents
+
+    Returns:
+        list(list): one row named after the mosaic or a row for each document in a packed mosaic
+    """
+    if manifest is not None and row.is_packed_mosaic(object_name):
+        rows = split_packed_text(document, manifest)
+        METRICS.increment("packed_documents", len(rows))
+
+        return rows
+
+    return [[object_name, document.text]]
+
+
+def split_packed_text(document, manifest):
+    """split the text of a packed mosaic into the documents its tiles came from. each token goes to the tile nearest
+    its center and the text of a document is the text of its tiles in mosaic order
+
+    Args:
+        document (Document): the documentai document of the packed mosaic
+        manifest (dict): the packed mosaic's manifest with the `width`, `height` and the `file_name`, `page` and
+                         `box` of each tile
+
+    Returns:
+        list(list): a row of file name and text for each document in the mosaic
+    """
+    tiles = manifest["tiles"]
+    texts = [[] for _ in tiles]
+
+    for tile, text, _, _ in read_tokens(document, manifest):
+        texts[tile].append(text)
+
+    documents = {}
+    for tile, text in zip(tiles, texts):
+        documents.setdefault(tile["file_name"], []).append("".join(text).strip())
+
+    return [[file_name, "\n".join(text for text in parts if text)] for file_name, parts in documents.items()]
+
+
+def read_tokens(document, manifest=None):
+    """read the tokens of a mosaic and the tile nearest each token's center
+
+    Args:
+        document (Document): the documentai document of the mosaic
+        manifest (dict): the mosaic's manifest. the tile is -1 without one
+
+    Returns:
+        generator: (tile, text, confidence, box) for each token with the box in mosaic pixels
+    """
+    tiles = manifest["tiles"] if manifest else []
+
+    for page in getattr(document, "pages", None) or []:
+        if manifest:
+            width, height = manifest["width"], manifest["height"]
+        else:
+            dimension = getattr(page, "dimension", None)
+            width, height = (dimension.width, dimension.height) if dimension else (1, 1)
+
+        for token in page.tokens:
+            box = get_token_box(token.layout, width, height)
+            x, y = (box[0] + box[2]) / 2, (box[1] + box[3]) / 2
+            tile = -1
+
+            if tiles:
+                distances = [get_box_distance(item["box"], x, y) for item in tiles]
+                tile = distances.index(min(distances))
+
+            text = "".join(
+                document.text[int(segment.start_index) : int(segment.end_index)]
+                for segment in token.layout.text_anchor.text_segments
+            )
+
+            yield tile, text, float(getattr(token.layout, "confidence", 0.0) or 0.0), box
+
+
+def get_token_rows(document, mosaic_name, manifest=None):
+    """keep the text, confidence and box of every token of a mosaic with the tile it was read from
+
+    Args:
+        document (Document): the documentai document of the mosaic
+        mosaic_name (str): the mosaic blob name
+        manifest (dict): the mosaic's manifest
+
+    Returns:
+        list(list): the `TOKEN_COLUMNS` rows
+    """
+    tiles = manifest["tiles"] if manifest else []
+    rows = []
+    read = set()
+
+    for tile, text, confidence, box in read_tokens(document, manifest):
+        file_name, page = (tiles[tile]["file_name"], tiles[tile]["page"]) if tile >= 0 else (mosaic_name, None)
+        rows.append([mosaic_name, tile, file_name, page, text.strip(), confidence, *box])
+        read.add(tile)
+
+    for index, tile in enumerate(tiles):
+        if index not in read:
+            rows.append([mosaic_name, index, tile["file_name"], tile["page"], "", 0.0, *tile["box"]])
+
+    return rows
+
+
+def get_token_box(layout, width, height):
+    """get the bounding box of a token in mosaic pixels
+
+    Args:
+        layout (Layout): the documentai token layout
+        width (int): the mosaic width for normalized vertices
+        height (int): the mosaic height for normalized vertices
+
+    Returns:
+        list(float): the left, top, right and bottom
+    """
+    polygon = layout.bounding_poly
+    vertices = [(vertex.x * width, vertex.y * height) for vertex in polygon.normalized_vertices]
+
+    if not vertices:
+        vertices = [(vertex.x, vertex.y) for vertex in polygon.vertices]
+
+    if not vertices:
+        return [0.0, 0.0, 0.0, 0.0]
+
+    xs = [x for x, _ in vertices]
+    ys = [y for _, y in vertices]
+
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+
+def get_box_distance(box, x, y):
+    """the distance from a point to a box. 0 inside the box
+
+    Args:
+        box (list): the left, top, right and bottom of the box
+        x (float): the point x
+        y (float): the point y
+
+    Returns:
+        float: the distance in pixels
+    """
+    left, top, right, bottom = box
+
+    return math.hypot(max(left - x, 0, x - right), max(top - y, 0, y - bottom))
+
+
+def get_ai_client():
+    """get the documentai client, creating it the first time it is needed
+
+    Returns:
+        DocumentProcessorServiceClient: the documentai client
+    """
+    global AI_CLIENT  # pylint: disable=global-statement
+
+    if AI_CLIENT is None:
+        options = ClientOptions(api_endpoint="us-documentai.googleapis.com")
+        AI_CLIENT = google.cloud.documentai.DocumentProcessorServiceClient(client_options=options)
+
+    return AI_CLIENT
+
+
+def ocr_image_bytes(ai_client, processor_name, content):
+    """send an encoded image to the documentai processor. the mime type is read from the image bytes so mosaics
+    encoded with any of the `MOSAIC_CODECS` are described correctly
+
+    Args:
+        ai_client (DocumentProcessorServiceClient): the documentai client
+        processor_name (str): the full path of the documentai processor
+        content (bytes|bytearray): the encoded image
+
+    Returns:
+        ProcessResponse: the documentai response
+    """
+    #: documentai only accepts bytes. a downloaded mosaic can be the bytearray its chunks were assembled in. mosaics
+    #: are limited to `row_pack.MAX_MOSAIC_PIXELS` so the copy stays small
+    raw_document = google.cloud.documentai.RawDocument(content=bytes(content), mime_type=get_mime_type(content))
+    request = google.cloud.documentai.ProcessRequest(name=processor_name, raw_document=raw_document)
+
+    return ai_client.process_document(request=request, retry=OCR_RETRY)
+
+
+def get_ocr_text_function(project_number, processor_id):
+    """create a function that returns the documentai text for encoded image bytes
+
+    Args:
+        project_number (int): the number of the gcp project
+        processor_id (str): the id of the documentai processor
+
+    Returns:
+        callable: a function taking the encoded bytes and returning the ocr text
+    """
+    ai_client = get_ai_client()
+
+    processor_name = ai_client.processor_path(project_number, "us", processor_id)
+
+    def ocr(content):
+        return ocr_image_bytes(ai_client, processor_name, content).document.text
+
+    return ocr
+
+
+def get_mime_type(content):
+    """sniff the mime type of an encoded image from its signature
+
+    Args:
+        content (bytes): the encoded image
+
+    Returns:
+        str: the mime type of the image. jpeg is assumed for unknown signatures
+    """
+    if content[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+
+    if content[:4] in (b"II*\x00", b"MM\x00*"):
+        return "image/tiff"
+
+    return "image/jpeg"
+
+
+def upload_results(data, bucket_name, out_name, job_name):
+    """upload results dataframe to a GCP bucket as a gzip file
+
+    Args:
+        data (list): a list containing the results for the task (a list of lists. the first index being the file name
+                     and the second being the text found)
+        bucket_name (str): the name of the destination bucket
+        out_name (str): the name of the gzip file
+
+    Returns:
+        nothing
+    """
+    file_name = f"{job_name}/{out_name}.gz"
+    logging.info("uploading %s to %s/%s", out_name, bucket_name, file_name)
+
+    bucket = row.get_storage_client().bucket(bucket_name)
+    new_blob = bucket.blob(file_name)
+
+    frame = pd.DataFrame(data, columns=["file_name", "text"])
+
+    with BytesIO() as parquet:
+        frame.to_parquet(parquet, compression="gzip")
+
+        new_blob.upload_from_string(parquet.getvalue(), content_type="application/gzip")
+
+
+def upload_tokens(data, bucket_name, out_name, job_name):
+    """upload the token rows of a task next to its results as a parquet file
+
+    Args:
+        data (list): the `TOKEN_COLUMNS` rows from `get_token_rows`
+        bucket_name (str): the name of the destination bucket
+        out_name (str): the name of the task's results file
+        job_name (str): the name of the run job
+    """
+    file_name = f"{job_name}/tokens/{out_name}.parquet"
+    logging.info("uploading %i tokens to %s/%s", len(data), bucket_name, file_name)
+
+    frame = pd.DataFrame(data, columns=TOKEN_COLUMNS)
+
+    with BytesIO() as parquet:
+        frame.to_parquet(parquet, compression="gzip")
+
+        row.get_storage_client().bucket(bucket_name).blob(file_name).upload_from_string(
+            parquet.getvalue(), content_type="application/octet-stream"
+        )
+
+
+def upload_reread_tiles(data, bucket_name, out_name, job_name):
+    """upload the text of the tiles read again next to the run's tokens as a parquet file
+
+    Args:
+        data (list): the `REREAD_COLUMNS` rows of each tile read again
+        bucket_name (str): the name of the destination bucket
+        out_name (str): the name of the batch of tiles
+        job_name (str): the name of the run job whose tiles were read again
+    """
+    file_name = f"{job_name}/reocr/{out_name}.parquet"
+    logging.info("uploading %i tiles to %s/%s", len(data), bucket_name, file_name)
+
+    frame = pd.DataFrame(data, columns=REREAD_COLUMNS)
+
+    with BytesIO() as parquet:
+        frame.to_parquet(parquet, compression="gzip")
+
+        row.get_storage_client().bucket(bucket_name).blob(file_name).upload_from_string(
+            parquet.getvalue(), content_type="application/octet-stream"
+        )
+
+
+def load_tokens(bucket_name, job_name):
+    """read the token files of a run
+
+    Args:
+        bucket_name (str): the bucket holding the run's output. omit the `gs://` prefix
+        job_name (str): the name of the run job
+
+    Returns:
+        pd.DataFrame: the `TOKEN_COLUMNS` of every task
+    """
+    frames = [
+        pd.read_parquet(BytesIO(blob.download_as_bytes()))
+        for blob in row.get_storage_client().list_blobs(bucket_name, prefix=f"{job_name}/tokens/")
+        if blob.name.endswith(".parquet")
+    ]
+
+    if not frames:
+        return pd.DataFrame(columns=TOKEN_COLUMNS)
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def select_low_confidence_tiles(tokens, threshold=LOW_CONFIDENCE):
+    """find the tiles whose least confident token is below the threshold
+
+    Args:
+        tokens (pd.DataFrame): the token rows from `load_tokens`
+        threshold (float): the confidence a tile's tokens must all reach
+
+    Returns:
+        list(str): the tiles as queue items from `row.format_tile_item` in mosaic and tile order
+    """
+    tiles = tokens[tokens["tile"] >= 0].groupby(["mosaic", "tile"], sort=True)["confidence"].min()
+
+    return [
+        row.format_tile_item(mosaic, int(tile))
+        for (mosaic, tile), confidence in tiles.items()
+        if confidence < threshold
+    ]
+
+
+def merge_partial_results(frame):
+    """combine the text of the partial mosaics of a document split into page ranges into one row named after the
+    document. the text is joined in page order and the rows of whole documents are kept as they are
+
+    Args:
+        frame (pd.DataFrame): the results with `file_name` and `text` columns
+
+    Returns:
+        pd.DataFrame: the results with one row for each document
+    """
+    units = frame["file_name"].astype(str).map(row.parse_work_unit)
+    frame = frame.assign(
+        file_name=units.map(lambda unit: unit[0]),
+        first_page=units.map(lambda unit: unit[1][0] if unit[1] else 0),
+        text=frame["text"].fillna(""),
+    )
+
+    merged = (
+        frame.sort_values(["file_name", "first_page"], kind="stable")
+        .groupby("file_name", sort=False)["text"]
+        .agg("\n".join)
+        .reset_index()
+    )
+
+    return merged[["file_name", "text"]]
+
+
+def replace_reread_tiles(frame, tokens, reread):
+    """replace the text of the tiles that were read again. the text of a document with a tile that was read again is
+    rebuilt from the tokens of its tiles in mosaic order with the second read in place of the first one. tiles read as
+    empty the second time keep their first text
+
+    Args:
+        frame (pd.DataFrame): the results with `file_name` and `text` columns
+        tokens (pd.DataFrame): the `TOKEN_COLUMNS` rows of the run
+        reread (pd.DataFrame): the `REREAD_COLUMNS` rows of the tiles read again
+
+    Returns:
+        pd.DataFrame: the results with the text of the documents with tiles that were read again replaced
+    """
+    reread = reread[reread["text"].fillna("") != ""]
+    tokens = tokens[tokens["tile"] >= 0]
+
+    if reread.empty or tokens.empty:
+        return frame
+
+    tiles = tokens.groupby(["mosaic", "tile"], sort=True).agg(
+        file_name=("file_name", "first"), text=("text", lambda texts: " ".join(text for text in texts if text))
+    )
+    second = reread.assign(tile=reread["tile"].astype(int)).groupby(["mosaic", "tile"])["text"].last()
+    second = second[second.index.isin(tiles.index)]
+    tiles.loc[second.index, "text"] = second
+
+    documents = set(tiles.loc[second.index, "file_name"])
+    texts = (
+        tiles[tiles["file_name"].isin(documents)]
+        .groupby("file_name", sort=False)["text"]
+        .agg(lambda parts: "\n".join(part for part in parts if part))
+    )
+
+    replaced = frame["file_name"].isin(texts.index)
+    frame = frame.copy()
+    frame.loc[replaced, "text"] = frame.loc[replaced, "file_name"].map(texts)
+
+    return frame
+
+
+def merge_run_results(folder, output):
+    """merge the partial results in the result files of a run downloaded with `row.download_run` into one file. the
+    text of the tiles read again by `row_reocr.reocr_queued_tiles` replaces the text they were first read with
+
+    Args:
+        folder (str): the folder with the run's `.gz` parquet result files and its `tokens` and `reocr` folders
+        output (str): the folder to write the merged `results.gz` file to
+
+    Returns:
+        dict: the number of rows before and after the merge, the tiles read again and the merged file
+    """
+    folder = Path(folder)
+    files = sorted(folder.glob("*.gz"))
+
+    if not files:
+        raise FileNotFoundError(f"no result files in {folder}")
+
+    frame = pd.concat([pd.read_parquet(path, columns=["file_name", "text"]) for path in files], ignore_index=True)
+    reread = [pd.read_parquet(path, columns=REREAD_COLUMNS) for path in sorted(folder.glob("reocr/*.parquet"))]
+
+    if reread:
+        reread = pd.concat(reread, ignore_index=True)
+        tokens = [pd.read_parquet(path, columns=TOKEN_COLUMNS) for path in sorted(folder.glob("tokens/*.parquet"))]
+
+        if not tokens:
+            raise FileNotFoundError(f"no token files in {folder} for the tiles read again")
+
+        frame = replace_reread_tiles(frame, pd.concat(tokens, ignore_index=True), reread)
+
+    merged = merge_partial_results(frame)
+
+    output = Path(output)
+    output.mkdir(parents=True, exist_ok=True)
+    merged.to_parquet(output / "results.gz", compression="gzip")
+
+    summary = {
+        "rows": len(frame),
+        "documents": len(merged),
+        "reread tiles": len(reread),
+        "file": str(output / "results.gz"),
+    }
+    logging.info("merged the partial results of %s: %s", folder, summary)
+
+    return summary
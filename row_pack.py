@@ -0,0 +1,490 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+"""
+UDOT Right of Way (ROW) Parcel Number Extraction
+Building, packing and encoding the mosaics. the crops of a document are placed on a grid, or packed with the crops
+of other small documents, and the mosaics are encoded and uploaded with a manifest of their tiles
+"""
+
+import difflib
+import json
+import logging
+import math
+from io import BytesIO
+from pathlib import Path
+from time import perf_counter
+from uuid import uuid4
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import row
+from row_metrics import METRICS
+
+#: the mosaic color modes and the codecs they can be encoded with
+COLOR_MODES = ("color", "gray", "binary")
+MOSAIC_CODECS = {
+    "jpg": "image/jpeg",
+    "png": "image/png",
+    "tiff-lzw": "image/tiff",
+    "tiff-ccitt": "image/tiff",
+}
+
+#: the most pixels in a mosaic. larger mosaics are not built and partial mosaics are not merged past it
+MAX_MOSAIC_PIXELS = 40_000_000
+
+#: documents with at most this many crops are packed into shared mosaics when packing is on. documents with more
+#: crops fill a mosaic of their own
+PACK_MAX_TILES = 25
+
+#: the color mode, codec and jpeg quality combinations compared by `benchmark_mosaic_encodings`
+BENCHMARK_ENCODINGS = [
+    ("color", "jpg", 95),
+    ("gray", "jpg", 95),
+    ("gray", "jpg", 75),
+    ("gray", "png", None),
+    ("gray", "tiff-lzw", None),
+    ("binary", "png", None),
+    ("binary", "tiff-lzw", None),
+    ("binary", "tiff-ccitt", None),
+]
+
+
+def build_mosaic_image(images, object_name, out_dir, color_mode="color"):
+    """build a mosaic image from a list of cv2 images
+
+    Args:
+        images (list): list of cv2 images to mosaic together
+        object_name (str): the name of the image object (original filename)
+        out_dir (Path): location to save the result
+        color_mode (str): one of `COLOR_MODES`. gray and binary mosaics are built with a single band and binary
+                          mosaics are adaptively thresholded to black ink on white
+
+    Returns:
+        mosaic_image (np.ndarray): composite mosaic of smaller images
+    """
+    if images is None or len(images) == 0:
+        logging.info("no images to mosaic for %s", object_name)
+
+        return np.array(None)
+
+    object_path = Path(object_name)
+    boxes, total_width, total_height = get_grid_layout(images)
+
+    logging.info(
+        "mosaicking %i images into %i by %i pixel grid, %s",
+        len(images),
+        total_width,
+        total_height,
+        {"file name": object_name, "color mode": color_mode},
+    )
+
+    if total_height * total_width > MAX_MOSAIC_PIXELS:
+        logging.error('mosaic image size is too large: "%s"', object_name)
+
+        return np.array(None)
+
+    single_band = color_mode != "color"
+
+    if single_band:
+        mosaic_image = np.full((total_height, total_width), 255, dtype=np.uint8)
+    else:
+        mosaic_image = np.full((total_height, total_width, 3), 255, dtype=np.uint8)
+
+    for img, (left, top, right, bottom) in zip(images, boxes):
+        if single_band and img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        elif not single_band and img.ndim == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+
+        mosaic_image[top:bottom, left:right] = img
+
+    if color_mode == "binary":
+        mosaic_image = binarize_image(mosaic_image)
+
+    if out_dir:
+        if not out_dir.exists():
+            out_dir.mkdir(parents=True)
+
+        mosaic_outfile = out_dir / f"{object_path.stem}.jpg"
+        logging.info("saving to %s", mosaic_outfile)
+        cv2.imwrite(str(mosaic_outfile), mosaic_image)
+
+    else:
+        return mosaic_image
+
+
+def get_grid_layout(images, buffer=5):
+    """place images in the square cells of a grid with about as many rows as columns. every cell is as wide as the
+    largest image dimension plus a white buffer on each side
+
+    Args:
+        images (list): the cv2 images
+        buffer (int): the white border around each image
+
+    Returns:
+        tuple(list, int, int): the (left, top, right, bottom) box of each image and the grid width and height
+    """
+    max_dim = max(max(img.shape[:2]) for img in images)
+
+    #: Set up parameters for mosaic, calculate number of cols/rows
+    number_columns = math.floor(math.sqrt(len(images)))
+    number_rows = math.ceil(len(images) / number_columns)
+    tile_width = max_dim + 2 * buffer
+
+    boxes = []
+    for i, img in enumerate(images):
+        img_height, img_width = img.shape[:2]
+        top = (i // number_columns) * tile_width + buffer
+        left = (i % number_columns) * tile_width + buffer
+        boxes.append([left, top, left + img_width, top + img_height])
+
+    return boxes, tile_width * number_columns, tile_width * number_rows
+
+
+def get_mosaic_manifest(file_name, images, pages):
+    """describe the tiles of a mosaic built by `build_mosaic_image` in the manifest format of the packed mosaics
+
+    Args:
+        file_name (str): the name of the mosaic's ocr result row, `job/mosaics/file.pdf`
+        images (list): the crops in the mosaic
+        pages (list): the page number of each crop
+
+    Returns:
+        dict: the manifest with the mosaic `width`, `height` and the `file_name`, `page` and `box` of each tile
+    """
+    if not images:
+        return {"version": 1, "width": 0, "height": 0, "tiles": []}
+
+    boxes, width, height = get_grid_layout(images)
+
+    return {
+        "version": 1,
+        "width": width,
+        "height": height,
+        "tiles": [{"file_name": file_name, "page": page, "box": box} for page, box in zip(pages, boxes)],
+    }
+
+
+class MosaicPacker:
+    """pack the crops of many small documents into shared mosaics so they are read with one ocr request. the tiles
+    are placed on shelves of a fixed width and a mosaic is uploaded with its manifest before a document would push it
+    past the pixel budget. the crops of a document always stay in one mosaic. a `handle` function called with the
+    mosaic name, image and manifest replaces the upload
+    """
+
+    #: the white border around each tile
+    buffer = 5
+
+    def __init__(self, job_name, task_index, output_location, options, handle=None):
+        self.job_name = job_name
+        self.output_location = output_location
+        self.options = options
+        self.handle = handle
+        self.width = math.isqrt(options.pack_pixels)
+        self.name = f"{task_index}-{uuid4().hex[:8]}"
+        self.tiles = []
+        self.mosaics = 0
+
+    def add(self, object_name, crops, pages):
+        """add the crops of a document, uploading the current mosaic first when they do not fit
+
+        Args:
+            object_name (str): the document or work unit name
+            crops (list): the circle crops
+            pages (list): the page number of each crop
+        """
+        tiles = [{"file_name": object_name, "page": page, "crop": crop} for crop, page in zip(crops, pages)]
+
+        if self.tiles and self._layout(self.tiles + tiles) is None:
+            self.flush()
+
+        self.tiles.extend(tiles)
+
+    def flush(self):
+        """build the mosaic and its manifest and upload or handle them
+
+        Returns:
+            str: the mosaic name or None when there were no tiles
+        """
+        if not self.tiles:
+            return None
+
+        boxes, height = self._layout(self.tiles) or self._layout(self.tiles, limit=False)
+        width = max(self.width, max(box[2] for box in boxes) + self.buffer)
+        single_band = self.options.color_mode != "color"
+        shape = (height, width) if single_band else (height, width, 3)
+        mosaic = np.full(shape, 255, dtype=np.uint8)
+
+        for tile, (left, top, right, bottom) in zip(self.tiles, boxes):
+            crop = tile["crop"]
+
+            if single_band and crop.ndim == 3:
+                crop = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+            elif not single_band and crop.ndim == 2:
+                crop = cv2.cvtColor(crop, cv2.COLOR_GRAY2BGR)
+
+            mosaic[top:bottom, left:right] = crop
+
+        if self.options.color_mode == "binary":
+            mosaic = binarize_image(mosaic)
+
+        name = f"{row.PACKED_MOSAIC_FOLDER}/{self.name}-{self.mosaics:04d}.{self.options.codec.split('-')[0]}"
+        manifest = {
+            "version": 1,
+            "width": width,
+            "height": height,
+            "tiles": [
+                {"file_name": f"{self.job_name}/mosaics/{tile['file_name']}", "page": tile["page"], "box": box}
+                for tile, box in zip(self.tiles, boxes)
+            ],
+        }
+
+        if self.handle is not None:
+            self.handle(name, mosaic, manifest)
+        else:
+            upload_mosaic(mosaic, self.output_location, name, self.job_name, self.options.codec, self.options.quality)
+            upload_manifest(manifest, self.output_location, name, self.job_name)
+
+        METRICS.increment("packed_mosaics")
+        METRICS.observe("documents_per_packed_mosaic", len({tile["file_name"] for tile in self.tiles}))
+        logging.info(
+            "finished packed mosaic %s: %s",
+            name,
+            {"tiles": len(self.tiles), "documents": len({tile["file_name"] for tile in self.tiles}), "height": height},
+        )
+
+        self.tiles = []
+        self.mosaics += 1
+
+        return name
+
+    def _layout(self, tiles, limit=True):
+        """place the tiles left to right on shelves as tall as their tallest tile
+
+        Returns:
+            tuple(list, int): the (left, top, right, bottom) box of each tile and the mosaic height or None when the
+                              tiles do not fit in the pixel budget
+        """
+        boxes = []
+        left = top = shelf = 0
+
+        for tile in tiles:
+            height, width = tile["crop"].shape[:2]
+
+            if left and left + width + 2 * self.buffer > self.width:
+                top += shelf
+                left = shelf = 0
+
+            box = [left + self.buffer, top + self.buffer, left + self.buffer + width, top + self.buffer + height]
+            boxes.append(box)
+
+            left += width + 2 * self.buffer
+            shelf = max(shelf, height + 2 * self.buffer)
+
+            if limit and (top + shelf) * self.width > self.options.pack_pixels:
+                return None
+
+        return boxes, top + shelf
+
+
+def binarize_image(image):
+    """adaptively threshold a single band image to black ink on a white background
+
+    Args:
+        image (np.ndarray): the single band image
+
+    Returns:
+        np.ndarray: the image with only 0 and 255 values
+    """
+    return cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 15)
+
+
+def encode_mosaic(image, codec="jpg", quality=95):
+    """encode a mosaic image with one of the `MOSAIC_CODECS`
+
+    Args:
+        image (np.ndarray): the mosaic image
+        codec (str): the codec to encode with. ccitt tiffs are thresholded to 1 bit
+        quality (int): the jpeg quality from 0 to 100. ignored by the other codecs
+
+    Returns:
+        tuple(bytes, str): the encoded image and its mime type. the bytes are `None` when encoding fails
+    """
+    mime_type = MOSAIC_CODECS[codec]
+
+    if codec == "tiff-ccitt":
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+        bilevel = Image.fromarray(image).point(lambda value: 255 if value > 127 else 0, mode="1")
+
+        with BytesIO() as byte_array:
+            bilevel.save(byte_array, format="TIFF", compression="group4")
+
+            return byte_array.getvalue(), mime_type
+
+    if codec == "png":
+        extension = ".png"
+        parameters = [cv2.IMWRITE_PNG_COMPRESSION, 9]
+
+        if image.ndim == 2 and not np.any((image != 0) & (image != 255)):
+            parameters.extend([cv2.IMWRITE_PNG_BILEVEL, 1])
+    elif codec == "tiff-lzw":
+        extension = ".tif"
+        parameters = [cv2.IMWRITE_TIFF_COMPRESSION, 5]
+    else:
+        extension = ".jpg"
+        parameters = [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
+
+    is_success, buffer = cv2.imencode(extension, image, parameters)
+
+    if not is_success:
+        return None, mime_type
+
+    return buffer.tobytes(), mime_type
+
+
+def upload_mosaic(image, bucket_name, object_name, job_name, codec="jpg", quality=95):
+    """upload mosaic image to a GCP bucket with the mime type of the codec
+
+    Args:
+        image (np.array): the mosaic image bytes
+        bucket_name (str): the name of the destination bucket
+        object_name (str): the name of the image object (original filename)
+        codec (str): one of the `MOSAIC_CODECS`
+        quality (int): the jpeg quality
+
+    Returns:
+        bool: True if successful, False otherwise
+    """
+    content, mime_type = prepare_mosaic(image, object_name, codec, quality)
+
+    if content is None:
+        return False
+
+    upload_mosaic_content(content, mime_type, bucket_name, object_name, job_name)
+
+    return True
+
+
+def prepare_mosaic(image, object_name, codec="jpg", quality=95):
+    """encode a mosaic for uploading or reading
+
+    Args:
+        image (np.array): the mosaic image
+        object_name (str): the name of the image object (original filename)
+        codec (str): one of the `MOSAIC_CODECS`
+        quality (int): the jpeg quality
+
+    Returns:
+        tuple(bytes, str): the encoded mosaic and its mime type. the bytes are `None` when there is no mosaic or it
+                           could not be encoded
+    """
+    if image is None or not image.any():
+        logging.info('no mosaic image created or uploaded: "%s"', object_name)
+
+        return None, None
+
+    with METRICS.timer("encode_seconds"):
+        content, mime_type = encode_mosaic(image, codec, quality)
+
+    if content is None:
+        logging.error("unable to encode image: %s", object_name)
+
+    return content, mime_type
+
+
+def upload_mosaic_content(content, mime_type, bucket_name, object_name, job_name):
+    """upload an encoded mosaic to a GCP bucket
+
+    Args:
+        content (bytes): the encoded mosaic from `prepare_mosaic`
+        mime_type (str): the mime type of the codec
+        bucket_name (str): the name of the destination bucket
+        object_name (str): the name of the image object (original filename)
+        job_name (str): the name of the run job
+    """
+    file_name = f"{job_name}/mosaics/{object_name}"
+    logging.info("uploading %s to %s/%s", object_name, bucket_name, file_name)
+
+    bucket = row.get_storage_client().bucket(bucket_name)
+    new_blob = bucket.blob(str(file_name))
+
+    new_blob.upload_from_string(content, content_type=mime_type)
+    METRICS.observe("mosaic_encoded_bytes", len(content))
+
+
+def upload_manifest(manifest, bucket_name, mosaic_name, job_name):
+    """upload the manifest of a mosaic next to the job's mosaics
+
+    Args:
+        manifest (dict): the manifest from `get_mosaic_manifest` or `MosaicPacker.flush`
+        bucket_name (str): the name of the destination bucket
+        mosaic_name (str): the name of the mosaic in the job's mosaics folder
+        job_name (str): the name of the run job
+    """
+    row.get_storage_client().bucket(bucket_name).blob(
+        row.get_manifest_name(f"{job_name}/mosaics/{mosaic_name}")
+    ).upload_from_string(json.dumps(manifest), content_type="application/json")
+
+
+def benchmark_mosaic_encodings(images, object_name, ocr=None, encodings=None):
+    """compare the size, encode time and optionally the ocr text of a mosaic built with different color modes and
+    codecs. the first encoding is the reference for the ocr text agreement
+
+    Args:
+        images (list): list of cv2 images to mosaic together
+        object_name (str): the name of the image object (original filename)
+        ocr (callable): optional function that takes the encoded bytes and returns the ocr text
+        encodings (list): (color mode, codec, quality) tuples. defaults to `BENCHMARK_ENCODINGS`
+
+    Returns:
+        list(dict): a result for each encoding
+    """
+    if encodings is None:
+        encodings = BENCHMARK_ENCODINGS
+
+    results = []
+    reference_text = None
+
+    for color_mode, codec, quality in encodings:
+        build_start = perf_counter()
+        mosaic = build_mosaic_image(images, object_name, None, color_mode)
+        build_time = perf_counter() - build_start
+
+        if mosaic is None or mosaic.ndim == 0:
+            continue
+
+        encode_start = perf_counter()
+        content, mime_type = encode_mosaic(mosaic, codec, quality or 95)
+        encode_time = perf_counter() - encode_start
+
+        if content is None:
+            continue
+
+        result = {
+            "file": object_name,
+            "color mode": color_mode,
+            "codec": codec,
+            "quality": quality,
+            "mime type": mime_type,
+            "pixel bytes": mosaic.nbytes,
+            "bytes": len(content),
+            "build seconds": build_time,
+            "encode seconds": encode_time,
+        }
+
+        if ocr is not None:
+            text = ocr(content)
+
+            if reference_text is None:
+                reference_text = text
+
+            result["text"] = text
+            result["agreement"] = difflib.SequenceMatcher(None, reference_text, text).ratio()
+
+        results.append(result)
+
+    return results
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+"""
+UDOT Right of Way (ROW) Parcel Number Extraction
+An inverted index from the parcel numbers in the ocr text of a run to the mosaics that mention them
+"""
+
+import json
+import logging
+import re
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+#: parcel numbers are up to 5 digits with an optional letter and an optional `:` suffix like 15, 0015, 15A or 15:2E.
+#: leading zeros are dropped so 0015 and 15 are the same parcel. spaces around the colon are removed first
+PARCEL_PATTERN = r"(?<![\w:])0*(\d{1,5}[A-Z]?(?::\d?[A-Z]{1,2}\d?)?)(?![\w:])"
+COLON_PATTERN = r"\s*:\s*"
+
+#: the bytes of the longest parcel number the pattern finds
+PARCEL_BYTES = 12
+
+#: the version of the index layout and tokenizer. indexes built by another version are rebuilt
+INDEX_VERSION = 1
+
+INDEX_FOLDER = "parcel-index"
+
+
+def find_parcel_numbers(text):
+    """find the normalized parcel numbers in a block of text
+
+    Args:
+        text (str): the ocr text
+
+    Returns:
+        list(str): the parcel numbers in the order they appear
+    """
+    return re.findall(PARCEL_PATTERN, re.sub(COLON_PATTERN, ":", str(text).upper()))
+
+
+def build_parcel_index(folder, output=None):
+    """build the inverted index for the result files of a run downloaded with `row.download_run`. the index is a few
+    sorted arrays saved as .npy files so a lookup memory maps them and binary searches without reading the index
+
+    Args:
+        folder (str): the folder with the run's `.gz` parquet result files
+        output (str): the folder to write the index to. defaults to `parcel-index` in the run folder
+
+    Returns:
+        dict: the manifest of the index
+    """
+    folder = Path(folder)
+    output = Path(output) if output else folder / INDEX_FOLDER
+    files = sorted(folder.glob("*.gz"))
+
+    if not files:
+        raise FileNotFoundError(f"no result files in {folder}")
+
+    start = perf_counter()
+    tokens = []
+    documents = []
+    file_ids = []
+    rows = []
+    names = []
+    base = 0
+
+    for file_id, path in enumerate(files):
+        frame = pd.read_parquet(path, columns=["file_name", "text"]).reset_index(drop=True)
+
+        found = (
+            frame["text"]
+            .fillna("")
+            .str.upper()
+            .str.replace(COLON_PATTERN, ":", regex=True)
+            .str.findall(PARCEL_PATTERN)
+            .explode()
+            .dropna()
+        )
+
+        tokens.append(found.to_numpy(dtype=f"S{PARCEL_BYTES}"))
+        documents.append(found.index.to_numpy(dtype=np.int64) + base)
+        file_ids.append(np.full(len(frame), file_id, dtype=np.int32))
+        rows.append(np.arange(len(frame), dtype=np.int32))
+        names.extend(frame["file_name"].astype(str))
+        base += len(frame)
+
+        logging.info("indexed %s: %s", path.name, {"rows": len(frame), "parcel numbers": len(found)})
+
+    tokens = np.concatenate(tokens)
+    documents = np.concatenate(documents)
+
+    #: sort the (parcel, document) pairs and drop the documents that mention a parcel more than once
+    parcels, parcel_ids = np.unique(tokens, return_inverse=True)
+    order = np.lexsort((documents, parcel_ids))
+    parcel_ids = parcel_ids[order]
+    documents = documents[order]
+    keep = np.ones(len(order), dtype=bool)
+    keep[1:] = (parcel_ids[1:] != parcel_ids[:-1]) | (documents[1:] != documents[:-1])
+
+    offsets = np.zeros(len(parcels) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(parcel_ids[keep], minlength=len(parcels)), out=offsets[1:])
+
+    encoded_names = [name.encode("utf-8") for name in names]
+    name_offsets = np.zeros(len(encoded_names) + 1, dtype=np.int64)
+    np.cumsum([len(name) for name in encoded_names], out=name_offsets[1:])
+
+    output.mkdir(parents=True, exist_ok=True)
+    np.save(output / "parcels.npy", parcels.astype(f"S{PARCEL_BYTES}"))
+    np.save(output / "offsets.npy", offsets)
+    np.save(output / "postings.npy", documents[keep].astype(np.int32))
+    np.save(output / "files.npy", np.concatenate(file_ids))
+    np.save(output / "rows.npy", np.concatenate(rows))
+    np.save(output / "name_offsets.npy", name_offsets)
+    (output / "names.bin").write_bytes(b"".join(encoded_names))
+
+    manifest = {
+        "version": INDEX_VERSION,
+        "files": [path.name for path in files],
+        "documents": base,
+        "parcels": len(parcels),
+        "postings": int(keep.sum()),
+        "seconds": perf_counter() - start,
+    }
+    (output / "manifest.json").write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+
+    logging.info("built the parcel index in %s: %s", output, manifest)
+
+    return manifest
+
+
+class ParcelIndex:
+    """a read only view of an index from `build_parcel_index`. the arrays are memory mapped so opening the index and
+    a lookup only read the pages of the files they touch
+    """
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        self.manifest = json.loads((self.folder / "manifest.json").read_text(encoding="utf-8"))
+
+        if self.manifest.get("version") != INDEX_VERSION:
+            raise ValueError(f"the parcel index in {self.folder} is out of date, build it again")
+
+        self.parcels = np.load(self.folder / "parcels.npy", mmap_mode="r")
+        self.offsets = np.load(self.folder / "offsets.npy", mmap_mode="r")
+        self.postings = np.load(self.folder / "postings.npy", mmap_mode="r")
+        self.files = np.load(self.folder / "files.npy", mmap_mode="r")
+        self.rows = np.load(self.folder / "rows.npy", mmap_mode="r")
+        self.name_offsets = np.load(self.folder / "name_offsets.npy", mmap_mode="r")
+        self.names = np.memmap(self.folder / "names.bin", dtype=np.uint8, mode="r") if self.name_offsets[-1] else None
+
+    def lookup(self, parcel):
+        """find the mosaics whose text mentions a parcel number
+
+        Args:
+            parcel (str): the parcel number. it is normalized like the ocr text, so 0015 finds 15
+
+        Returns:
+            list(dict): the mosaic `file_name`, the results `file` and the `row` in that file for each mention
+        """
+        numbers = find_parcel_numbers(parcel)
+
+        if len(numbers) != 1:
+            raise ValueError(f"not a parcel number: {parcel}")
+
+        key = numbers[0].encode("utf-8")
+        position = int(np.searchsorted(self.parcels, key))
+
+        if position == len(self.parcels) or self.parcels[position] != key:
+            return []
+
+        return [
+            {
+                "file_name": self.name(document),
+                "file": self.manifest["files"][self.files[document]],
+                "row": int(self.rows[document]),
+            }
+            for document in self.postings[self.offsets[position] : self.offsets[position + 1]]
+        ]
+
+    def name(self, document):
+        """get the mosaic name of a document
+
+        Args:
+            document (int): the document id
+
+        Returns:
+            str: the mosaic file name from the results
+        """
+        start, end = self.name_offsets[document], self.name_offsets[document + 1]
+
+        return bytes(self.names[start:end]).decode("utf-8") if end > start else ""
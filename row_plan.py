@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+"""
+UDOT Right of Way (ROW) Parcel Number Extraction
+Plan a run before launching it. a sample of the index stratified by document type and size is rendered and detected
+locally and the measurements are scaled up to the whole index to recommend the task count and task resources
+"""
+
+import logging
+import math
+import random
+import resource
+from os import path
+from pathlib import Path
+from time import perf_counter, process_time
+
+import row
+import row_mosaic
+import row_pack
+import row_render
+from row_metrics import METRICS
+
+#: the upper bounds of the document size classes in megabytes. larger documents are in the last class
+SIZE_CLASSES_MB = (1, 10, 50)
+
+#: the number of documents rendered and detected to plan a run
+SAMPLE_SIZE = 30
+
+#: the share added to the measured runtime and memory for the documents and pages the sample did not see
+HEADROOM = 1.25
+
+#: the most tasks a cloud run job can run
+MAX_TASKS = 10_000
+
+#: the cloud run memory limits in GiB and the fewest cpus each one needs
+MEMORY_LIMITS = ((0.5, 1), (1, 1), (2, 1), (4, 1), (8, 2), (16, 4), (24, 6), (32, 8))
+
+#: the list prices in usd used for the cost estimate. the cloud run job prices are per second of an allocated cpu
+#: and GiB of memory and the ocr price is per page. each mosaic is one page
+CPU_SECOND_PRICE = 0.000018
+GIB_SECOND_PRICE = 0.000002
+OCR_PAGE_PRICE = 0.0015
+
+
+def get_size_class(size):
+    """name the size class of a document
+
+    Args:
+        size (int): the document size in bytes. None when it is unknown
+
+    Returns:
+        str: the size class
+    """
+    if size is None:
+        return "unknown"
+
+    lower = 0
+    for upper in SIZE_CLASSES_MB:
+        if size < upper * 1024 * 1024:
+            return f"{lower}-{upper}MB"
+
+        lower = upper
+
+    return f"{lower}MB+"
+
+
+def get_document_sizes(bucket, entries):
+    """read the size of each document in an index by listing the bucket instead of requesting every document
+
+    Args:
+        bucket (google.cloud.storage.Bucket): the bucket containing the documents
+        entries (list(str)): the index entries
+
+    Returns:
+        dict: the size in bytes of each document name that was found
+    """
+    names = {row.parse_work_unit(entry)[0] for entry in entries}
+    prefix = path.commonprefix(sorted(names)) if names else ""
+
+    return {blob.name: blob.size for blob in bucket.list_blobs(prefix=prefix) if blob.name in names}
+
+
+def get_strata(entries, sizes):
+    """group the index entries by document type and size class. page range work units are their own type
+
+    Args:
+        entries (list(str)): the index entries
+        sizes (dict): the document sizes from `get_document_sizes`
+
+    Returns:
+        dict: the entries of each (type, size class)
+    """
+    strata = {}
+
+    for entry in entries:
+        object_name, pages = row.parse_work_unit(entry)
+        kind = Path(object_name).suffix.casefold() or "none"
+
+        if pages is not None:
+            kind = f"{kind} pages"
+
+        strata.setdefault((kind, get_size_class(sizes.get(object_name))), []).append(entry)
+
+    return strata
+
+
+def sample_strata(strata, sample_size=SAMPLE_SIZE, seed=0):
+    """sample each stratum in proportion to its share of the index. every stratum gets at least one document so the
+    rare types and sizes are still measured
+
+    Args:
+        strata (dict): the entries of each stratum from `get_strata`
+        sample_size (int): the number of documents to sample
+        seed (int): the random seed
+
+    Returns:
+        dict: the sampled entries of each stratum
+    """
+    total = sum(len(entries) for entries in strata.values())
+    generator = random.Random(seed)
+    samples = {}
+
+    for key in sorted(strata):
+        entries = strata[key]
+        count = min(len(entries), max(1, round(sample_size * len(entries) / total)))
+        samples[key] = generator.sample(entries, count)
+
+    return samples
+
+
+def measure_entry(bucket, entry, options):
+    """render, detect and mosaic one index entry the way the mosaic job does without uploading anything
+
+    Args:
+        bucket (google.cloud.storage.Bucket): the bucket containing the documents
+        entry (str): the index entry
+        options (SimpleNamespace): the mosaic options from `row_mosaic.get_mosaic_options`
+
+    Returns:
+        dict: the seconds, cpu seconds, peak memory, pages, circles, mosaic bytes and ocr requests of the entry
+    """
+    measurement = {"mosaic bytes": 0, "ocr requests": 0.0}
+
+    def handle(mosaic_name, mosaic, _):
+        content, _ = row_pack.prepare_mosaic(mosaic, mosaic_name, options.codec, options.quality)
+
+        if content is None:
+            return
+
+        measurement["mosaic bytes"] = len(content)
+        measurement["ocr requests"] = 1.0
+
+        #: a packed document shares its request with the other documents in its mosaic
+        if options.pack_pixels and METRICS.counters.get("circles", 0) <= row_pack.PACK_MAX_TILES:
+            measurement["ocr requests"] = min(mosaic.shape[0] * mosaic.shape[1] / options.pack_pixels, 1.0)
+
+    METRICS.reset()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_start = process_time() + children.ru_utime + children.ru_stime
+    start = perf_counter()
+
+    row_mosaic.mosaic_object(bucket, entry, "plan", 0, None, options, handle=handle)
+
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    measurement["seconds"] = perf_counter() - start
+    measurement["cpu seconds"] = process_time() + children.ru_utime + children.ru_stime - cpu_start
+    measurement["peak rss bytes"] = row_render.get_peak_rss() or 0
+    measurement["pages"] = METRICS.counters.get("pages", 0)
+    measurement["circles"] = METRICS.counters.get("circles", 0)
+
+    return measurement
+
+
+def extrapolate(strata, measurements):
+    """scale the mean of each stratum's measurements up to the number of entries in the stratum
+
+    Args:
+        strata (dict): the entries of each stratum
+        measurements (dict): the measurements of each stratum's sampled entries
+
+    Returns:
+        dict: the estimated totals of the index and the estimate of each stratum
+    """
+    totals = dict.fromkeys(("seconds", "cpu seconds", "pages", "circles", "mosaic bytes", "ocr requests"), 0.0)
+    breakdown = []
+
+    for key, entries in sorted(strata.items()):
+        sampled = measurements.get(key) or []
+
+        if not sampled:
+            continue
+
+        estimate = {"type": key[0], "size": key[1], "entries": len(entries), "sampled": len(sampled)}
+
+        for name in totals:
+            estimate[name] = sum(measurement[name] for measurement in sampled) / len(sampled) * len(entries)
+            totals[name] += estimate[name]
+
+        estimate["slowest seconds"] = max(measurement["seconds"] for measurement in sampled)
+        breakdown.append(estimate)
+
+    all_sampled = [measurement for sampled in measurements.values() for measurement in sampled]
+    totals["peak rss bytes"] = max((measurement["peak rss bytes"] for measurement in all_sampled), default=0)
+    totals["slowest seconds"] = max((measurement["seconds"] for measurement in all_sampled), default=0.0)
+
+    return {"totals": totals, "strata": breakdown}
+
+
+def recommend_resources(totals, entries, target_seconds):
+    """choose the task count and task resources that finish the mosaic job in the target time
+
+    Args:
+        totals (dict): the estimated totals from `extrapolate`
+        entries (int): the number of index entries
+        target_seconds (float): the wall clock time the job should finish in
+
+    Returns:
+        dict: the tasks, cpus and memory per task, the expected wall clock time and cost and any warnings
+    """
+    warnings = []
+    seconds = totals["seconds"] * HEADROOM
+    tasks = min(max(1, math.ceil(seconds / target_seconds)), MAX_TASKS, max(entries, 1))
+
+    if totals["slowest seconds"] * HEADROOM > target_seconds:
+        warnings.append(
+            f"the slowest sampled document takes {totals['slowest seconds']:.0f} seconds. split the large documents "
+            "into page ranges with `storage split-index` to finish in the target time"
+        )
+
+    if tasks == MAX_TASKS and seconds / tasks > target_seconds:
+        warnings.append(f"{MAX_TASKS} tasks can not finish in the target time")
+
+    memory_gib = totals["peak rss bytes"] * HEADROOM / 1024**3
+    memory_limit, minimum_cpus = next(
+        ((limit, cpus) for limit, cpus in MEMORY_LIMITS if limit >= memory_gib), MEMORY_LIMITS[-1]
+    )
+
+    if memory_gib > MEMORY_LIMITS[-1][0]:
+        warnings.append(f"the peak memory of {memory_gib:.1f}GiB is over the largest task. lower --memory-budget")
+
+    #: the cpus the stages kept busy. opencv threads and the pdf renderer can use more than one
+    busy_cpus = totals["cpu seconds"] / totals["seconds"] if totals["seconds"] else 1.0
+    cpus = min(max(minimum_cpus, math.ceil(busy_cpus - 0.25)), 8)
+
+    task_seconds = seconds / tasks
+    mosaic_cost = tasks * task_seconds * (cpus * CPU_SECOND_PRICE + memory_limit * GIB_SECOND_PRICE)
+    ocr_cost = math.ceil(totals["ocr requests"]) * OCR_PAGE_PRICE
+
+    return {
+        "tasks": tasks,
+        "cpus": cpus,
+        "memory": f"{memory_limit:g}Gi" if memory_limit >= 1 else f"{int(memory_limit * 1024)}Mi",
+        "task seconds": task_seconds,
+        "mosaic cost usd": mosaic_cost,
+        "ocr cost usd": ocr_cost,
+        "warnings": warnings,
+    }
+
+
+def plan_run(input_bucket, entries, options=None, sample_size=SAMPLE_SIZE, target_seconds=3600, seed=0):
+    """estimate the cost and runtime of a run from a stratified sample of its index
+
+    Args:
+        input_bucket (str): the bucket to get files from using the format `gs://bucket-name`
+        entries (list(str)): the index entries
+        options (SimpleNamespace): the mosaic options from `row_mosaic.get_mosaic_options`. the defaults are used when
+                                   omitted
+        sample_size (int): the number of documents to measure
+        target_seconds (float): the wall clock time the mosaic job should finish in
+        seed (int): the random seed for the sample
+
+    Returns:
+        dict: the estimated totals, the estimate of each stratum and the recommended `TOTAL_FILES`, task count and
+              task resources
+    """
+    if options is None:
+        options = row_mosaic.get_mosaic_options()
+
+    entries = [entry.strip() for entry in entries if entry.strip()]
+
+    if not entries:
+        raise ValueError("there are no entries in the index to plan")
+
+    bucket = row.get_storage_client().bucket(input_bucket[5:])
+    strata = get_strata(entries, get_document_sizes(bucket, entries))
+    samples = sample_strata(strata, sample_size, seed)
+    start = perf_counter()
+
+    measurements = {}
+    for key, sampled in samples.items():
+        measurements[key] = [measure_entry(bucket, entry, options) for entry in sampled]
+
+    estimate = extrapolate(strata, measurements)
+    recommendation = recommend_resources(estimate["totals"], len(entries), target_seconds)
+
+    logging.info(
+        "planned %i entries from %i samples in %.1f seconds: %s",
+        len(entries),
+        sum(len(sampled) for sampled in samples.values()),
+        perf_counter() - start,
+        recommendation,
+    )
+
+    return {"total files": len(entries), **estimate, "recommendation": recommendation}
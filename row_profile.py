@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+"""
+UDOT Right of Way (ROW) Parcel Number Extraction
+Opt in cpu and memory profiling of the objects that are slow or memory hungry
+"""
+
+import cProfile
+import io
+import logging
+import pstats
+import tracemalloc
+from contextlib import contextmanager
+from time import perf_counter
+
+#: the profiler for the object being processed. `checkpoint` is a no-op when it is None
+ACTIVE_PROFILER = None
+
+
+class ObjectProfiler:
+    """profile the cpu time and python allocations of a single object. the report is only built when the object
+    exceeds one of the thresholds
+    """
+
+    def __init__(self, object_name, seconds, memory_mb, top=25):
+        self.object_name = object_name
+        self.seconds_threshold = seconds
+        self.memory_threshold = memory_mb * 1024 * 1024
+        self.top = top
+        self.profile = cProfile.Profile()
+        self.seconds = 0.0
+        self.peak = 0
+        self.snapshot = None
+        self.snapshot_size = 0
+        self.report = None
+        self._start = 0.0
+
+    def start(self):
+        """start profiling"""
+        tracemalloc.start()
+        self._start = perf_counter()
+        self.profile.enable()
+
+    def stop(self):
+        """stop profiling and build the report when a threshold is exceeded"""
+        self.profile.disable()
+        self.seconds = perf_counter() - self._start
+        self.checkpoint()
+        self.peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        if self.seconds >= self.seconds_threshold or self.peak >= self.memory_threshold:
+            self.report = self.build_report()
+
+        self.snapshot = None
+
+    def checkpoint(self):
+        """keep a snapshot of the allocations if more memory is in use than at the last checkpoint. call this where
+        the large allocations are still alive, like after rendering a page
+        """
+        current = tracemalloc.get_traced_memory()[0]
+
+        if current > self.snapshot_size:
+            self.snapshot = tracemalloc.take_snapshot().filter_traces(
+                (
+                    tracemalloc.Filter(False, tracemalloc.__file__),
+                    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                )
+            )
+            self.snapshot_size = current
+
+    def build_report(self):
+        """describe the cpu hotspots and the largest allocations
+
+        Returns:
+            str: the report
+        """
+        output = io.StringIO()
+        output.write(f"object: {self.object_name}\n")
+        output.write(f"seconds: {self.seconds:.2f} (threshold {self.seconds_threshold})\n")
+        output.write(
+            f"peak traced memory: {self.peak / 1024 / 1024:.1f} MB "
+            f"(threshold {self.memory_threshold / 1024 / 1024:.0f} MB)\n\n"
+        )
+
+        output.write(f"top {self.top} functions by cumulative time\n")
+        stats = pstats.Stats(self.profile, stream=output)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top)
+
+        if self.snapshot is not None:
+            output.write(f"top {self.top} allocations at {self.snapshot_size / 1024 / 1024:.1f} MB in use\n")
+
+            for statistic in self.snapshot.statistics("lineno")[: self.top]:
+                output.write(f"{statistic}\n")
+
+        return output.getvalue()
+
+
+@contextmanager
+def profile_object(object_name, options):
+    """profile the block when profiling is enabled in the options
+
+    Args:
+        object_name (str): the name of the object being processed
+        options (SimpleNamespace): the mosaic options with `profile`, `profile_seconds`, `profile_memory_mb` and
+                                   `profile_top`
+
+    Yields:
+        ObjectProfiler: the profiler or None when profiling is disabled. its `report` is set after the block when a
+                        threshold was exceeded
+    """
+    global ACTIVE_PROFILER  # pylint: disable=global-statement
+
+    if not getattr(options, "profile", False):
+        yield None
+
+        return
+
+    profiler = ObjectProfiler(object_name, options.profile_seconds, options.profile_memory_mb, options.profile_top)
+    ACTIVE_PROFILER = profiler
+    profiler.start()
+
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        ACTIVE_PROFILER = None
+
+        if profiler.report is not None:
+            logging.warning(
+                "profiled a slow object: %s",
+                {"file": object_name, "seconds": round(profiler.seconds, 2), "peak bytes": profiler.peak},
+            )
+
+
+def checkpoint():
+    """record the allocations of the active profiler, if there is one"""
+    if ACTIVE_PROFILER is not None:
+        ACTIVE_PROFILER.checkpoint()
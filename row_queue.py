@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+"""
+UDOT Right of Way (ROW) Parcel Number Extraction
+Work queues for long running workers that lease objects until the queue is drained or their time runs out
+"""
+
+import json
+import logging
+import sqlite3
+import zlib
+from collections import deque
+from pathlib import Path
+from time import perf_counter, time
+from urllib.parse import quote, unquote
+from uuid import uuid4
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+#: the seconds a worker holds an item before another worker may take it over
+LEASE_SECONDS = 1800
+
+#: the number of times an item is leased before it is marked as failed
+MAX_ATTEMPTS = 3
+
+#: the seconds a bucket queue worker keeps its list of retryable items before it lists the leases again
+RETRY_SCAN_SECONDS = 60
+
+
+class SqliteQueue:
+    """a queue kept in a local sqlite database. sqlite locks the file so workers on the same machine or a shared disk
+    can lease from it at the same time
+    """
+
+    def __init__(self, path, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        self.path = Path(path)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        #: autocommit so the lease transaction can take the write lock before it reads
+        self.connection = sqlite3.connect(str(self.path), timeout=60, isolation_level=None)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            "name TEXT PRIMARY KEY, state TEXT NOT NULL DEFAULT 'pending', worker TEXT, expires REAL, "
+            "attempts INTEGER NOT NULL DEFAULT 0)"
+        )
+
+    def add(self, names):
+        """add items to the queue. items already in the queue are left as they are
+
+        Args:
+            names (iterable): the object names
+
+        Returns:
+            int: the number of items added
+        """
+        before = self.connection.total_changes
+
+        self.connection.execute("BEGIN IMMEDIATE")
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO items (name) VALUES (?)", ((name,) for name in _clean_names(names))
+        )
+        self.connection.execute("COMMIT")
+
+        return self.connection.total_changes - before
+
+    def lease(self, worker):
+        """take the next pending item or an item whose lease expired
+
+        Args:
+            worker (str): the name of the worker taking the item
+
+        Returns:
+            str: the object name or None when there is nothing left to lease
+        """
+        now = time()
+
+        self.connection.execute("BEGIN IMMEDIATE")
+
+        try:
+            self.connection.execute(
+                "UPDATE items SET state = 'failed' WHERE state = 'leased' AND expires < ? AND attempts >= ?",
+                (now, self.max_attempts),
+            )
+            item = self.connection.execute(
+                "SELECT name FROM items WHERE state = 'pending' OR (state = 'leased' AND expires < ?) "
+                "ORDER BY rowid LIMIT 1",
+                (now,),
+            ).fetchone()
+
+            if item is not None:
+                self.connection.execute(
+                    "UPDATE items SET state = 'leased', worker = ?, expires = ?, attempts = attempts + 1 "
+                    "WHERE name = ?",
+                    (worker, now + self.lease_seconds, item[0]),
+                )
+        finally:
+            self.connection.execute("COMMIT")
+
+        return None if item is None else item[0]
+
+    def complete(self, name):
+        """mark a leased item as done
+
+        Args:
+            name (str): the object name
+        """
+        self.connection.execute("UPDATE items SET state = 'done', expires = NULL WHERE name = ?", (name,))
+
+    def fail(self, name):
+        """give a leased item back so it is retried or mark it as failed once it has used all of its attempts
+
+        Args:
+            name (str): the object name
+        """
+        self.connection.execute(
+            "UPDATE items SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, expires = NULL "
+            "WHERE name = ?",
+            (self.max_attempts, name),
+        )
+
+    def counts(self):
+        """count the items in each state
+
+        Returns:
+            dict: the pending, leased, done and failed counts
+        """
+        counts = dict.fromkeys(("pending", "leased", "done", "failed"), 0)
+        counts.update(self.connection.execute("SELECT state, COUNT(*) FROM items GROUP BY state").fetchall())
+
+        return counts
+
+    def close(self):
+        """close the database"""
+        self.connection.close()
+
+
+class BucketQueue:
+    """a queue kept in a cloud storage bucket. the item names are stored in a few list blobs and each lease is a blob
+    that can only be created once, so two workers can never hold the same attempt of an item. workers try the items
+    in a different order to avoid racing for the same ones. once a worker reaches the items another worker leased it
+    skips the leased items instead of trying each one. expired or failed items are retried once the rest are leased
+    """
+
+    def __init__(self, client, location, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        bucket_name, _, prefix = location[5:].partition("/")
+
+        self.bucket = client.bucket(bucket_name)
+        self.prefix = f"{prefix.rstrip('/')}/" if prefix else ""
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.candidates = None
+        self.retries = deque()
+        self.scanned = None
+        self.listed = None
+        self.attempts = {}
+
+    def add(self, names):
+        """add items to the queue as a new list blob
+
+        Args:
+            names (iterable): the object names
+
+        Returns:
+            int: the number of items added
+        """
+        names = list(_clean_names(names))
+
+        if names:
+            self.bucket.blob(f"{self.prefix}items/{uuid4().hex}.txt").upload_from_string(
+                "".join(f"{name}\n" for name in names), content_type="text/plain"
+            )
+
+        return len(names)
+
+    def lease(self, worker):
+        """take the next item no worker has leased. once every item is leased, take over an expired or failed one
+
+        Args:
+            worker (str): the name of the worker taking the item
+
+        Returns:
+            str: the object name or None when there is nothing left to lease
+        """
+        if self.candidates is None:
+            names = self._names()
+            offset = zlib.crc32(worker.encode("utf-8")) % len(names) if names else 0
+            self.candidates = deque(names[offset:] + names[:offset])
+
+        while self.candidates:
+            name = self.candidates.popleft()
+
+            if self._claim(name, 1, worker):
+                return name
+
+            #: another worker leased the item so this worker has reached its items. trying each of them would cost a
+            #: request per item for every worker so the leased items are listed and skipped. the listing is reused
+            #: like the retry scan so workers racing for the same items do not list the leases on every item
+            if self.listed is None or time() - self.listed >= RETRY_SCAN_SECONDS:
+                leased = {key.rpartition(".")[0] for key in self._keys("leases/")}
+                self.candidates = deque(candidate for candidate in self.candidates if candidate not in leased)
+                self.listed = time()
+
+        #: listing the leases costs a request per item so the scan is reused until it runs out and goes stale
+        if not self.retries and (self.scanned is None or time() - self.scanned >= RETRY_SCAN_SECONDS):
+            self.retries.extend(self._retryable().items())
+            self.scanned = time()
+
+        while self.retries:
+            name, attempt = self.retries.popleft()
+
+            if self._claim(name, attempt + 1, worker):
+                return name
+
+        return None
+
+    def complete(self, name):
+        """mark a leased item as done
+
+        Args:
+            name (str): the object name
+        """
+        self.bucket.blob(f"{self.prefix}done/{quote(name, safe='')}").upload_from_string(b"")
+
+    def fail(self, name):
+        """release the lease on an item so it is retried, or mark it as failed once it has used all of its attempts
+
+        Args:
+            name (str): the object name
+        """
+        attempt = self.attempts.get(name, 1)
+        key = quote(name, safe="")
+
+        if attempt >= self.max_attempts:
+            self.bucket.blob(f"{self.prefix}failed/{key}").upload_from_string(b"")
+        else:
+            self.bucket.blob(f"{self.prefix}released/{key}.{attempt}").upload_from_string(b"")
+            self.retries.append((name, attempt))
+
+    def counts(self):
+        """count the items in each state
+
+        Returns:
+            dict: the pending, leased, done and failed counts
+        """
+        names = set(self._names())
+        done = self._keys("done/")
+        failed = self._keys("failed/")
+        leased = {key.rpartition(".")[0] for key in self._keys("leases/")}
+
+        return {
+            "pending": len(names - leased),
+            "leased": len(leased - done - failed),
+            "done": len(done),
+            "failed": len(failed),
+        }
+
+    def close(self):
+        """nothing to close. the storage client is shared"""
+
+    def _names(self):
+        names = []
+
+        for blob in self.bucket.list_blobs(prefix=f"{self.prefix}items/"):
+            names.extend(blob.download_as_bytes().decode("utf-8").splitlines())
+
+        return list(dict.fromkeys(name for name in names if name))
+
+    def _keys(self, folder):
+        return {
+            unquote(blob.name[len(self.prefix) + len(folder) :])
+            for blob in self.bucket.list_blobs(prefix=f"{self.prefix}{folder}")
+        }
+
+    def _claim(self, name, attempt, worker):
+        lease = json.dumps({"worker": worker, "expires": time() + self.lease_seconds})
+
+        try:
+            self.bucket.blob(f"{self.prefix}leases/{quote(name, safe='')}.{attempt}").upload_from_string(
+                lease, content_type="application/json", if_generation_match=0
+            )
+        except PreconditionFailed:
+            return False
+
+        self.attempts[name] = attempt
+
+        return True
+
+    def _retryable(self):
+        """find the items whose latest lease expired or was released and that have attempts left"""
+        finished = self._keys("done/") | self._keys("failed/")
+        released = self._keys("released/")
+        latest = {}
+
+        for blob in self.bucket.list_blobs(prefix=f"{self.prefix}leases/"):
+            key, _, attempt = blob.name[len(self.prefix) + len("leases/") :].rpartition(".")
+            name = unquote(key)
+
+            if name not in finished and int(attempt) > latest.get(name, (0, None))[0]:
+                latest[name] = (int(attempt), blob)
+
+        retryable = {}
+
+        for name, (attempt, blob) in latest.items():
+            if attempt >= self.max_attempts:
+                continue
+
+            if f"{quote(name, safe='')}.{attempt}" in released:
+                retryable[name] = attempt
+
+                continue
+
+            try:
+                expires = json.loads(blob.download_as_bytes()).get("expires", 0)
+            except (NotFound, ValueError):
+                continue
+
+            if expires < time():
+                retryable[name] = attempt
+
+        return retryable
+
+
+def _clean_names(names):
+    return (name.strip() for name in names if name.strip())
+
+
+def get_queue(location, client=None, lease_seconds=LEASE_SECONDS):
+    """create a work queue for a local sqlite file or a cloud storage location. Cloud storage locations must start
+    with `gs://` and can include a prefix, `gs://bucket-name/prefix`
+
+    Args:
+        location (str): the sqlite file or bucket location
+        client (google.cloud.storage.Client): the storage client for bucket locations
+        lease_seconds (float): the seconds a worker holds an item before another worker may take it over
+
+    Returns:
+        SqliteQueue|BucketQueue: the queue
+    """
+    if location.startswith("gs://"):
+        if client is None:
+            raise ValueError("a storage client is required for bucket locations")
+
+        logging.info("using bucket queue %s", location)
+
+        return BucketQueue(client, location, lease_seconds)
+
+    logging.info("using sqlite queue %s", location)
+
+    return SqliteQueue(location, lease_seconds)
+
+
+def drain(queue, handle, worker, seconds=None, flush=None, flush_every=50):
+    """lease and handle items until the queue is drained or the time budget would run out before another item could
+    finish. items that raise are given back to the queue. when `flush` is given, items are only completed after it
+    returns so their results are saved before another worker could skip them. when it raises, the items it was saving
+    are given back to the queue
+
+    Args:
+        queue (SqliteQueue|BucketQueue): the queue to lease from
+        handle (callable): called with each object name
+        worker (str): the name of the worker
+        seconds (float): the time budget. None to run until the queue is drained
+        flush (callable): called every `flush_every` items and at the end to save the results
+        flush_every (int): the number of items handled between flushes
+
+    Returns:
+        dict: the number of items handled and failed and the seconds spent
+    """
+    start = perf_counter()
+    slowest = 0.0
+    handled = []
+    summary = {"items": 0, "failed": 0}
+
+    def complete_handled():
+        if flush is not None and handled:
+            try:
+                flush()
+            except Exception as error:  # pylint: disable=broad-except
+                logging.error("worker %s failed to save %i items, %s", worker, len(handled), error, exc_info=True)
+
+                for name in handled:
+                    queue.fail(name)
+
+                summary["items"] -= len(handled)
+                summary["failed"] += len(handled)
+                handled.clear()
+
+                return
+
+        for name in handled:
+            queue.complete(name)
+
+        handled.clear()
+
+    while seconds is None or perf_counter() - start + slowest < seconds:
+        name = queue.lease(worker)
+
+        if name is None:
+            break
+
+        item_start = perf_counter()
+
+        try:
+            handle(name)
+        except Exception as error:  # pylint: disable=broad-except
+            logging.error("worker %s failed on %s, %s", worker, name, error, exc_info=True)
+            queue.fail(name)
+            summary["failed"] += 1
+
+            continue
+
+        slowest = max(slowest, perf_counter() - item_start)
+        summary["items"] += 1
+        handled.append(name)
+
+        if flush is None or len(handled) >= flush_every:
+            complete_handled()
+
+    complete_handled()
+
+    summary["seconds"] = perf_counter() - start
+    logging.info("worker %s finished: %s", worker, summary)
+
+    return summary
@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+"""
+UDOT Right of Way (ROW) Parcel Number Extraction
+Rendering the pages of pdfs and tiffs. pdf pages are rendered one at a time at the highest resolution that fits
+the memory budget and the pages of both are yielded with their page numbers
+"""
+
+import logging
+import re
+from io import BytesIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import cv2
+from pdf2image import convert_from_path, pdfinfo_from_path
+from pdf2image.exceptions import PDFInfoNotInstalledError, PDFPageCountError, PDFSyntaxError
+from PIL import Image
+from PIL.Image import DecompressionBombError
+
+from row_metrics import METRICS
+
+#: the resolutions a pdf page falls back to when it does not fit in the memory budget
+RENDER_DPIS = (300, 250, 200, 150, 100, 72)
+
+#: the estimated bytes held per pixel while a page is processed. the rendered rgb page, the decoded bgr page, the
+#: gray and blurred bands and the hough gradient and accumulator buffers
+RENDER_BYTES_PER_PIXEL = 16
+
+
+def convert_pdf_to_jpg_bytes(pdf_as_bytes, object_name, dpi=300, memory_budget=None, pages=None):
+    """convert pdf to jpg images. the pages are rendered one at a time as the images are iterated and each page is
+    rendered at the highest dpi, up to `dpi`, that fits in the memory budget
+
+    Args:
+        pdf_as_bytes: a pdf as bytes
+        object_name (str): the name of the pdf for logging
+        dpi (int): the resolution to render the pages at when they fit in the memory budget
+        memory_budget (int): the bytes a rendered page may use. None to always render at `dpi`
+        pages (tuple): the one based, inclusive (first, last) pages to render. None to render every page
+
+    Returns:
+        tuple(generator, number, str): A tuple of a generator of (page number, image) pairs, the count of pages and any
+                                       error message. pages that fail to render are skipped
+    """
+
+    def render_pages(content):
+        #: the first item is the page count and any error message so the directory is only made inside the generator
+        #: and removed when it is exhausted or closed
+        with TemporaryDirectory() as folder:
+            pdf_path = str(Path(folder) / "document.pdf")
+
+            try:
+                Path(pdf_path).write_bytes(content)
+
+                #: the pages are rendered from the file so the caller can free the pdf while they are iterated
+                del content
+
+                first, last = get_page_range(pdfinfo_from_path(pdf_path)["Pages"], pages, object_name)
+                page_sizes = get_pdf_page_sizes(pdf_path, last, first)
+            except (TypeError, PDFInfoNotInstalledError, PDFPageCountError, PDFSyntaxError) as error:
+                logging.error("error in %s, %s", object_name, error, exc_info=True)
+
+                yield 0, error
+
+                return
+
+            yield max(0, last - first + 1), ""
+
+            for page in range(first, last + 1):
+                page_dpi = choose_render_dpi(page_sizes.get(page), dpi, memory_budget)
+
+                if page_dpi < dpi:
+                    METRICS.increment("pages_reduced_dpi")
+                    logging.warning(
+                        "rendering a page at a reduced resolution: %s",
+                        {"file": object_name, "page": page, "dpi": page_dpi, "page size": page_sizes.get(page)},
+                    )
+
+                image = render_pdf_page(pdf_path, page, page_dpi, object_name)
+
+                if image is not None:
+                    yield page, image
+
+    images = render_pages(pdf_as_bytes)
+    count, messages = next(images)
+
+    return (images, count, messages)
+
+
+def convert_tiff_to_images(tiff_as_bytes, object_name, pages=None):
+    """split a multi-page tiff into its pages. the pages are decoded one at a time as the images are iterated so only
+    a single page is in memory
+
+    Args:
+        tiff_as_bytes: a tiff as bytes
+        object_name (str): the name of the tiff for logging
+        pages (tuple): the one based, inclusive (first, last) pages to decode. None to decode every page
+
+    Returns:
+        tuple(generator, number, str): A tuple of a generator of (page number, BGR image) pairs, the count of pages
+                                       and any error message. pages that fail to decode are skipped
+    """
+
+    def decode_pages(content):
+        #: the first item is the page count and any error message so the directory is only made inside the generator
+        #: and removed when it is exhausted or closed
+        with TemporaryDirectory() as folder:
+            tiff_path = str(Path(folder) / "document.tif")
+
+            Path(tiff_path).write_bytes(content)
+
+            #: the pages are decoded from the file so the caller can free the tiff while they are iterated
+            del content
+
+            #: opencv reports 0 pages for files it can not read
+            page_count = cv2.imcount(tiff_path)
+
+            if page_count == 0:
+                logging.error("unable to read the pages of %s", object_name)
+
+                yield 0, "unable to read the tiff pages"
+
+                return
+
+            first, last = get_page_range(page_count, pages, object_name)
+
+            yield max(0, last - first + 1), ""
+
+            for page in range(first - 1, last):
+                success, frames = cv2.imreadmulti(tiff_path, page, 1, flags=cv2.IMREAD_COLOR)
+
+                if not success or not frames:
+                    logging.error("unable to read page %i of %s", page + 1, object_name)
+
+                    continue
+
+                yield page + 1, frames[0]
+
+    images = decode_pages(tiff_as_bytes)
+    count, messages = next(images)
+
+    return (images, count, messages)
+
+
+def render_pdf_page(pdf_path, page, dpi, object_name):
+    """render a single pdf page as jpg bytes. pages that are too large for pillow or memory are rendered again at the
+    next lower resolution in `RENDER_DPIS`
+
+    Args:
+        pdf_path (str): the path to the pdf
+        page (int): the one based page number
+        dpi (int): the resolution to render at
+        object_name (str): the name of the pdf for logging
+
+    Returns:
+        bytes: the page as a jpg or None if it could not be rendered
+    """
+    for page_dpi in [dpi] + [lower for lower in RENDER_DPIS if lower < dpi]:
+        try:
+            images = convert_from_path(pdf_path, page_dpi, first_page=page, last_page=page)
+        except (DecompressionBombError, MemoryError) as error:
+            METRICS.increment("pages_rerendered")
+            logging.warning(
+                "page too large to render: %s", {"file": object_name, "page": page, "dpi": page_dpi, "error": error}
+            )
+
+            continue
+        except (PDFInfoNotInstalledError, PDFPageCountError, PDFSyntaxError) as error:
+            logging.error("error in %s page %i, %s", object_name, page, error, exc_info=True)
+
+            return None
+
+        if not images:
+            return None
+
+        with BytesIO() as byte_array:
+            images[0].save(byte_array, format="JPEG")
+
+            return byte_array.getvalue()
+
+    logging.error("unable to render page %i of %s at any resolution", page, object_name)
+
+    return None
+
+
+def get_pdf_page_sizes(pdf_path, page_count, first_page=1):
+    """read the size of every page of a pdf in points without rendering it
+
+    Args:
+        pdf_path (str): the path to the pdf
+        page_count (int): the number of pages in the pdf or the last page to read
+        first_page (int): the first page to read
+
+    Returns:
+        dict: the (width, height) in points for each one based page number
+    """
+    if page_count < first_page:
+        return {}
+
+    return parse_pdf_page_sizes(pdfinfo_from_path(pdf_path, first_page=first_page, last_page=page_count))
+
+
+def get_page_range(page_count, pages, object_name):
+    """clamp a requested page range to the pages in a document
+
+    Args:
+        page_count (int): the number of pages in the document
+        pages (tuple): the one based, inclusive (first, last) pages or None for every page
+        object_name (str): the name of the document for logging
+
+    Returns:
+        tuple(int, int): the first and last pages. the last page is before the first when the range is past the end
+    """
+    if pages is None:
+        return 1, page_count
+
+    first, last = pages
+
+    if last > page_count:
+        logging.warning(
+            "page range is past the end of the document: %s",
+            {"file": object_name, "pages": pages, "page count": page_count},
+        )
+
+    return first, min(last, page_count)
+
+
+def parse_pdf_page_sizes(info):
+    """parse the page sizes from pdfinfo output
+
+    Args:
+        info (dict): the pdfinfo output for a page range, with `Page    1 size` keys
+
+    Returns:
+        dict: the (width, height) in points for each one based page number
+    """
+    sizes = {}
+
+    for key, value in info.items():
+        page = re.fullmatch(r"Page\s+(\d+) size", key)
+        size = re.match(r"([\d.]+) x ([\d.]+) pts", str(value))
+
+        if page and size:
+            sizes[int(page.group(1))] = (float(size.group(1)), float(size.group(2)))
+
+    return sizes
+
+
+def choose_render_dpi(page_size, dpi, memory_budget):
+    """pick the highest resolution, up to `dpi`, where the estimated memory to render and detect circles on a page
+    fits in the budget
+
+    Args:
+        page_size (tuple): the (width, height) of the page in points or None when it is unknown
+        dpi (int): the preferred resolution
+        memory_budget (int): the bytes a page may use or None for no limit
+
+    Returns:
+        int: the resolution to render the page at
+    """
+    if page_size is None:
+        return dpi
+
+    width, height = page_size
+    candidates = [dpi] + [lower for lower in RENDER_DPIS if lower < dpi]
+
+    for candidate in candidates:
+        pixels = (width / 72 * candidate) * (height / 72 * candidate)
+
+        #: pillow refuses to open images over twice its maximum pixel count
+        if Image.MAX_IMAGE_PIXELS and pixels > 2 * Image.MAX_IMAGE_PIXELS:
+            continue
+
+        if memory_budget is None or pixels * RENDER_BYTES_PER_PIXEL <= memory_budget:
+            return candidate
+
+    return candidates[-1]
+
+
+def get_memory_budget(memory_budget_mb=None):
+    """get the bytes a single page may use. defaults to half of the container memory limit
+
+    Args:
+        memory_budget_mb (float): the budget in megabytes. None to read it from the container limit
+
+    Returns:
+        int: the budget in bytes or None when there is no limit
+    """
+    if memory_budget_mb:
+        return int(float(memory_budget_mb) * 1024 * 1024)
+
+    for limit_file in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            limit = Path(limit_file).read_text(encoding="utf-8").strip()
+        except OSError:
+            continue
+
+        #: cgroups report no limit as `max` or as a number near the largest 64 bit integer
+        if limit.isdigit() and int(limit) < 2**60:
+            return int(limit) // 2
+
+    return None
+
+
+def reset_peak_rss():
+    """reset the peak resident memory of the process so it can be measured for each object. only linux supports it"""
+    try:
+        Path("/proc/self/clear_refs").write_text("5", encoding="utf-8")
+    except OSError:
+        pass
+
+
+def get_peak_rss():
+    """get the peak resident memory of the process since it started or since the last `reset_peak_rss`
+
+    Returns:
+        int: the peak resident memory in bytes or None when it is not available
+    """
+    try:
+        for line in Path("/proc/self/status").read_text(encoding="utf-8").splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return None
+
+
+def count_document_pages(content, object_name):
+    """count the pages of a pdf or tiff without rendering them
+
+    Args:
+        content (bytes): the document
+        object_name (str): the name of the document. the extension picks the reader
+
+    Returns:
+        int: the number of pages or 0 when the document can not be read
+    """
+    extension = Path(object_name).suffix.casefold()
+
+    with TemporaryDirectory() as folder:
+        path = Path(folder) / f"document{extension}"
+        path.write_bytes(content)
+
+        if extension in [".tif", ".tiff"]:
+            return cv2.imcount(str(path))
+
+        try:
+            return pdfinfo_from_path(str(path))["Pages"]
+        except (PDFInfoNotInstalledError, PDFPageCountError, PDFSyntaxError) as error:
+            logging.error("unable to count the pages of %s, %s", object_name, error)
+
+            return 0
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+"""
+UDOT Right of Way (ROW) Parcel Number Extraction
+The second ocr pass. only the mosaic tiles whose tokens were read with a low confidence are queued. each one is cut
+from its mosaic, enlarged and contrast enhanced, and the tiles are read together in small mosaics so the cost of the
+pass follows the number of bad tiles instead of the size of the run
+"""
+
+import json
+import logging
+from uuid import uuid4
+
+import cv2
+import numpy as np
+
+import row
+import row_ocr
+import row_pack
+import row_queue
+from row_metrics import METRICS
+
+#: the factor the tiles are enlarged by before they are read again
+TILE_SCALE = 2
+
+#: the tiles read together in one ocr request
+TILES_PER_MOSAIC = row_pack.PACK_MAX_TILES
+
+
+def enhance_tile(crop, scale=TILE_SCALE):
+    """enlarge a tile and spread its contrast so faint or small digits are easier to read
+
+    Args:
+        crop (np.ndarray): the tile cut from a mosaic
+        scale (int): the factor to enlarge the tile by
+
+    Returns:
+        np.ndarray: the single band enhanced tile
+    """
+    if crop.ndim == 3:
+        crop = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+
+    enlarged = cv2.resize(crop, None, fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC)
+
+    return cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8)).apply(enlarged)
+
+
+def reocr_queued_tiles(inputs, queue, seconds=None, scale=TILE_SCALE, tiles_per_mosaic=TILES_PER_MOSAIC):
+    """the code to run in a long running worker. tiles from `row_ocr.select_low_confidence_tiles` are leased from the
+    queue, enhanced and read in mosaics of `tiles_per_mosaic` tiles. the text of each tile is saved with its mosaic and
+    tile in the `reocr` folder of the first pass' run so `row_ocr.merge_run_results` replaces the text the tile was
+    first read with
+
+    Args:
+        inputs (class): the inputs to the function
+            job_name (str): the name of the run whose results are amended
+            input_bucket (str): the bucket holding the mosaics using the format `gs://bucket-name`
+            output_location (str): the location to save the results to. omit the `gs://` prefix
+            task_index (int): the index of the task running
+            project_number (int): the number of the gcp project
+            processor_id (str): the id of the documentai processor
+        queue (SqliteQueue|BucketQueue): the queue of tile items from `row.get_work_queue`
+        seconds (float): the time budget. None to run until the queue is drained
+        scale (int): the factor to enlarge the tiles by
+        tiles_per_mosaic (int): the tiles read in one ocr request
+
+    Returns:
+        dict: the number of tiles handled and failed and the seconds spent
+    """
+    METRICS.reset()
+
+    bucket = row.get_storage_client().bucket(inputs.input_bucket[5:])
+    ai_client = row_ocr.get_ai_client()
+    processor_name = ai_client.processor_path(inputs.project_number, "us", inputs.processor_id)
+
+    #: a worker id keeps the batches of a restarted worker from replacing the earlier ones
+    worker_id = uuid4().hex[:8]
+    #: the tiles of a mosaic are queued next to each other so only the last mosaic is kept
+    mosaics = {}
+    tiles = []
+    batches = []
+
+    def handle(item):
+        mosaic_name, tile = row.parse_tile_item(item)
+
+        if mosaic_name not in mosaics:
+            mosaics.clear()
+            image = cv2.imdecode(np.frombuffer(row.download_object(bucket, mosaic_name), np.uint8), cv2.IMREAD_COLOR)
+            manifest = json.loads(row.download_object(bucket, row.get_manifest_name(mosaic_name)))
+            mosaics[mosaic_name] = (image, manifest)
+
+        image, manifest = mosaics[mosaic_name]
+        left, top, right, bottom = manifest["tiles"][tile]["box"]
+
+        tiles.append((item, enhance_tile(image[top:bottom, left:right], scale)))
+
+    def flush():
+        if not tiles:
+            return
+
+        name = f"task-{inputs.task_index}-{worker_id}-{len(batches):04d}"
+        crops = [crop for _, crop in tiles]
+
+        try:
+            mosaic = row_pack.build_mosaic_image(crops, name, None, "gray")
+            content, _ = row_pack.prepare_mosaic(mosaic, name, "png")
+            document = None
+
+            if content is not None:
+                document = row_ocr.read_mosaic_text(ai_client, processor_name, name, content, inputs)
+
+            #: raising gives the tiles back to the queue so they are read again instead of completed without text
+            if document is None:
+                raise ValueError(f"the {len(tiles)} tiles of {name} could not be read")
+
+            #: each tile is its own document so its text can replace the text it was first read with
+            boxes, width, height = row_pack.get_grid_layout(crops)
+            manifest = {
+                "version": 1,
+                "width": width,
+                "height": height,
+                "tiles": [{"file_name": item, "page": None, "box": box} for (item, _), box in zip(tiles, boxes)],
+            }
+            rows = [[*row.parse_tile_item(item), text] for item, text in row_ocr.split_packed_text(document, manifest)]
+
+            row_ocr.upload_reread_tiles(rows, inputs.output_location, name, inputs.job_name)
+            batches.append(name)
+            METRICS.increment("reocr_tiles", len(tiles))
+        finally:
+            tiles.clear()
+
+    summary = row_queue.drain(
+        queue, handle, f"{inputs.job_name}-{inputs.task_index}", seconds, flush=flush, flush_every=tiles_per_mosaic
+    )
+
+    METRICS.increment("queue_items", summary["items"])
+    METRICS.increment("queue_items_failed", summary["failed"])
+    row.emit_metrics("reocr", inputs.job_name, inputs.task_index, inputs.output_location)
+
+    logging.info(
+        "job name: %s task: %i read %i tiles again in %i mosaics",
+        inputs.job_name,
+        inputs.task_index,
+        summary["items"],
+        len(batches),
+    )
+
+    return summary
@@ -1,8 +1,13 @@
 #!/usr/bin/env python
 # * coding: utf8 *
 """
-the file to run to start the project
+the file to run to start the project. the job modules are imported when the job starts so a task only loads the
+libraries of its job type. when `WORK_QUEUE` is set the task runs as a long running worker that leases objects from
+the queue instead of working on a slice of the index. the `fused` job type mosaics and reads each document in one
+task without uploading the mosaics unless `FUSED_UPLOAD_MOSAICS` is set. the `reocr` job type reads the low
+confidence tiles queued with `row_cli.py queue tiles` again and always runs as queue workers
 """
+# pylint: disable=import-outside-toplevel
 
 import logging
 from os import environ
@@ -23,12 +28,43 @@ logging.basicConfig(
 #: Set up variables
 TASK_INDEX = int(environ["CLOUD_RUN_TASK_INDEX"])
 TASK_COUNT = int(environ["CLOUD_RUN_TASK_COUNT"])
-TOTAL_FILES = int(environ["TOTAL_FILES"])
-INDEX = environ["INDEX_FILE_LOCATION"]
+TOTAL_FILES = int(environ.get("TOTAL_FILES", 0))
+INDEX = environ.get("INDEX_FILE_LOCATION")
 BUCKET_NAME = environ["INPUT_BUCKET"]
 OUTPUT_BUCKET_NAME = environ["OUTPUT_BUCKET"]
 JOB_TYPE = environ["JOB_TYPE"]
 JOB_NAME = environ["JOB_NAME"]
+WORK_QUEUE = environ.get("WORK_QUEUE")
+WORKER_SECONDS = float(environ["WORKER_SECONDS"]) if environ.get("WORKER_SECONDS") else None
+
+
+def get_mosaic_options():
+    """read the mosaic options from the environment
+
+    Returns:
+        SimpleNamespace: the mosaic job options
+    """
+    import row_mosaic
+
+    return row_mosaic.get_mosaic_options(
+        color_mode=environ.get("MOSAIC_COLOR_MODE"),
+        codec=environ.get("MOSAIC_CODEC"),
+        quality=environ.get("MOSAIC_QUALITY"),
+        filter_crops=environ.get("MOSAIC_FILTER_CROPS"),
+        hash_index=environ.get("MOSAIC_HASH_INDEX"),
+        profile=environ.get("PROFILE_OBJECTS"),
+        profile_seconds=environ.get("PROFILE_MIN_SECONDS"),
+        profile_memory_mb=environ.get("PROFILE_MIN_MEMORY_MB"),
+        profile_top=environ.get("PROFILE_TOP"),
+        dpi=environ.get("RENDER_DPI"),
+        memory_budget_mb=environ.get("MEMORY_BUDGET_MB"),
+        detector=environ.get("MOSAIC_DETECTOR"),
+        triage=environ.get("MOSAIC_TRIAGE"),
+        decode_reduction=environ.get("MOSAIC_DECODE_REDUCTION"),
+        detection_profile=environ.get("MOSAIC_DETECTION_PROFILE"),
+        detection_cache=environ.get("MOSAIC_DETECTION_CACHE"),
+        pack_pixels=environ.get("MOSAIC_PACK_PIXELS"),
+    )
 
 
 def mosaic_all_circles():
@@ -36,7 +72,11 @@ def mosaic_all_circles():
 
     job_start = perf_counter()
 
-    row.mosaic_all_circles(JOB_NAME, BUCKET_NAME, OUTPUT_BUCKET_NAME, INDEX, TASK_INDEX, TASK_COUNT, TOTAL_FILES)
+    import row_mosaic
+
+    row_mosaic.mosaic_all_circles(
+        JOB_NAME, BUCKET_NAME, OUTPUT_BUCKET_NAME, INDEX, TASK_INDEX, TASK_COUNT, TOTAL_FILES, get_mosaic_options()
+    )
 
     logging.info(
         "job name: %s task %i: entire job %s",
@@ -46,11 +86,13 @@ def mosaic_all_circles():
     )
 
 
-def ocr_all_mosaics():
-    """the main function to execute when cloud run starts the ocr job"""
-    job_start = perf_counter()
+def get_ocr_inputs():
+    """read the ocr job inputs from the environment
 
-    inputs = SimpleNamespace(
+    Returns:
+        SimpleNamespace: the ocr job inputs
+    """
+    return SimpleNamespace(
         job_name=JOB_NAME,
         input_bucket=BUCKET_NAME,
         output_location=OUTPUT_BUCKET_NAME,
@@ -62,7 +104,14 @@ def ocr_all_mosaics():
         processor_id=environ["PROCESSOR_ID"],
     )
 
-    row.ocr_all_mosaics(inputs)
+
+def ocr_all_mosaics():
+    """the main function to execute when cloud run starts the ocr job"""
+    job_start = perf_counter()
+
+    import row_ocr
+
+    row_ocr.ocr_all_mosaics(get_ocr_inputs())
 
     logging.info(
         "job name: %s task %i: entire job %s",
@@ -72,10 +121,86 @@ def ocr_all_mosaics():
     )
 
 
-if __name__ == "__main__":
+def fuse_all_objects():
+    """the main function to execute when cloud run starts the fused mosaic and ocr job"""
+    job_start = perf_counter()
+
+    import row_fused
+
+    inputs = get_ocr_inputs()
+    inputs.upload_mosaics = row.to_bool(environ.get("FUSED_UPLOAD_MOSAICS"))
+
+    row_fused.fuse_all_objects(inputs, get_mosaic_options())
+
+    logging.info(
+        "job name: %s task %i: entire job %s",
+        JOB_NAME,
+        TASK_INDEX,
+        row.format_time(perf_counter() - job_start),
+    )
+
+
+def merge_partial_mosaics():
+    """the main function to execute when cloud run starts the merge job after the mosaic job. the first task stacks
+    the partial mosaics of the documents whose page ranges in the `INDEX_FILE_LOCATION` index have all finished
+    """
+    if TASK_INDEX != 0:
+        logging.info("job name: %s task %i: only the first task merges", JOB_NAME, TASK_INDEX)
+
+        return
+
+    import row_merge
+
+    options = get_mosaic_options()
+    entries = row.get_index(INDEX).read_text(encoding="utf-8").splitlines()
+    summary = row_merge.merge_partial_mosaics(JOB_NAME, OUTPUT_BUCKET_NAME, entries, options.codec, options.quality)
+
+    logging.info("job name: %s task %i: merged partial mosaics: %s", JOB_NAME, TASK_INDEX, summary)
+
+
+def work_from_queue():
+    """the main function to execute when cloud run starts a job as long running workers. the clients, caches and
+    imported libraries are reused for every object the worker leases
+    """
+    job_start = perf_counter()
+    queue = row.get_work_queue(WORK_QUEUE)
+
     if JOB_TYPE == "mosaic":
+        import row_mosaic
+
+        summary = row_mosaic.mosaic_queued_objects(
+            JOB_NAME, BUCKET_NAME, OUTPUT_BUCKET_NAME, queue, TASK_INDEX, get_mosaic_options(), WORKER_SECONDS
+        )
+    elif JOB_TYPE == "reocr":
+        import row_reocr
+
+        summary = row_reocr.reocr_queued_tiles(get_ocr_inputs(), queue, WORKER_SECONDS)
+    else:
+        import row_ocr
+
+        summary = row_ocr.ocr_queued_mosaics(get_ocr_inputs(), queue, WORKER_SECONDS)
+
+    logging.info(
+        "job name: %s task %i: entire worker %s: %s",
+        JOB_NAME,
+        TASK_INDEX,
+        row.format_time(perf_counter() - job_start),
+        {"items": summary["items"], "failed": summary["failed"], "remaining": queue.counts()},
+    )
+
+    queue.close()
+
+
+if __name__ == "__main__":
+    if JOB_TYPE in ("mosaic", "ocr", "reocr") and WORK_QUEUE:
+        work_from_queue()
+    elif JOB_TYPE == "mosaic":
         mosaic_all_circles()
     elif JOB_TYPE == "ocr":
         ocr_all_mosaics()
+    elif JOB_TYPE == "fused":
+        fuse_all_objects()
+    elif JOB_TYPE == "merge":
+        merge_partial_mosaics()
     else:
         logging.error("JOB_TYPE environment variable not set")
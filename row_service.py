@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+"""
+UDOT Right of Way (ROW) Parcel Number Extraction
+A local http service that detects circles and builds mosaics with a pool of warm worker processes, and a load
+generator to measure its latency
+"""
+# pylint: disable=import-outside-toplevel
+
+import base64
+import json
+import logging
+import math
+import statistics
+import subprocess
+import sys
+import threading
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import TimeoutError as PoolTimeoutError
+from multiprocessing import get_context
+from os import cpu_count
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from urllib.error import HTTPError, URLError
+from urllib.parse import parse_qsl, quote, urlsplit
+from urllib.request import Request, urlopen
+
+#: the largest request body accepted
+MAX_REQUEST_BYTES = 256 * 1024 * 1024
+
+#: the seconds a request waits for a free slot and for its result
+SLOT_SECONDS = 5
+REQUEST_SECONDS = 300
+
+#: the query parameters passed to `row_mosaic.get_mosaic_options`
+OPTION_PARAMETERS = (
+    "color_mode",
+    "codec",
+    "quality",
+    "filter_crops",
+    "dpi",
+    "memory_budget_mb",
+    "detector",
+    "triage",
+    "decode_reduction",
+)
+
+#: the worker process state. the mosaic module is imported once when the worker starts
+WORKER = {}
+
+
+class InvalidRequestError(ValueError):
+    """the query parameters of a request are not valid mosaic options"""
+
+
+def _warm_worker():
+    """import the detection libraries and run a detection so the first request does not pay for it"""
+    logging.getLogger().setLevel(logging.WARNING)
+
+    import numpy as np
+
+    import row_detect
+    import row_mosaic
+
+    WORKER["row_mosaic"] = row_mosaic
+    row_detect.detect_circles(np.full((200, 200, 3), 255, dtype=np.uint8))
+
+
+def detect_document(content, name, parameters):
+    """detect the circles on every page of an image, tiff or pdf and mosaic them. this runs in a worker process
+
+    Args:
+        content (bytes): the encoded image or document
+        name (str): the name of the document for logging
+        parameters (dict): the mosaic options and `mosaic`, false to skip building the mosaic
+
+    Returns:
+        dict: the circles found on each page as [x, y, radius] and the base64 encoded mosaic
+    """
+    import row_pack
+    import row_render
+
+    row_mosaic = WORKER.get("row_mosaic")
+
+    if row_mosaic is None:
+        _warm_worker()
+        row_mosaic = WORKER["row_mosaic"]
+
+    start = perf_counter()
+    include_mosaic = str(parameters.get("mosaic", "true")).casefold() not in ("false", "0", "no")
+
+    try:
+        options = row_mosaic.get_mosaic_options(
+            **{key: value for key, value in parameters.items() if key in OPTION_PARAMETERS}
+        )
+    except ValueError as error:
+        raise InvalidRequestError(str(error)) from error
+
+    if content.startswith(b"%PDF"):
+        pages, _, messages = row_render.convert_pdf_to_jpg_bytes(
+            content, name, options.dpi, row_render.get_memory_budget(options.memory_budget_mb)
+        )
+    elif content[:4] in (b"II*\x00", b"MM\x00*"):
+        pages, _, messages = row_render.convert_tiff_to_images(content, name)
+    else:
+        pages, messages = [(1, content)], ""
+
+    results = []
+    crops = []
+
+    for number, page in pages:
+        image, circles, inset = row_mosaic.read_and_detect_circles(
+            page, name, None, options.detector, options.triage, options.decode_reduction
+        )
+
+        if image is None:
+            results.append({"page": number, "error": "unable to read the image", "circles": []})
+
+            continue
+
+        height, width = image.shape
+        page_crops = []
+
+        if circles is not None:
+            page_crops = row_mosaic.export_circles_from_image(circles, None, name, image.color(), height, width, inset)
+
+        if options.filter_crops:
+            page_crops, _ = row_mosaic.filter_circle_crops(page_crops)
+
+        crops.extend(page_crops)
+
+        coordinates = []
+        if circles is not None:
+            coordinates = [[round(float(value)) for value in circle] for circle in circles[0]]
+
+        results.append({"page": number, "width": width, "height": height, "circles": coordinates})
+
+    response = {"name": name, "pages": results, "circle count": sum(len(page["circles"]) for page in results)}
+
+    if messages:
+        response["message"] = str(messages)
+
+    if include_mosaic and crops:
+        mosaic = row_pack.build_mosaic_image(crops, name, None, options.color_mode)
+        encoded, mime_type = row_pack.encode_mosaic(mosaic, options.codec, options.quality)
+
+        response["mosaic"] = base64.b64encode(encoded).decode("ascii") if encoded else None
+        response["mosaic mime type"] = mime_type
+
+    response["seconds"] = perf_counter() - start
+
+    return response
+
+
+class DetectionService:
+    """a pool of pre started worker processes behind a limit on the requests in flight. requests over the limit wait
+    up to `SLOT_SECONDS` for a slot and are then turned away so a burst can not queue unbounded work. a slot is held
+    until its worker finishes, even when the request timed out, so the limit counts the work the pool is doing
+    """
+
+    def __init__(self, workers=None, max_in_flight=None):
+        self.workers = workers or cpu_count() or 1
+        self.max_in_flight = max_in_flight or 2 * self.workers
+        self.slots = threading.BoundedSemaphore(self.max_in_flight)
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+        #: spawn the workers so they do not fork opencv's threads. they all start and warm up in parallel now and the
+        #: service waits until the pool answers
+        self.pool = get_context("spawn").Pool(self.workers, initializer=_warm_worker)
+        self.pool.map(len, [b""] * self.workers)
+
+    def detect(self, content, name, parameters):
+        """run a detection on a worker
+
+        Args:
+            content (bytes): the encoded image or document
+            name (str): the name of the document
+            parameters (dict): the query parameters
+
+        Returns:
+            tuple(int, dict): the http status and the response
+        """
+        if not self.slots.acquire(timeout=SLOT_SECONDS):
+            return HTTPStatus.SERVICE_UNAVAILABLE, {"error": "too many requests in flight"}
+
+        with self.lock:
+            self.in_flight += 1
+
+        try:
+            result = self.pool.apply_async(
+                detect_document, (content, name, parameters), callback=self._release, error_callback=self._release
+            )
+        except Exception:
+            self._release()
+
+            raise
+
+        try:
+            return HTTPStatus.OK, result.get(REQUEST_SECONDS)
+        except InvalidRequestError as error:
+            return HTTPStatus.BAD_REQUEST, {"error": str(error)}
+        except PoolTimeoutError:
+            return HTTPStatus.GATEWAY_TIMEOUT, {"error": f"detection took more than {REQUEST_SECONDS} seconds"}
+        except Exception as error:  # pylint: disable=broad-except
+            logging.error("detection failed on %s, %s", name, error, exc_info=True)
+
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {"error": str(error)}
+
+    def _release(self, _=None):
+        """free the slot of a finished detection. the pool calls this once the worker returns or raises"""
+        with self.lock:
+            self.in_flight -= 1
+
+        self.slots.release()
+
+    def health(self):
+        """describe the pool
+
+        Returns:
+            dict: the worker count, the limit and the requests in flight
+        """
+        return {
+            "status": "ok",
+            "workers": self.workers,
+            "max in flight": self.max_in_flight,
+            "in flight": self.in_flight,
+        }
+
+    def close(self):
+        """stop the workers"""
+        self.pool.terminate()
+        self.pool.join()
+
+
+class DetectionHandler(BaseHTTPRequestHandler):
+    """`POST /detect?name=file.pdf&codec=png` with the image or pdf as the body and `GET /health`"""
+
+    service = None
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """report the health of the service"""
+        if urlsplit(self.path).path != "/health":
+            return self.respond(HTTPStatus.NOT_FOUND, {"error": "not found"})
+
+        return self.respond(HTTPStatus.OK, self.service.health())
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """detect the circles in the request body"""
+        url = urlsplit(self.path)
+
+        if url.path != "/detect":
+            return self.respond(HTTPStatus.NOT_FOUND, {"error": "not found"})
+
+        length = int(self.headers.get("Content-Length") or 0)
+
+        if length == 0:
+            return self.respond(HTTPStatus.BAD_REQUEST, {"error": "send an image or pdf as the request body"})
+
+        if length > MAX_REQUEST_BYTES:
+            return self.respond(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {"error": "the request body is too large"})
+
+        parameters = dict(parse_qsl(url.query))
+        content = self.rfile.read(length)
+
+        status, response = self.service.detect(content, parameters.pop("name", "upload"), parameters)
+
+        return self.respond(status, response)
+
+    def respond(self, status, response):
+        """send a json response"""
+        body = json.dumps(response).encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+
+        if status == HTTPStatus.SERVICE_UNAVAILABLE:
+            self.send_header("Retry-After", str(SLOT_SECONDS))
+
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logging.debug("%s %s", self.address_string(), format % args)
+
+
+def create_server(port=8080, workers=None, max_in_flight=None, host="127.0.0.1"):
+    """create the http server and start its workers. call `serve_forever` to handle requests
+
+    Args:
+        port (int): the port to listen on. 0 picks a free port
+        workers (int): the number of worker processes. defaults to the number of cpus
+        max_in_flight (int): the number of requests handled or waiting for a worker at once. defaults to twice the
+                             number of workers
+        host (str): the address to listen on
+
+    Returns:
+        ThreadingHTTPServer: the server with the `DetectionService` as `service`
+    """
+    service = DetectionService(workers, max_in_flight)
+    handler = type("BoundDetectionHandler", (DetectionHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.service = service
+
+    logging.info("detection service listening on %s:%i with %i workers", host, server.server_port, service.workers)
+
+    return server
+
+
+def percentile(values, share):
+    """get a percentile by the nearest rank
+
+    Args:
+        values (list): the values
+        share (float): the percentile from 0 to 100
+
+    Returns:
+        float: the value or 0 when there are none
+    """
+    if not values:
+        return 0.0
+
+    ordered = sorted(values)
+
+    return ordered[min(max(math.ceil(share / 100 * len(ordered)) - 1, 0), len(ordered) - 1)]
+
+
+def generate_load(url, payloads, requests=50, concurrency=4, parameters=""):
+    """send detection requests from a number of concurrent clients and measure the latency
+
+    Args:
+        url (str): the base url of the service, like `http://127.0.0.1:8080`
+        payloads (list): (name, bytes) documents sent in turn
+        requests (int): the number of requests to send
+        concurrency (int): the number of clients sending at once
+        parameters (str): extra query parameters, like `codec=png`
+
+    Returns:
+        dict: the latency percentiles, throughput and the count of each response status
+    """
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def client():
+        for number in counter:
+            name, content = payloads[number % len(payloads)]
+            request = Request(
+                f"{url.rstrip('/')}/detect?name={quote(name)}{'&' + parameters if parameters else ''}",
+                data=content,
+                headers={"Content-Type": "application/octet-stream"},
+            )
+            start = perf_counter()
+
+            try:
+                with urlopen(request, timeout=REQUEST_SECONDS) as response:
+                    response.read()
+                    status = response.status
+            except HTTPError as error:
+                status = error.code
+            except URLError:
+                status = "connection error"
+
+            with lock:
+                latencies.append(perf_counter() - start)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    start = perf_counter()
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+
+    for thread in clients:
+        thread.start()
+
+    for thread in clients:
+        thread.join()
+
+    seconds = perf_counter() - start
+
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "seconds": seconds,
+        "requests per second": requests / seconds if seconds else 0.0,
+        "latency p50": percentile(latencies, 50),
+        "latency p90": percentile(latencies, 90),
+        "latency p99": percentile(latencies, 99),
+        "latency max": max(latencies, default=0.0),
+        "latency mean": statistics.fmean(latencies) if latencies else 0.0,
+        "statuses": statuses,
+    }
+
+
+def benchmark_service(payloads, workers=None, requests=50, concurrencies=(1, 2, 4), max_in_flight=None, url=None):
+    """measure the latency of the service at a series of client concurrencies. a service is started on a free port
+    when no url is given
+
+    Args:
+        payloads (list): (name, bytes) documents sent in turn
+        workers (int): the number of worker processes of the started service
+        requests (int): the number of requests at each concurrency
+        concurrencies (list): the numbers of concurrent clients
+        max_in_flight (int): the request limit of the started service
+        url (str): the url of a running service
+
+    Returns:
+        list(dict): the load results for each concurrency
+    """
+    server = None
+
+    if url is None:
+        server = create_server(0, workers, max_in_flight)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}"
+
+    try:
+        return [generate_load(url, payloads, requests, concurrency) for concurrency in concurrencies]
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+            server.service.close()
+
+
+def measure_cold_detection(file_name, repeat=3):
+    """time `row_cli.py detect circles` on a file in a fresh interpreter, the way staff run a single lookup without
+    the service
+
+    Args:
+        file_name (str): the image to detect circles in
+        repeat (int): the number of runs
+
+    Returns:
+        dict: the latency percentiles of the runs
+    """
+    latencies = []
+
+    with TemporaryDirectory() as folder:
+        for _ in range(repeat):
+            start = perf_counter()
+            subprocess.run(
+                [sys.executable, "row_cli.py", "detect", "circles", str(file_name), f"--save-to={folder}"],
+                capture_output=True,
+                check=True,
+                cwd=Path(__file__).parent,
+            )
+            latencies.append(perf_counter() - start)
+
+    return {
+        "requests": repeat,
+        "latency p50": percentile(latencies, 50),
+        "latency max": max(latencies),
+    }
@@ -0,0 +1,629 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+"""
+UDOT Right of Way (ROW) Parcel Number Extraction
+A local simulator for the mosaic and ocr jobs to plan task counts without running them in the cloud
+"""
+
+import base64
+import hashlib
+import logging
+import random
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from os import cpu_count, getpid
+from pathlib import Path
+from threading import Lock
+from time import sleep, time
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+from google.api_core.exceptions import InternalServerError, NotFound, PreconditionFailed
+
+import row
+import row_bench
+import row_download
+import row_mosaic
+import row_ocr
+import row_queue
+
+#: the sheets drawn for the synthetic documents as (sheet size, dpi)
+SIMULATION_SHEETS = [("letter", 150), ("tabloid", 150), ("letter", 300)]
+
+#: the file marking a directory as a simulation workspace the simulator may empty
+WORKSPACE_MARKER = ".row-simulation"
+
+
+class LocalBlob:
+    """a stand in for a cloud storage blob backed by a local file"""
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.content_type = None
+
+    @property
+    def path(self):
+        """the local file holding the blob"""
+        return self.bucket.path / self.name
+
+    @property
+    def size(self):
+        """the size of the blob in bytes"""
+        return self.path.stat().st_size if self.path.exists() else None
+
+    @property
+    def md5_hash(self):
+        """the base64 md5 hash of the blob content like the cloud storage metadata"""
+        if not self.path.exists():
+            return None
+
+        return base64.b64encode(hashlib.md5(self.path.read_bytes()).digest()).decode("ascii")
+
+    @property
+    def generation(self):
+        """the modification time of the file. it changes every time the blob is written like a generation"""
+        return self.path.stat().st_mtime_ns if self.path.exists() else None
+
+    def exists(self):
+        """check if the blob exists"""
+        return self.path.exists()
+
+    def download_as_bytes(self, start=None, end=None):
+        """read the blob. `start` and `end` are inclusive byte offsets like the cloud storage client
+
+        Returns:
+            bytes: the blob content
+        """
+        if not self.path.exists():
+            raise NotFound(f"no such object: {self.bucket.name}/{self.name}")
+
+        with self.path.open("rb") as data:
+            start = start or 0
+            data.seek(start)
+            content = data.read() if end is None else data.read(end - start + 1)
+
+        self.bucket.client.wait(len(content))
+
+        return content
+
+    def delete(self):
+        """remove the blob"""
+        if not self.path.exists():
+            raise NotFound(f"no such object: {self.bucket.name}/{self.name}")
+
+        self.bucket.client.wait(0)
+        self.path.unlink()
+
+    def download_to_filename(self, filename):
+        """copy the blob to a local file"""
+        Path(filename).write_bytes(self.download_as_bytes())
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        """write the blob. `if_generation_match=0` only creates the blob when it does not exist, like the cloud
+        storage client
+        """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+
+        self.bucket.client.wait(len(data))
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        if if_generation_match == 0:
+            try:
+                with self.path.open("xb") as blob:
+                    blob.write(data)
+            except FileExistsError:
+                raise PreconditionFailed(f"object exists: {self.bucket.name}/{self.name}") from None
+        else:
+            self.path.write_bytes(data)
+
+        self.content_type = content_type
+
+
+class LocalBucket:
+    """a stand in for a cloud storage bucket backed by a local directory"""
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.path = client.root / name
+
+    def blob(self, name):
+        """get a blob by name"""
+        return LocalBlob(self, name)
+
+    def get_blob(self, name):
+        """get a blob by name or None when it does not exist"""
+        blob = LocalBlob(self, name)
+
+        return blob if blob.exists() else None
+
+    def list_blobs(self, prefix=None, **_):
+        """list the blobs in the bucket in name order"""
+        if not self.path.exists():
+            return iter([])
+
+        names = sorted(
+            item.relative_to(self.path).as_posix()
+            for item in self.path.rglob("*")
+            if item.is_file() and not item.name.startswith(".")
+        )
+
+        return (LocalBlob(self, name) for name in names if name.startswith(prefix or ""))
+
+
+class LocalStorageClient:
+    """a stand in for the cloud storage client where each bucket is a directory under `root`. every request waits
+    for `latency` seconds plus the transfer time at `bandwidth` bytes per second to mimic a remote store. a
+    `slow_rate` share of the requests wait another `slow_latency` seconds to mimic the slow tail of responses
+    """
+
+    def __init__(self, root, latency=0.0, bandwidth=None, slow_rate=0.0, slow_latency=0.0, seed=None):
+        self.root = Path(root)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.slow_requests = 0
+        self.lock = Lock()
+
+    def bucket(self, name):
+        """get a bucket by name"""
+        return LocalBucket(self, name)
+
+    def list_blobs(self, bucket_name, prefix=None, **kwargs):
+        """list the blobs in a bucket"""
+        return self.bucket(bucket_name).list_blobs(prefix=prefix, **kwargs)
+
+    def wait(self, size):
+        """sleep for the simulated request time"""
+        delay = self.latency
+        if self.bandwidth:
+            delay += size / self.bandwidth
+
+        with self.lock:
+            self.requests += 1
+
+            if self.slow_rate and self.random.random() < self.slow_rate:
+                self.slow_requests += 1
+                delay += self.slow_latency
+
+        if delay > 0:
+            sleep(delay)
+
+
+class FakeDocumentAIClient:
+    """a stand in for the documentai client with a configurable latency and failure rate"""
+
+    def __init__(self, latency=0.5, jitter=0.5, failure_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+
+    @staticmethod
+    def processor_path(project, location, processor):
+        """build the processor path the same way as the documentai client"""
+        return f"projects/{project}/locations/{location}/processors/{processor}"
+
+    def process_document(self, request, **_):
+        """wait for a log normally distributed latency and then fail or return a document with placeholder text"""
+        self.requests += 1
+
+        if self.latency > 0:
+            sleep(self.latency * self.random.lognormvariate(0, self.jitter))
+
+        if self.random.random() < self.failure_rate:
+            raise InternalServerError("simulated ocr failure")
+
+        size = len(request.raw_document.content)
+
+        return SimpleNamespace(document=SimpleNamespace(text=f"simulated text for {size} bytes"))
+
+
+def prepare_workspace(workspace):
+    """empty a simulation workspace. only a new or empty directory or one holding the `WORKSPACE_MARKER` the simulator
+    wrote is emptied so a mistyped location is never deleted. any other directory raises a ValueError
+
+    Args:
+        workspace (str): the directory for the simulated buckets
+
+    Returns:
+        Path: the empty workspace
+    """
+    workspace = Path(workspace)
+
+    if workspace.exists() and any(workspace.iterdir()):
+        if not (workspace / WORKSPACE_MARKER).is_file():
+            raise ValueError(f"{workspace} is not empty and was not created by the simulator, it will not be deleted")
+
+        shutil.rmtree(workspace)
+
+    workspace.mkdir(parents=True, exist_ok=True)
+    (workspace / WORKSPACE_MARKER).write_text("created by row_sim\n", encoding="utf-8")
+
+    return workspace
+
+
+def create_synthetic_run(workspace, file_count, distinct=20, sheets=None, seed=0):
+    """write synthetic plan sheets into a local input bucket with an index listing them. only `distinct` sheets are
+    drawn and they are repeated under different names to keep the set up fast
+
+    Args:
+        workspace (Path): the simulation directory. buckets are created as sub directories
+        file_count (int): the number of files in the index
+        distinct (int): the number of different sheets to draw
+        sheets (list): (sheet size, dpi) tuples to draw. defaults to `SIMULATION_SHEETS`
+        seed (int): the random seed
+
+    Returns:
+        Path: the folder containing the index.txt file
+    """
+    if sheets is None:
+        sheets = SIMULATION_SHEETS
+
+    workspace = Path(workspace)
+    rng = np.random.default_rng(seed)
+    documents = []
+
+    for i in range(min(distinct, file_count)):
+        size, dpi = sheets[i % len(sheets)]
+        page, _ = row_bench.generate_synthetic_page(size, dpi, int(rng.integers(0, 30)), seed + i)
+        extension = ".png" if i % 4 == 3 else ".jpg"
+        _, encoded = cv2.imencode(extension, page)
+        documents.append((extension, encoded.tobytes()))
+
+    bucket = workspace / "input"
+    index_folder = workspace / "index"
+    bucket.mkdir(parents=True, exist_ok=True)
+    index_folder.mkdir(parents=True, exist_ok=True)
+
+    with (index_folder / "index.txt").open("w", encoding="utf-8", newline="") as index:
+        for i in range(file_count):
+            extension, content = documents[i % len(documents)]
+            name = f"synthetic/document-{i:07d}{extension}"
+
+            (bucket / name).parent.mkdir(parents=True, exist_ok=True)
+            (bucket / name).write_bytes(content)
+            index.write(name + "\n")
+
+    return index_folder
+
+
+def _initialize_worker(root, storage_latency, ocr_settings):
+    logging.getLogger().setLevel(logging.WARNING)
+
+    row.STORAGE_CLIENT = LocalStorageClient(root, storage_latency)
+    row_ocr.AI_CLIENT = FakeDocumentAIClient(seed=getpid(), **ocr_settings)
+
+
+def _run_task(phase, job_name, index_folder, task_index, task_count, total_size):
+    start = time()
+
+    if phase == "mosaic":
+        row_mosaic.mosaic_all_circles(
+            job_name, "gs://input", "output", str(index_folder), task_index, task_count, total_size
+        )
+        results = None
+    else:
+        inputs = SimpleNamespace(
+            job_name=job_name,
+            input_bucket="gs://output",
+            output_location="output",
+            file_index=str(index_folder),
+            task_index=task_index,
+            task_count=task_count,
+            total_size=total_size,
+            project_number=0,
+            processor_id="simulated",
+        )
+        results = len(row_ocr.ocr_all_mosaics(inputs))
+
+    return {"task": task_index, "start": start, "end": time(), "results": results}
+
+
+def _run_worker(phase, job_name, queue_location, worker_index):
+    start = time()
+    queue = row_queue.get_queue(queue_location)
+
+    if phase == "mosaic":
+        summary = row_mosaic.mosaic_queued_objects(job_name, "gs://input", "output", queue, worker_index)
+    else:
+        inputs = SimpleNamespace(
+            job_name=job_name,
+            input_bucket="gs://output",
+            output_location="output",
+            task_index=worker_index,
+            project_number=0,
+            processor_id="simulated",
+        )
+        summary = row_ocr.ocr_queued_mosaics(inputs, queue)
+
+    queue.close()
+
+    return {"task": worker_index, "start": start, "end": time(), "results": summary["items"]}
+
+
+def _write_index(folder, names):
+    folder.mkdir(parents=True, exist_ok=True)
+    (folder / "index.txt").write_text("".join(f"{name}\n" for name in names), encoding="utf-8")
+
+    return folder
+
+
+def _list_mosaics(workspace, job_name):
+    return [blob.name for blob in LocalStorageClient(workspace).list_blobs("output", prefix=f"{job_name}/mosaics/")]
+
+
+def summarize_tasks(tasks):
+    """summarize the task timings of a phase
+
+    Args:
+        tasks (list): the task records with `start` and `end` times
+
+    Returns:
+        dict: the makespan and the distribution of task durations
+    """
+    if not tasks:
+        return {"makespan seconds": 0.0, "tasks": 0}
+
+    durations = np.array([task["end"] - task["start"] for task in tasks])
+    median = float(np.percentile(durations, 50))
+
+    return {
+        "makespan seconds": max(task["end"] for task in tasks) - min(task["start"] for task in tasks),
+        "tasks": len(tasks),
+        "task seconds p50": median,
+        "task seconds p90": float(np.percentile(durations, 90)),
+        "task seconds p99": float(np.percentile(durations, 99)),
+        "task seconds max": float(durations.max()),
+        "straggler ratio": float(durations.max() / median) if median else 0.0,
+    }
+
+
+def _run_phase(executor, phase, job_name, index_folder, task_count, total_size):
+    futures = [
+        executor.submit(_run_task, phase, job_name, index_folder, task_index, task_count, total_size)
+        for task_index in range(task_count)
+    ]
+
+    return [future.result() for future in futures]
+
+
+def simulate(
+    workspace,
+    file_count=100,
+    task_counts=(1, 2, 4),
+    parallelism=None,
+    storage_latency=0.05,
+    ocr_settings=None,
+    distinct=20,
+    sheets=None,
+):
+    """run the mosaic and ocr jobs end to end against local storage and a fake ocr service for each task count
+
+    Args:
+        workspace (str): the directory for the simulated buckets. it is emptied first when the simulator created it
+        file_count (int): the number of synthetic files to process
+        task_counts (list): the task counts to simulate
+        parallelism (int): the number of tasks running at once. defaults to the number of cpus
+        storage_latency (float): the seconds added to every storage request
+        ocr_settings (dict): `latency`, `jitter` and `failure_rate` for the `FakeDocumentAIClient`
+        distinct (int): the number of different synthetic sheets
+        sheets (list): (sheet size, dpi) tuples to draw. defaults to `SIMULATION_SHEETS`
+
+    Returns:
+        list(dict): the makespan, task duration distribution and throughput for each task count
+    """
+    workspace = prepare_workspace(workspace)
+
+    parallelism = parallelism or cpu_count() or 1
+    ocr_settings = {"latency": 0.5, "jitter": 0.5, "failure_rate": 0.0, **(ocr_settings or {})}
+    index_folder = create_synthetic_run(workspace, file_count, distinct, sheets)
+    reports = []
+
+    #: spawn the workers so they start like a fresh task and do not fork opencv's threads
+    with ProcessPoolExecutor(
+        max_workers=parallelism,
+        mp_context=get_context("spawn"),
+        initializer=_initialize_worker,
+        initargs=(str(workspace), storage_latency, ocr_settings),
+    ) as executor:
+        for task_count in task_counts:
+            job_name = f"simulation-{task_count}"
+            logging.info("simulating %i files with %i tasks, %i at a time", file_count, task_count, parallelism)
+
+            mosaic_tasks = _run_phase(executor, "mosaic", job_name, index_folder, task_count, file_count)
+
+            #: index the mosaics with their full names so the ocr tasks can read them from the output bucket
+            mosaics = _list_mosaics(workspace, job_name)
+            ocr_index = _write_index(workspace / f"{job_name}-ocr-index", mosaics)
+
+            ocr_tasks = _run_phase(executor, "ocr", job_name, ocr_index, task_count, max(len(mosaics), 1))
+
+            mosaic = summarize_tasks(mosaic_tasks)
+            ocr = summarize_tasks(ocr_tasks)
+            ocr["mosaics"] = len(mosaics)
+            ocr["failures"] = len(mosaics) - sum(task["results"] for task in ocr_tasks)
+            makespan = mosaic["makespan seconds"] + ocr["makespan seconds"]
+
+            reports.append(
+                {
+                    "tasks": task_count,
+                    "parallelism": parallelism,
+                    "files": file_count,
+                    "mosaic": mosaic,
+                    "ocr": ocr,
+                    "makespan seconds": makespan,
+                    "files per second": file_count / makespan if makespan else 0.0,
+                }
+            )
+
+    return reports
+
+
+def compare_worker_modes(
+    workspace,
+    file_count=100,
+    task_count=20,
+    parallelism=None,
+    storage_latency=0.05,
+    ocr_settings=None,
+    distinct=20,
+    sheets=None,
+):
+    """run the jobs end to end the way cloud run starts tasks, a fresh process for each slice of the index, and as
+    long running workers that lease objects from a queue. the workers pay the process start, imports and client
+    set up once instead of once per task
+
+    Args:
+        workspace (str): the directory for the simulated buckets. it is emptied first when the simulator created it
+        file_count (int): the number of synthetic files to process
+        task_count (int): the number of tasks the index is split into for the per task model
+        parallelism (int): the number of tasks or workers running at once. defaults to the number of cpus
+        storage_latency (float): the seconds added to every storage request
+        ocr_settings (dict): `latency`, `jitter` and `failure_rate` for the `FakeDocumentAIClient`
+        distinct (int): the number of different synthetic sheets
+        sheets (list): (sheet size, dpi) tuples to draw. defaults to `SIMULATION_SHEETS`
+
+    Returns:
+        dict: the makespan and throughput of the `tasks` and `queue` models and the speed up of the queue
+    """
+    workspace = prepare_workspace(workspace)
+
+    parallelism = parallelism or cpu_count() or 1
+    ocr_settings = {"latency": 0.5, "jitter": 0.5, "failure_rate": 0.0, **(ocr_settings or {})}
+    index_folder = create_synthetic_run(workspace, file_count, distinct, sheets)
+    files = (index_folder / "index.txt").read_text(encoding="utf-8").splitlines()
+    reports = {}
+
+    for mode in ("tasks", "queue"):
+        job_name = f"comparison-{mode}"
+        processes = task_count if mode == "tasks" else parallelism
+        phases = {}
+        start = time()
+
+        #: every task or worker gets a fresh process so it pays the start up like a cloud run task
+        with get_context("spawn").Pool(
+            parallelism, _initialize_worker, (str(workspace), storage_latency, ocr_settings), maxtasksperchild=1
+        ) as pool:
+            for phase in ("mosaic", "ocr"):
+                phase_start = time()
+
+                if phase == "mosaic":
+                    names, phase_index = files, index_folder
+                else:
+                    names = _list_mosaics(workspace, job_name)
+                    phase_index = _write_index(workspace / f"{job_name}-ocr-index", names)
+
+                if mode == "tasks":
+                    arguments = [
+                        (phase, job_name, phase_index, task_index, processes, max(len(names), 1))
+                        for task_index in range(processes)
+                    ]
+                    tasks = pool.starmap(_run_task, arguments)
+                else:
+                    queue_location = str(workspace / f"{job_name}-{phase}-queue.sqlite")
+                    queue = row_queue.get_queue(queue_location)
+                    queue.add(names)
+                    queue.close()
+                    tasks = pool.starmap(
+                        _run_worker, [(phase, job_name, queue_location, worker) for worker in range(processes)]
+                    )
+
+                phases[phase] = {**summarize_tasks(tasks), "phase seconds": time() - phase_start}
+
+        makespan = time() - start
+
+        reports[mode] = {
+            "processes": processes,
+            "mosaic": phases["mosaic"],
+            "ocr": phases["ocr"],
+            "makespan seconds": makespan,
+            "files per second": file_count / makespan if makespan else 0.0,
+        }
+
+    reports["speed up"] = reports["tasks"]["makespan seconds"] / reports["queue"]["makespan seconds"]
+
+    return reports
+
+
+def compare_downloads(
+    workspace,
+    size_mb=256,
+    latency=0.05,
+    bandwidth_mb=50,
+    slow_rate=0.05,
+    slow_latency=2.0,
+    chunk_mb=16,
+    workers=8,
+    repeat=3,
+    seed=0,
+):
+    """download a large object from a local store with injected latency as one stream and with the ranged
+    downloader. the store limits the bandwidth of each request, like a single cloud storage stream, and makes a share
+    of the requests slow
+
+    Args:
+        workspace (str): the directory for the simulated bucket. it is emptied first when the simulator created it
+        size_mb (int): the size of the object
+        latency (float): the seconds added to every request
+        bandwidth_mb (float): the megabytes per second of each request
+        slow_rate (float): the share of requests that are slow
+        slow_latency (float): the seconds added to a slow request
+        chunk_mb (int): the size of each ranged request
+        workers (int): the number of ranged requests in flight
+        repeat (int): the number of downloads for each mode
+        seed (int): the random seed of the slow requests
+
+    Returns:
+        dict: the seconds and throughput of the `single` and `ranged` modes, the hedges and the speed up
+    """
+    workspace = prepare_workspace(workspace)
+
+    size = size_mb * 1024 * 1024
+    content = np.random.default_rng(seed).integers(0, 256, size, dtype=np.uint8).tobytes()
+    (workspace / "input").mkdir(parents=True)
+    (workspace / "input" / "large.pdf").write_bytes(content)
+
+    client = LocalStorageClient(workspace, latency, bandwidth_mb * 1024 * 1024, slow_rate, slow_latency, seed)
+    bucket = client.bucket("input")
+    downloader = row_download.RangedDownloader(chunk_mb * 1024 * 1024, workers)
+    reports = {}
+
+    try:
+        for mode in ("single", "ranged"):
+            seconds = []
+            hedges = 0
+
+            for _ in range(repeat):
+                start = time()
+
+                if mode == "single":
+                    downloaded = bucket.blob("large.pdf").download_as_bytes()
+                else:
+                    downloaded, stats = downloader.download(bucket, "large.pdf")
+                    hedges += stats["hedges"]
+
+                seconds.append(time() - start)
+
+                if downloaded != content:
+                    raise ValueError(f"the {mode} download does not match the object")
+
+            reports[mode] = {
+                "seconds": seconds,
+                "MB/s": size_mb * len(seconds) / sum(seconds),
+                "hedges": hedges,
+            }
+    finally:
+        downloader.close()
+
+    reports["speed up"] = sum(reports["single"]["seconds"]) / sum(reports["ranged"]["seconds"])
+
+    return reports
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+"""
+UDOT Right of Way (ROW) Parcel Number Extraction
+Keyed storage for small records shared between cloud run tasks, like detection results
+"""
+
+import logging
+from os import replace
+from pathlib import Path
+from uuid import uuid4
+
+from google.api_core.exceptions import NotFound
+
+
+class LocalStore:
+    """a store that keeps each record as a file in a local directory"""
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+
+    def get(self, key):
+        """read a record
+
+        Args:
+            key (str): the record key
+
+        Returns:
+            bytes: the record or None if the key does not exist
+        """
+        path = self.folder / key
+
+        if not path.exists():
+            return None
+
+        return path.read_bytes()
+
+    def put(self, key, content):
+        """write a record. the record is written to a temporary file and moved into place so concurrent readers never
+        see a partial record
+
+        Args:
+            key (str): the record key
+            content (bytes): the record
+        """
+        path = self.folder / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        temporary = path.with_name(f".{path.name}.{uuid4().hex}")
+        temporary.write_bytes(content)
+
+        replace(temporary, path)
+
+    def list(self, folder):
+        """list the keys of the records in a folder
+
+        Args:
+            folder (str): the folder key
+
+        Returns:
+            list(str): the record keys in name order
+        """
+        path = self.folder / folder
+
+        if not path.is_dir():
+            return []
+
+        return sorted(
+            item.relative_to(self.folder).as_posix()
+            for item in path.rglob("*")
+            if item.is_file() and not item.name.startswith(".")
+        )
+
+
+class BucketStore:
+    """a store that keeps each record as a blob in a cloud storage bucket"""
+
+    def __init__(self, client, location):
+        bucket_name, _, prefix = location[5:].partition("/")
+
+        self.bucket = client.bucket(bucket_name)
+        self.prefix = f"{prefix.rstrip('/')}/" if prefix else ""
+
+    def get(self, key):
+        """read a record
+
+        Args:
+            key (str): the record key
+
+        Returns:
+            bytes: the record or None if the key does not exist
+        """
+        try:
+            return self.bucket.blob(f"{self.prefix}{key}").download_as_bytes()
+        except NotFound:
+            return None
+
+    def put(self, key, content):
+        """write a record
+
+        Args:
+            key (str): the record key
+            content (bytes): the record
+        """
+        self.bucket.blob(f"{self.prefix}{key}").upload_from_string(content)
+
+    def list(self, folder):
+        """list the keys of the records in a folder
+
+        Args:
+            folder (str): the folder key
+
+        Returns:
+            list(str): the record keys in name order
+        """
+        blobs = self.bucket.list_blobs(prefix=f"{self.prefix}{folder.rstrip('/')}/")
+
+        return sorted(blob.name[len(self.prefix) :] for blob in blobs)
+
+
+def get_store(location, client=None):
+    """create a store for a local directory or a cloud storage location. Cloud storage locations must start with
+    `gs://` and can include a prefix, `gs://bucket-name/prefix`
+
+    Args:
+        location (str): the directory or bucket location
+        client (google.cloud.storage.Client): the storage client for bucket locations
+
+    Returns:
+        LocalStore|BucketStore: the store
+    """
+    if location.startswith("gs://"):
+        if client is None:
+            raise ValueError("a storage client is required for bucket locations")
+
+        logging.info("using bucket store %s", location)
+
+        return BucketStore(client, location)
+
+    logging.info("using local store %s", location)
+
+    return LocalStore(location)
@@ -5,12 +5,46 @@ test_row.py
 A module that contains tests for the project module.
 """
 
+import base64
+import json
+import logging
+import sys
+import threading
+import tracemalloc
+from io import BytesIO
 from pathlib import Path
+from types import SimpleNamespace
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
 
+import cv2
 import numpy as np
+import pandas as pd
 import pytest
+from google.api_core.exceptions import InternalServerError, NotFound, ServiceUnavailable
 
 import row
+import row_bench
+import row_cache
+import row_detect
+import row_download
+import row_fused
+import row_logging
+import row_merge
+import row_metrics
+import row_mosaic
+import row_ocr
+import row_pack
+import row_parcels
+import row_plan
+import row_profile
+import row_queue
+import row_render
+import row_reocr
+import row_service
+import row_sim
+import row_store
+import row_tune
 
 root = Path(__file__).parent / "test-data"
 
@@ -18,7 +52,7 @@ root = Path(__file__).parent / "test-data"
 def test_convert_pdf_to_pil_single_page_pdf():
     pdf = root / "single_page.PDF"
 
-    images, count, _ = row.convert_pdf_to_jpg_bytes(pdf.read_bytes(), "test_pdf")
+    images, count, _ = row_render.convert_pdf_to_jpg_bytes(pdf.read_bytes(), "test_pdf")
 
     assert count == 1
     assert images is not None
@@ -27,7 +61,7 @@ def test_convert_pdf_to_pil_single_page_pdf():
 def test_convert_pdf_to_pil_multi_page_pdf():
     pdf = root / "multiple_page.pdf"
 
-    images, count, _ = row.convert_pdf_to_jpg_bytes(pdf.read_bytes(), "test_pdf")
+    images, count, _ = row_render.convert_pdf_to_jpg_bytes(pdf.read_bytes(), "test_pdf")
 
     assert count == 5
     assert images is not None
@@ -36,14 +70,14 @@ def test_convert_pdf_to_pil_multi_page_pdf():
 def test_convert_pdf_to_pil_handles_invalid_pdf():
     pdf = root / "invalid.pdf"
 
-    _, count, message = row.convert_pdf_to_jpg_bytes(pdf.read_bytes(), "test_pdf")
+    _, count, message = row_render.convert_pdf_to_jpg_bytes(pdf.read_bytes(), "test_pdf")
 
     assert count == 0
     assert message != ""
 
 
 def test_convert_pdf_to_pil_handles_empty_bytes():
-    _, count, message = row.convert_pdf_to_jpg_bytes(None, "test_pdf")
+    _, count, message = row_render.convert_pdf_to_jpg_bytes(None, "test_pdf")
 
     assert count == 0
     assert message != ""
@@ -78,7 +112,7 @@ def test_get_files_from_index_returns_the_page_size_for_the_second_page():
 def test_get_circles_finds_circles():
     image = root / "five_circles_with_text.png"
 
-    circles = row.get_circles_from_image_bytes(image.read_bytes(), None, image.name)
+    circles = row_mosaic.get_circles_from_image_bytes(image.read_bytes(), None, image.name)
 
     assert circles is not None
 
@@ -89,7 +123,7 @@ def test_get_circles_saves_images_to_output():
     image = root / "five_circles_with_text.png"
     output = Path(__file__).parent / "data" / "nested"
 
-    row.get_circles_from_image_bytes(image.read_bytes(), output, image.name)
+    row_mosaic.get_circles_from_image_bytes(image.read_bytes(), output, image.name)
 
     assert output.exists()
 
@@ -98,21 +132,21 @@ def test_get_circles_saves_images_to_output():
 
 @pytest.mark.parametrize("input,expected", [(None, np.array(None)), ([], np.array(None)), (list([]), np.array(None))])
 def test_build_mosaic_image_handles_empty_list(input, expected):
-    image = row.build_mosaic_image(input, "name", None)
+    image = row_pack.build_mosaic_image(input, "name", None)
     assert image == expected
 
 
 @pytest.mark.parametrize("input", [None, np.array(None)])
 def test_upload_mosaic_handles_empty_np_array(input):
-    assert row.upload_mosaic(input, "name", None, "tests") == False
+    assert row_pack.upload_mosaic(input, "name", None, "tests") == False
 
 
 def test_build_mosaic_image_handles_builds_a_mosaic():
     images = []
     for item_path in root.glob("crop_*"):
-        images.append(row.convert_to_cv2_image(item_path.read_bytes()))
+        images.append(row_mosaic.convert_to_cv2_image(item_path.read_bytes()))
 
-    mosaic = row.build_mosaic_image(images, "test", None)
+    mosaic = row_pack.build_mosaic_image(images, "test", None)
 
     assert mosaic is not None
 
@@ -134,9 +168,1320 @@ def test_get_first_and_last_index(task_index, task_count, total_size, expected):
 def test_can_mosaic_non_square_crops():
     image = root / "edge_crop.jpg"
 
-    cv2_image = row.convert_to_cv2_image(image.read_bytes())
+    cv2_image = row_mosaic.convert_to_cv2_image(image.read_bytes())
 
-    mosaic = row.build_mosaic_image([cv2_image], "edge_crop.jpg", None)
+    mosaic = row_pack.build_mosaic_image([cv2_image], "edge_crop.jpg", None)
 
     assert mosaic is not None
     assert mosaic.shape == (112, 112, 3)
+
+
+@pytest.mark.parametrize(
+    "color_mode,expected", [("color", (112, 112, 3)), ("gray", (112, 112)), ("binary", (112, 112))]
+)
+def test_build_mosaic_image_color_modes(color_mode, expected):
+    image = root / "edge_crop.jpg"
+
+    cv2_image = row_mosaic.convert_to_cv2_image(image.read_bytes())
+
+    mosaic = row_pack.build_mosaic_image([cv2_image], "edge_crop.jpg", None, color_mode)
+
+    assert mosaic.shape == expected
+
+    if color_mode == "binary":
+        assert set(np.unique(mosaic)) <= {0, 255}
+
+
+@pytest.mark.parametrize(
+    "codec,mime_type",
+    [("jpg", "image/jpeg"), ("png", "image/png"), ("tiff-lzw", "image/tiff"), ("tiff-ccitt", "image/tiff")],
+)
+def test_encode_mosaic_matches_mime_type(codec, mime_type):
+    image = root / "edge_crop.jpg"
+
+    cv2_image = row_mosaic.convert_to_cv2_image(image.read_bytes())
+    mosaic = row_pack.build_mosaic_image([cv2_image], "edge_crop.jpg", None, "binary")
+
+    content, encoded_mime_type = row_pack.encode_mosaic(mosaic, codec, 80)
+
+    assert encoded_mime_type == mime_type
+    assert row_ocr.get_mime_type(content) == mime_type
+    assert row_mosaic.convert_to_cv2_image(content).shape == (112, 112, 3)
+
+
+def test_get_mosaic_options_uses_defaults_and_rejects_unknown_codecs():
+    options = row_mosaic.get_mosaic_options(codec="png", quality=None)
+
+    assert options.codec == "png"
+    assert options.color_mode == "color"
+    assert options.quality == 95
+
+    with pytest.raises(ValueError):
+        row_mosaic.get_mosaic_options(codec="gif")
+
+
+def test_benchmark_mosaic_encodings_reports_each_encoding():
+    image = root / "edge_crop.jpg"
+
+    cv2_image = row_mosaic.convert_to_cv2_image(image.read_bytes())
+
+    results = row_pack.benchmark_mosaic_encodings([cv2_image], "edge_crop.jpg", ocr=lambda content: "1234")
+
+    assert len(results) == len(row_pack.BENCHMARK_ENCODINGS)
+    assert all(result["agreement"] == 1 for result in results)
+    assert results[0]["pixel bytes"] == 3 * results[1]["pixel bytes"]
+
+
+def test_filter_circle_crops_drops_empty_and_solid_crops():
+    blank = np.full((80, 80, 3), 255, dtype=np.uint8)
+    solid = np.zeros((90, 90, 3), dtype=np.uint8)
+    text = np.full((80, 80, 3), 255, dtype=np.uint8)
+    cv2.putText(text, "123", (8, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 0), 2)
+
+    features = row_mosaic.score_circle_crops([blank, solid, text])
+
+    assert features["components"].tolist() == [0, 1, 3]
+
+    kept, dropped = row_mosaic.filter_circle_crops([blank, solid, text])
+
+    assert dropped == 2
+    assert kept[0] is text
+
+
+def test_filter_circle_crops_handles_no_crops():
+    assert row_mosaic.filter_circle_crops([]) == ([], 0)
+
+
+@pytest.mark.parametrize("value,expected", [("1", True), ("true", True), ("False", False), ("", False), (None, False)])
+def test_to_bool(value, expected):
+    assert row.to_bool(value) == expected
+
+
+def draw_page_with_circles(width=2200, height=1700):
+    page = np.full((height, width, 3), 255, dtype=np.uint8)
+    radius = int(0.025 * height) + 5
+
+    for i, (x, y) in enumerate([(300, 300), (900, 500), (1500, 1200), (600, 1300), (1900, 400)]):
+        cv2.circle(page, (x, y), radius, (0, 0, 0), 3)
+        cv2.putText(page, str(100 + i), (x - radius // 2 - 8, y + 8), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 0), 2)
+
+    return page
+
+
+def test_local_store_round_trips_records(tmp_path):
+    store = row_store.get_store(str(tmp_path / "store"))
+
+    assert store.get("missing.json") is None
+
+    store.put("nested/key.json", b"content")
+
+    assert store.get("nested/key.json") == b"content"
+    assert store.list("nested") == ["nested/key.json"]
+    assert store.list("missing") == []
+
+
+def test_page_hash_index_reuses_detections_for_duplicate_pages(tmp_path):
+    hash_index = row_cache.PageHashIndex(row_store.LocalStore(tmp_path))
+    page = draw_page_with_circles()
+    _, original = cv2.imencode(".png", page)
+    _, smaller = cv2.imencode(".png", cv2.resize(page, (1100, 850), interpolation=cv2.INTER_AREA))
+
+    first = row_mosaic.get_circles_from_image_bytes(original.tobytes(), None, "original.png", hash_index)
+    second = row_mosaic.get_circles_from_image_bytes(original.tobytes(), None, "copy.png", hash_index)
+
+    #: a fresh index over the same store simulates another task
+    other_task = row_cache.PageHashIndex(row_store.LocalStore(tmp_path))
+    third = row_mosaic.get_circles_from_image_bytes(smaller.tobytes(), None, "export.png", other_task)
+
+    assert len(first) == len(second) == len(third) == 5
+    assert hash_index.summary() == {"hits": 1, "misses": 1, "hit rate": 0.5}
+    assert other_task.hits == 1
+    assert third[0].shape[0] == pytest.approx(first[0].shape[0] / 2, abs=25)
+
+
+def test_page_hash_index_misses_different_pages(tmp_path):
+    hash_index = row_cache.PageHashIndex(row_store.LocalStore(tmp_path))
+    page = draw_page_with_circles()
+    blank = np.full_like(page, 255)
+
+    hash_index.record(row_cache.get_page_signature(page), None, 4)
+
+    assert hash_index.lookup(row_cache.get_page_signature(blank)) is None
+    assert hash_index.lookup(row_cache.get_page_signature(page)) == (None, 4)
+
+
+def test_page_hash_index_finds_near_duplicates_and_keeps_colliding_pages(tmp_path):
+    hash_index = row_cache.PageHashIndex(row_store.LocalStore(tmp_path))
+    page = draw_page_with_circles()
+    signature = row_cache.get_page_signature(page)
+    hash_index.record(signature, None, 4)
+
+    #: a rescan flips a few hash bits but its thumbnail still matches
+    flipped = f"{int(signature['hash'], 16) ^ 0b1011:064x}"
+    other_task = row_cache.PageHashIndex(row_store.LocalStore(tmp_path))
+
+    assert other_task.lookup({**signature, "hash": flipped}) == (None, 4)
+    assert other_task.lookup({**signature, "hash": f"{int(signature['hash'], 16) ^ (2**40 - 1):064x}"}) is None
+
+    #: a different page with the same hash is kept next to the first one
+    blank = row_cache.get_page_signature(np.full_like(page, 255))
+    hash_index.record({**blank, "hash": signature["hash"]}, None, 9)
+    other_task = row_cache.PageHashIndex(row_store.LocalStore(tmp_path))
+
+    assert other_task.lookup(signature) == (None, 4)
+    assert other_task.lookup({**blank, "hash": signature["hash"]}) == (None, 9)
+
+
+def test_page_hash_index_keeps_the_records_of_every_task(tmp_path):
+    page = draw_page_with_circles()
+    signature = row_cache.get_page_signature(page)
+    blank = row_cache.get_page_signature(np.full_like(page, 255))
+    flipped = f"{int(signature['hash'], 16) ^ 0b1011:064x}"
+
+    #: both tasks read the empty index before either one records a page
+    first_task = row_cache.PageHashIndex(row_store.LocalStore(tmp_path))
+    second_task = row_cache.PageHashIndex(row_store.LocalStore(tmp_path))
+
+    assert first_task.lookup(signature) is None
+    assert second_task.lookup({**blank, "hash": flipped}) is None
+
+    first_task.record(signature, None, 4)
+    second_task.record({**blank, "hash": flipped}, None, 9)
+
+    assert first_task.lookup({**blank, "hash": flipped}) == (None, 9)
+    assert second_task.lookup(signature) == (None, 4)
+
+
+def test_generate_synthetic_page_is_deterministic():
+    page, labels = row_bench.generate_synthetic_page("letter", 100, 8, seed=3)
+    same_page, same_labels = row_bench.generate_synthetic_page("letter", 100, 8, seed=3)
+
+    assert page.shape == (1100, 850, 3)
+    assert len(labels) == 8
+    assert labels == same_labels
+    assert np.array_equal(page, same_page)
+
+
+def test_match_circles_counts_matches_once():
+    labels = [(100, 100, 20, "1"), (300, 300, 20, "2")]
+    circles = np.array([[[101, 99, 20], [102, 101, 20], [500, 500, 20]]], dtype=np.float32)
+
+    result = row_bench.match_circles(circles, labels)
+
+    assert result["true positives"] == 1
+    assert result["false positives"] == 2
+    assert result["false negatives"] == 1
+    assert result["recall"] == 0.5
+
+
+def test_benchmark_case_measures_stages_and_recall():
+    result = row_bench.benchmark_case("letter", 100, 5, repeat=1)
+
+    assert result["case"] == "letter-100dpi-5"
+    assert result["detection"]["recall"] == 1
+    assert result["stages"]["detect_circles"]["peak bytes"] > 0
+    assert set(result["stages"]) >= {"get_circles_from_image_bytes", "export_circles_from_image", "build_mosaic_image"}
+
+
+def test_measure_times_without_tracing_memory():
+    tracing = []
+
+    def allocate():
+        tracing.append(tracemalloc.is_tracing())
+
+        return bytearray(1_000_000)
+
+    _, measurement = row_bench.measure(allocate, repeat=2)
+
+    assert tracing == [False, False, True]
+    assert measurement["peak bytes"] >= 1_000_000
+
+
+def test_parse_cases_reads_and_rejects_benchmark_cases():
+    assert row_bench.parse_cases("letter:300:10, arch-d:150:40") == [("letter", 300, 10), ("arch-d", 150, 40)]
+
+    for text in ("letter:300", "letter:300:ten", "legal:300:10"):
+        with pytest.raises(ValueError, match="is not a benchmark case"):
+            row_bench.parse_cases(text)
+
+
+def test_compare_benchmarks_reports_regressions():
+    baseline = {
+        "cases": [
+            {
+                "case": "letter-100dpi-5",
+                "stages": {"detect_circles": {"min seconds": 1.0, "peak bytes": 100}},
+                "detection": {"recall": 1.0},
+            }
+        ]
+    }
+    results = {
+        "cases": [
+            {
+                "case": "letter-100dpi-5",
+                "stages": {"detect_circles": {"min seconds": 1.5, "peak bytes": 100}},
+                "detection": {"recall": 0.5},
+            }
+        ]
+    }
+
+    regressions = row_bench.compare_benchmarks(results, baseline)
+
+    assert len(regressions) == 2
+    assert row_bench.compare_benchmarks(baseline, baseline) == []
+
+    #: a small recall drop is a regression even though time and memory get a relative tolerance
+    results["cases"][0].update(stages=baseline["cases"][0]["stages"], detection={"recall": 0.95})
+
+    assert row_bench.compare_benchmarks(results, baseline) == ["letter-100dpi-5 recall dropped from 100.0% to 95.0%"]
+
+
+def test_local_storage_client_reads_ranges_and_lists_blobs(tmp_path):
+    client = row_sim.LocalStorageClient(tmp_path)
+    bucket = client.bucket("bucket")
+
+    bucket.blob("folder/file.txt").upload_from_string(b"0123456789", content_type="text/plain")
+
+    assert bucket.blob("folder/file.txt").download_as_bytes() == b"0123456789"
+    assert bucket.blob("folder/file.txt").download_as_bytes(start=2, end=4) == b"234"
+    assert [blob.name for blob in client.list_blobs("bucket", prefix="folder/")] == ["folder/file.txt"]
+
+    with pytest.raises(NotFound):
+        bucket.blob("missing.txt").download_as_bytes()
+
+
+def test_ranged_downloader_assembles_chunks_in_order(tmp_path):
+    content = np.random.default_rng(0).integers(0, 256, 10_500, dtype=np.uint8).tobytes()
+    bucket = row_sim.LocalStorageClient(tmp_path).bucket("input")
+    bucket.blob("large.pdf").upload_from_string(content)
+    bucket.blob("small.png").upload_from_string(content[:900])
+    downloader = row_download.RangedDownloader(chunk_bytes=1000, workers=4)
+
+    try:
+        large, large_stats = downloader.download(bucket, "large.pdf")
+        small, small_stats = downloader.download(bucket, "small.png")
+    finally:
+        downloader.close()
+
+    assert isinstance(large, bytearray)
+    assert large == content
+    assert large_stats == {"chunks": 11, "hedges": 0}
+    assert small == content[:900]
+    assert small_stats == {"chunks": 1, "hedges": 0}
+
+
+def test_ranged_download_can_be_read_by_documentai(tmp_path):
+    page, _ = row_bench.generate_synthetic_page("letter", 100, 4, seed=1)
+    content = cv2.imencode(".png", page)[1].tobytes()
+    bucket = row_sim.LocalStorageClient(tmp_path).bucket("input")
+    bucket.blob("mosaic.png").upload_from_string(content)
+    downloader = row_download.RangedDownloader(chunk_bytes=1000, workers=4)
+
+    try:
+        downloaded = row_download.download(bucket, "mosaic.png", downloader)
+    finally:
+        downloader.close()
+
+    response = row_ocr.ocr_image_bytes(row_sim.FakeDocumentAIClient(latency=0), "processor", downloaded)
+
+    assert len(content) > 1000
+    assert response.document.text == f"simulated text for {len(content)} bytes"
+
+
+def test_ocr_image_bytes_counts_every_retried_attempt(monkeypatch):
+    monkeypatch.setattr(row_ocr, "OCR_RETRY", row_ocr.OCR_RETRY.with_delay(initial=0.001, maximum=0.001))
+    row_ocr.METRICS.reset()
+    attempts = []
+
+    def process():
+        attempts.append(len(attempts))
+
+        if len(attempts) < 3:
+            raise ServiceUnavailable("busy")
+
+        return SimpleNamespace(document=SimpleNamespace(text="15"))
+
+    client = SimpleNamespace(process_document=lambda request, retry: retry(process)())
+
+    assert row_ocr.ocr_image_bytes(client, "processor", b"\x89PNG").document.text == "15"
+    assert row_ocr.METRICS.counters["ocr_retries"] == 2
+
+
+def test_ranged_downloader_hedges_slow_chunks(tmp_path):
+    content = np.random.default_rng(0).integers(0, 256, 20_000, dtype=np.uint8).tobytes()
+    client = row_sim.LocalStorageClient(tmp_path, latency=0.01, slow_rate=0.3, slow_latency=1, seed=0)
+    bucket = client.bucket("input")
+    bucket.blob("large.pdf").upload_from_string(content)
+    downloader = row_download.RangedDownloader(chunk_bytes=1000, workers=4, hedge_percentile=50, hedge_min_samples=1)
+    row_download.METRICS.reset()
+
+    try:
+        downloaded = row_download.download(bucket, "large.pdf", downloader)
+    finally:
+        downloader.close()
+
+    assert downloaded == content
+    assert client.slow_requests > 0
+    assert row_download.METRICS.counters["download_hedges"] > 0
+    assert row_download.METRICS.counters["download_chunks"] == 20
+
+
+def test_sampling_filter_keeps_an_even_share_and_every_warning():
+    sampler = row_logging.SamplingFilter(0.25)
+    info = logging.makeLogRecord({"levelno": logging.INFO})
+    warning = logging.makeLogRecord({"levelno": logging.WARNING})
+
+    assert [sampler.filter(info) for _ in range(8)].count(True) == 2
+    assert sampler.filter(warning)
+
+
+def test_log_shipper_batches_records_and_samples_only_the_details():
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    sink = row_logging.LocalSink()
+
+    try:
+        root.setLevel(logging.INFO)
+        shipper = row_logging.ship_logs_in_background(sink, sample_rate=0.1, batch_size=25)
+
+        for index in range(100):
+            logging.getLogger(row_logging.DETAIL_LOGGER).info("pass %i", index)
+
+        for index in range(10):
+            logging.info("object summary %i", index)
+
+        shipper.close()
+    finally:
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+
+        for handler in handlers:
+            root.addHandler(handler)
+
+        root.setLevel(level)
+        row_logging.sample_detail_logs(1.0)
+
+    assert len([line for line in sink.lines if "object summary" in line]) == 10
+    assert len([line for line in sink.lines if "pass" in line]) == 10
+    assert sink.calls < len(sink.lines)
+
+
+def test_log_shipper_reports_failed_batches_and_dropped_records(capsys):
+    def sink(_):
+        raise OSError("sink unavailable")
+
+    shipper = row_logging.LogShipper(sink, batch_size=1)
+    shipper.queue.put(logging.makeLogRecord({"msg": "lost"}))
+    shipper.close()
+
+    assert "unable to ship 1 log records" in capsys.readouterr().err
+
+    handler = row_logging.NonBlockingHandler(row_logging.Queue(1))
+    row_logging.METRICS.reset()
+
+    for _ in range(3):
+        handler.handle(logging.makeLogRecord({"msg": "record"}))
+
+    assert handler.dropped == 2
+    assert row_logging.METRICS.counters["log_records_dropped"] == 2
+
+
+def test_fake_documentai_client_fails_at_the_failure_rate():
+    client = row_sim.FakeDocumentAIClient(latency=0, failure_rate=1)
+    request = SimpleNamespace(raw_document=SimpleNamespace(content=b"image"))
+
+    with pytest.raises(InternalServerError):
+        client.process_document(request)
+
+
+def test_simulate_runs_both_jobs_for_each_task_count(tmp_path):
+    reports = row_sim.simulate(
+        tmp_path / "simulation",
+        file_count=4,
+        task_counts=(1, 2),
+        parallelism=2,
+        storage_latency=0,
+        ocr_settings={"latency": 0},
+        distinct=2,
+        sheets=[("letter", 100)],
+    )
+
+    assert [report["tasks"] for report in reports] == [1, 2]
+    assert all(report["ocr"]["mosaics"] == 4 for report in reports)
+    assert all(report["ocr"]["failures"] == 0 for report in reports)
+    assert reports[1]["mosaic"]["tasks"] == 2
+
+
+def test_prepare_workspace_only_empties_simulator_directories(tmp_path):
+    (tmp_path / "documents").mkdir()
+    (tmp_path / "documents" / "keep.pdf").write_bytes(b"%PDF")
+
+    with pytest.raises(ValueError):
+        row_sim.prepare_workspace(tmp_path / "documents")
+
+    workspace = row_sim.prepare_workspace(tmp_path / "simulation")
+    (workspace / "input").mkdir()
+
+    assert row_sim.prepare_workspace(workspace) == workspace
+    assert (tmp_path / "documents" / "keep.pdf").exists()
+    assert not (workspace / "input").exists()
+
+
+def test_metrics_merge_counters_and_histograms():
+    first = row_metrics.Metrics()
+    first.increment("pages", 2)
+    first.observe("render_seconds", 0.2)
+    second = row_metrics.Metrics()
+    second.increment("pages", 3)
+    second.observe("render_seconds", 45)
+    second.observe("download_bytes", 2048)
+
+    merged = row_metrics.merge_records([first.to_record(task="0"), second.to_record(task="1")], job="test")
+
+    assert merged["tasks"] == 2
+    assert merged["counters"] == {"pages": 5}
+    assert merged["histograms"]["render_seconds"]["count"] == 2
+    assert merged["histograms"]["render_seconds"]["max"] == 45
+    assert sum(merged["histograms"]["render_seconds"]["counts"]) == 2
+    assert merged["histograms"]["download_bytes"]["buckets"] == list(row_metrics.BYTES_BUCKETS)
+
+
+def test_metrics_to_openmetrics():
+    metrics = row_metrics.Metrics()
+    metrics.increment("pages", 2)
+    metrics.observe("circles_per_page", 3)
+    metrics.observe("circles_per_page", 1000)
+
+    text = row_metrics.to_openmetrics(metrics.to_record(job="test"))
+
+    assert '# TYPE row_pages counter\nrow_pages_total{job="test"} 2\n' in text
+    assert 'row_circles_per_page_bucket{job="test",le="5"} 1\n' in text
+    assert 'row_circles_per_page_bucket{job="test",le="+Inf"} 2\n' in text
+    assert 'row_circles_per_page_count{job="test"} 2\n' in text
+    assert text.endswith("# EOF\n")
+
+
+def test_emit_metrics_can_be_downloaded_for_the_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(row, "STORAGE_CLIENT", row_sim.LocalStorageClient(tmp_path), raising=False)
+    row.METRICS.reset()
+    row.METRICS.increment("objects")
+
+    row.emit_metrics("mosaic", "test", 0, "output")
+    row.emit_metrics("mosaic", "test", 1, "output")
+
+    records = row.download_metrics("output", "test")
+
+    assert len(records) == 2
+    assert row_metrics.merge_records(records)["counters"] == {"objects": 2}
+
+
+def test_profile_object_only_reports_objects_over_the_thresholds():
+    options = row_mosaic.get_mosaic_options(profile=True, profile_seconds=1000, profile_memory_mb=1000)
+
+    with row_profile.profile_object("fast.pdf", options) as profiler:
+        np.zeros((100, 100))
+
+    assert profiler.report is None
+
+    options = row_mosaic.get_mosaic_options(profile=True, profile_seconds=0, profile_top=5)
+
+    with row_profile.profile_object("slow.pdf", options) as profiler:
+        page = np.zeros((1000, 1000))
+        row_profile.checkpoint()
+        del page
+
+    assert "object: slow.pdf" in profiler.report
+    assert "cumulative time" in profiler.report
+    assert "allocations at" in profiler.report
+
+
+def test_profile_object_is_disabled_by_default():
+    with row_profile.profile_object("file.pdf", row_mosaic.get_mosaic_options()) as profiler:
+        row_profile.checkpoint()
+
+    assert profiler is None
+
+
+def test_mosaic_all_circles_uploads_mosaics_and_profiles(tmp_path, monkeypatch):
+    client = row_sim.LocalStorageClient(tmp_path)
+    monkeypatch.setattr(row, "STORAGE_CLIENT", client, raising=False)
+    index = row_sim.create_synthetic_run(tmp_path, 2, distinct=1, sheets=[("letter", 100)])
+    options = row_mosaic.get_mosaic_options(profile=True, profile_seconds=0)
+
+    row_mosaic.mosaic_all_circles("test", "gs://input", "output", str(index), 0, 1, 2, options)
+
+    names = [blob.name for blob in client.list_blobs("output")]
+
+    assert "test/mosaics/synthetic/document-0000000.jpg" in names
+    assert "test/profiles/synthetic/document-0000001.jpg.txt" in names
+    assert "test/metrics/mosaic-task-0.json" in names
+
+
+def test_packed_mosaics_hold_small_documents_and_split_their_text_back(tmp_path, monkeypatch):
+    client = row_sim.LocalStorageClient(tmp_path)
+    monkeypatch.setattr(row, "STORAGE_CLIENT", client, raising=False)
+    (tmp_path / "input").mkdir()
+    (tmp_path / "index").mkdir()
+
+    for seed in range(4):
+        page, _ = row_bench.generate_synthetic_page("letter", 150, 2, seed=seed)
+        cv2.imwrite(str(tmp_path / "input" / f"doc-{seed}.png"), page)
+
+    (tmp_path / "index" / "index.txt").write_text("".join(f"doc-{seed}.png\n" for seed in range(4)))
+    options = row_mosaic.get_mosaic_options(pack_pixels=4_000_000)
+
+    row_mosaic.mosaic_all_circles("test", "gs://input", "output", str(tmp_path / "index"), 0, 1, 4, options)
+
+    mosaics = [blob.name for blob in client.list_blobs("output", prefix="test/mosaics/")]
+    manifest = json.loads(client.bucket("output").blob(row.get_manifest_name(mosaics[0])).download_as_bytes())
+
+    (tmp_path / "processed").mkdir()
+    row.generate_index("gs://output", "test/mosaics/", str(tmp_path / "processed"))
+    remaining = row.generate_remaining_index(
+        str(tmp_path / "index"), str(tmp_path / "processed"), None, "gs://output/test/mosaics"
+    )
+
+    assert len(mosaics) == 1
+    assert row.is_packed_mosaic(mosaics[0])
+    assert remaining == set()
+    assert [tile["file_name"] for tile in manifest["tiles"]] == [f"test/mosaics/doc-{i // 2}.png" for i in range(8)]
+
+    text = ""
+    tokens = []
+    for index, tile in enumerate(manifest["tiles"]):
+        left, top, right, bottom = tile["box"]
+        word = f"{index} "
+        tokens.append(
+            SimpleNamespace(
+                layout=SimpleNamespace(
+                    text_anchor=SimpleNamespace(
+                        text_segments=[SimpleNamespace(start_index=len(text), end_index=len(text) + len(word))]
+                    ),
+                    bounding_poly=SimpleNamespace(
+                        normalized_vertices=[
+                            SimpleNamespace(x=x / manifest["width"], y=y / manifest["height"])
+                            for x, y in ((left, top), (right, top), (right, bottom), (left, bottom))
+                        ],
+                        vertices=[],
+                    ),
+                )
+            )
+        )
+        text += word
+
+    rows = row_ocr.split_packed_text(SimpleNamespace(text=text, pages=[SimpleNamespace(tokens=tokens)]), manifest)
+
+    assert rows == [[f"test/mosaics/doc-{seed}.png", f"{seed * 2}\n{seed * 2 + 1}"] for seed in range(4)]
+
+
+def test_fused_run_reads_mosaics_from_memory_with_the_ocr_result_schema(tmp_path, monkeypatch):
+    client = row_sim.LocalStorageClient(tmp_path)
+    ai_client = row_sim.FakeDocumentAIClient(latency=0)
+    monkeypatch.setattr(row, "STORAGE_CLIENT", client, raising=False)
+    monkeypatch.setattr(row_ocr, "AI_CLIENT", ai_client)
+    (tmp_path / "input").mkdir()
+    (tmp_path / "index").mkdir()
+
+    for seed in range(2):
+        page, _ = row_bench.generate_synthetic_page("letter", 150, 2, seed=seed)
+        cv2.imwrite(str(tmp_path / "input" / f"doc-{seed}.png"), page)
+
+    (tmp_path / "index" / "index.txt").write_text("doc-0.png\ndoc-1.png\n")
+    inputs = SimpleNamespace(
+        job_name="test",
+        input_bucket="gs://input",
+        output_location="output",
+        file_index=str(tmp_path / "index"),
+        task_index=0,
+        task_count=1,
+        total_size=2,
+        project_number=1,
+        processor_id="processor",
+        upload_mosaics=False,
+    )
+
+    rows = row_fused.fuse_all_objects(inputs)
+    frame = pd.read_parquet(BytesIO(client.bucket("output").blob("test/task-0.gz").download_as_bytes()))
+
+    assert ai_client.requests == 2
+    assert [name for name, _ in rows] == ["test/mosaics/doc-0.png", "test/mosaics/doc-1.png"]
+    assert list(frame.columns) == ["file_name", "text"]
+    assert frame.values.tolist() == rows
+    assert not list(client.list_blobs("output", prefix="test/mosaics/"))
+
+    inputs.upload_mosaics = True
+    row_fused.fuse_all_objects(inputs, row_mosaic.get_mosaic_options(pack_pixels=4_000_000))
+
+    mosaics = [blob.name for blob in client.list_blobs("output", prefix="test/mosaics/")]
+
+    assert ai_client.requests == 3
+    assert len(mosaics) == 1 and row.is_packed_mosaic(mosaics[0])
+    assert client.bucket("output").blob(row.get_manifest_name(mosaics[0])).exists()
+
+
+def test_low_confidence_tiles_are_queued_and_read_again(tmp_path, monkeypatch):
+    client = row_sim.LocalStorageClient(tmp_path)
+    ai_client = row_sim.FakeDocumentAIClient(latency=0)
+    monkeypatch.setattr(row, "STORAGE_CLIENT", client, raising=False)
+    monkeypatch.setattr(row_ocr, "AI_CLIENT", ai_client)
+    (tmp_path / "input").mkdir()
+    (tmp_path / "index").mkdir()
+    (tmp_path / "mosaics").mkdir()
+
+    for seed in range(2):
+        page, _ = row_bench.generate_synthetic_page("letter", 150, 2, seed=seed)
+        cv2.imwrite(str(tmp_path / "input" / f"doc-{seed}.png"), page)
+
+    (tmp_path / "index" / "index.txt").write_text("doc-0.png\ndoc-1.png\n")
+    row_mosaic.mosaic_all_circles("test", "gs://input", "output", str(tmp_path / "index"), 0, 1, 2)
+
+    manifest = json.loads(client.bucket("output").blob("test/manifests/doc-0.png.json").download_as_bytes())
+
+    assert [tile["file_name"] for tile in manifest["tiles"]] == ["test/mosaics/doc-0.png"] * 2
+
+    (tmp_path / "mosaics" / "index.txt").write_text("test/mosaics/doc-0.png\ntest/mosaics/doc-1.png\n")
+    inputs = SimpleNamespace(
+        job_name="run",
+        input_bucket="gs://output",
+        output_location="results",
+        file_index=str(tmp_path / "mosaics"),
+        task_index=0,
+        task_count=1,
+        total_size=2,
+        project_number=1,
+        processor_id="processor",
+    )
+    row_ocr.ocr_all_mosaics(inputs)
+
+    #: the fake client reads nothing so every tile is empty and queued
+    tokens = row_ocr.load_tokens("results", "run")
+    tiles = row_ocr.select_low_confidence_tiles(tokens)
+
+    assert len(tokens) == 4
+    assert tiles == [row.format_tile_item(f"test/mosaics/doc-{i // 2}.png", i % 2) for i in range(4)]
+
+    left, top, right, bottom = manifest["tiles"][0]["box"]
+    token = SimpleNamespace(
+        layout=SimpleNamespace(
+            confidence=0.99,
+            text_anchor=SimpleNamespace(text_segments=[SimpleNamespace(start_index=0, end_index=5)]),
+            bounding_poly=SimpleNamespace(
+                normalized_vertices=[],
+                vertices=[SimpleNamespace(x=x, y=y) for x, y in ((left, top), (right, bottom))],
+            ),
+        )
+    )
+    document = SimpleNamespace(text="12345", pages=[SimpleNamespace(tokens=[token])])
+    rows = row_ocr.get_token_rows(document, "test/mosaics/doc-0.png", manifest)
+
+    assert rows[0][:6] == ["test/mosaics/doc-0.png", 0, "test/mosaics/doc-0.png", 1, "12345", 0.99]
+    assert row_ocr.select_low_confidence_tiles(pd.DataFrame(rows, columns=row_ocr.TOKEN_COLUMNS)) == [
+        "test/mosaics/doc-0.png#tile=1"
+    ]
+
+    queue = row_queue.SqliteQueue(tmp_path / "queue.db")
+    queue.add(tiles)
+    requests = ai_client.requests
+
+    summary = row_reocr.reocr_queued_tiles(inputs, queue, tiles_per_mosaic=3)
+    results = sorted(blob.name for blob in client.list_blobs("results", prefix="run/reocr/"))
+    frame = pd.concat(
+        [pd.read_parquet(BytesIO(client.bucket("results").blob(name).download_as_bytes())) for name in results]
+    )
+
+    assert summary["items"] == 4
+    assert ai_client.requests - requests == 2
+    assert queue.counts()["done"] == 4
+    assert [row.format_tile_item(mosaic, tile) for mosaic, tile in zip(frame["mosaic"], frame["tile"])] == tiles
+
+    queue.close()
+
+    #: the second read of a tile replaces its first text and the documents without one keep theirs
+    row_ocr.upload_reread_tiles([["test/mosaics/doc-0.png", 1, "67890"]], "results", "extra", "run")
+    row_ocr.merge_run_results(tmp_path / "results" / "run", tmp_path / "merged")
+    merged = pd.read_parquet(tmp_path / "merged" / "results.gz").set_index("file_name")["text"]
+
+    assert merged["test/mosaics/doc-0.png"] == "67890"
+    assert merged["test/mosaics/doc-1.png"].startswith("simulated text")
+
+
+def test_plan_run_extrapolates_a_stratified_sample(tmp_path, monkeypatch):
+    client = row_sim.LocalStorageClient(tmp_path)
+    monkeypatch.setattr(row, "STORAGE_CLIENT", client, raising=False)
+    (tmp_path / "input" / "plans").mkdir(parents=True)
+    page, _ = row_bench.generate_synthetic_page("letter", 100, 3, seed=0)
+
+    for index in range(6):
+        cv2.imwrite(str(tmp_path / "input" / f"plans/doc-{index}.png"), page)
+
+    cv2.imwritemulti(str(tmp_path / "input" / "plans/pages.tif"), [page, page])
+    entries = [f"plans/doc-{index}.png" for index in range(6)] + ["plans/pages.tif"]
+
+    report = row_plan.plan_run("gs://input", entries, sample_size=3, target_seconds=1e-3)
+    strata = {(stratum["type"], stratum["size"]): stratum for stratum in report["strata"]}
+
+    assert report["total files"] == 7
+    assert {key: (stratum["entries"], stratum["sampled"]) for key, stratum in strata.items()} == {
+        (".png", "0-1MB"): (6, 3),
+        (".tif", "0-1MB"): (1, 1),
+    }
+    assert report["totals"]["pages"] == 8
+    assert report["totals"]["circles"] == 24
+    assert report["totals"]["ocr requests"] == 7
+    assert report["recommendation"]["tasks"] == 7
+    assert report["recommendation"]["warnings"]
+    assert row_plan.get_size_class(20 * 1024 * 1024) == "10-50MB"
+    assert row_plan.get_size_class(None) == "unknown"
+
+
+def test_choose_render_dpi_reduces_the_resolution_to_fit_the_budget():
+    arch_e = (36 * 72, 48 * 72)
+    pixels_at_300 = 36 * 300 * 48 * 300
+
+    assert row_render.choose_render_dpi(arch_e, 300, None) == 300
+    assert row_render.choose_render_dpi(arch_e, 300, pixels_at_300 * row_render.RENDER_BYTES_PER_PIXEL) == 300
+    assert row_render.choose_render_dpi(arch_e, 300, pixels_at_300 * row_render.RENDER_BYTES_PER_PIXEL // 2) == 200
+    assert row_render.choose_render_dpi(arch_e, 300, 1) == 72
+    assert row_render.choose_render_dpi(None, 300, 1) == 300
+
+
+def test_parse_pdf_page_sizes():
+    info = {
+        "Pages": 2,
+        "Page    1 size": "612 x 792 pts (letter)",
+        "Page    2 size": "2592.5 x 3456 pts",
+        "Page    2 rot": "0",
+    }
+
+    assert row_render.parse_pdf_page_sizes(info) == {1: (612.0, 792.0), 2: (2592.5, 3456.0)}
+
+
+def test_get_memory_budget_uses_the_megabytes_given():
+    assert row_render.get_memory_budget(512) == 512 * 1024 * 1024
+
+
+def test_export_circles_from_image_masks_outside_the_circle():
+    page, _ = row_bench.generate_synthetic_page("letter", 100, 0)
+    page[:] = 0
+    height, width = page.shape[:2]
+    circles = np.array([[[400.0, 500.0, 30.0], [10.0, 8.0, 25.0]]])
+
+    crops = row_mosaic.export_circles_from_image(circles, None, "page.png", page, height, width, 3)
+
+    assert crops[0].shape == (94, 94, 3)
+    assert crops[0][0, 0].tolist() == [255, 255, 255]
+    assert crops[0][47, 47].tolist() == [0, 0, 0]
+
+    #: circles near the top left edge are cropped at the page edge instead of producing an empty crop
+    assert crops[1].shape == (84, 84, 3)
+    assert crops[1][8, 10].tolist() == [0, 0, 0]
+
+
+def test_job_modules_only_import_the_libraries_of_their_job():
+    results = row_bench.measure_imports(
+        {"shared": ["row"], "mosaic": ["row", "row_mosaic"], "ocr": ["row", "row_ocr"]}, repeat=1
+    )
+
+    assert results["shared"]["libraries"] == []
+    assert "cv2" in results["mosaic"]["libraries"]
+    assert "pandas" not in results["mosaic"]["libraries"]
+    assert "google.cloud.documentai" not in results["mosaic"]["libraries"]
+    assert "pandas" in results["ocr"]["libraries"]
+    assert "cv2" not in results["ocr"]["libraries"]
+    assert results["mosaic"]["seconds"] > 0
+
+
+@pytest.mark.parametrize("detector", ["hough", "hough-alt", "contour"])
+def test_detect_circles_finds_the_synthetic_circles_with_each_detector(detector):
+    page, labels = row_bench.generate_synthetic_page("letter", 150, 8, seed=2)
+
+    circles, inset = row_detect.detect_circles(page, detector)
+
+    assert row_bench.match_circles(circles, labels)["recall"] == 1
+    assert inset > 0
+
+
+def test_get_mosaic_options_rejects_unknown_detectors():
+    with pytest.raises(ValueError):
+        row_mosaic.get_mosaic_options(detector="ransac")
+
+
+def test_compare_detectors_reports_speed_and_accuracy(tmp_path):
+    page, labels = row_bench.generate_synthetic_page("letter", 150, 5, seed=4)
+    cv2.imwrite(str(tmp_path / "page.png"), page)
+    (tmp_path / "labels.json").write_text(json.dumps({"page.png": [label[:3] for label in labels]}), encoding="utf-8")
+
+    results = row_bench.compare_detectors(
+        [], ["hough", "contour"], repeat=1, pages=row_bench.load_labeled_pages(tmp_path / "labels.json")
+    )
+
+    assert set(results["detectors"]) == {"hough", "contour"}
+    assert results["detectors"]["contour"]["recall"] == 1
+    assert results["detectors"]["contour"]["seconds"] > 0
+    assert [result["page"] for result in results["pages"]] == ["page.png", "page.png"]
+
+
+def test_triage_finds_the_synthetic_circles_and_skips_blank_pages():
+    page, labels = row_bench.generate_synthetic_page("letter", 150, 8, seed=2)
+    blank = np.full_like(page, 255)
+
+    circles, _ = row_detect.detect_circles(page, "hough", triage=True)
+    blank_circles, _ = row_detect.detect_circles(blank, "hough", triage=True)
+
+    assert row_bench.match_circles(circles, labels)["recall"] == 1
+    assert blank_circles is None
+
+
+def test_triage_restricts_text_pages_to_small_regions():
+    gray = cv2.cvtColor(row_bench.generate_synthetic_text_page("letter", 150, seed=0), cv2.COLOR_BGR2GRAY)
+    min_rad, max_rad = row_detect.get_radius_range(gray.shape[0], *row_detect.RADIUS_MULTIPLIERS[0])
+
+    regions = row_detect.triage_page(gray, min_rad, max_rad)
+
+    assert sum((right - left) * (bottom - top) for left, top, right, bottom in regions) < gray.size / 4
+
+
+def test_reduced_gray_decode_finds_circles_and_only_decodes_color_when_needed():
+    page, labels = row_bench.generate_synthetic_page("letter", 300, 6, seed=1)
+    content = cv2.imencode(".jpg", page)[1].tobytes()
+    blank = cv2.imencode(".jpg", np.full_like(page, 255))[1].tobytes()
+    row_mosaic.METRICS.reset()
+
+    found, circles, _ = row_mosaic.read_and_detect_circles(content, "page.jpg", decode_reduction=2)
+    empty, no_circles, _ = row_mosaic.read_and_detect_circles(blank, "blank.jpg", decode_reduction=2)
+
+    assert found.gray.shape == (page.shape[0] // 2, page.shape[1] // 2)
+    assert row_bench.match_circles(circles, labels)["recall"] == 1
+    assert no_circles is None
+    assert empty.shape == page.shape[:2]
+    assert row_mosaic.METRICS.histograms["color_decode_seconds"]["count"] == 1
+    assert len(row_mosaic.get_circles_from_image_bytes(content, None, "page.jpg", decode_reduction=2)) == 6
+
+
+def test_tune_detection_keeps_the_recall_and_writes_a_loadable_profile(tmp_path, monkeypatch):
+    page, _ = row_bench.generate_synthetic_page("letter", 200, 6, seed=3)
+
+    results = row_tune.tune_detection([("page", page, 6)], trials=6, workers=1, sample_dpi=200)
+    row_tune.save_profile(results["profile"], tmp_path / "profile.json")
+    options = row_mosaic.get_mosaic_options(detection_profile=str(tmp_path / "profile.json"))
+
+    assert results["trials"][0]["dpi"] == 200
+    assert results["trials"][0]["param2"] == row_detect.DETECTION_PARAMETERS["param2"]
+    assert results["chosen"] in results["front"]
+    assert results["chosen"]["recall"] >= results["default"]["recall"]
+    assert results["chosen"]["seconds"] <= results["default"]["seconds"]
+    assert options.dpi == results["chosen"]["dpi"]
+    assert options.detection_parameters["param1"] == results["chosen"]["param1"]
+
+    #: the tasks of a run read the profile from a bucket
+    monkeypatch.setattr(row, "STORAGE_CLIENT", row_sim.LocalStorageClient(tmp_path), raising=False)
+    row_tune.save_profile(results["profile"], "gs://profiles/tuned/profile.json")
+
+    assert row_mosaic.load_detection_profile("gs://profiles/tuned/profile.json")["dpi"] == results["chosen"]["dpi"]
+
+    with pytest.raises(FileNotFoundError):
+        row_mosaic.load_detection_profile("gs://profiles/missing.json")
+
+
+def test_merge_regions_joins_overlapping_regions():
+    assert row_detect.merge_regions([(0, 0, 10, 10), (5, 5, 20, 20), (50, 50, 60, 60)]) == [
+        (0, 0, 20, 20),
+        (50, 50, 60, 60),
+    ]
+
+
+def test_convert_tiff_to_images_decodes_every_page(tmp_path):
+    pages = [row_bench.generate_synthetic_page("letter", 100, 3, seed=seed)[0] for seed in range(3)]
+    cv2.imwritemulti(str(tmp_path / "pages.tif"), pages)
+
+    content = bytearray((tmp_path / "pages.tif").read_bytes())
+    references = sys.getrefcount(content)
+
+    images, count, messages = row_render.convert_tiff_to_images(content, "pages.tif")
+
+    #: the pages are decoded from the temporary file so the tiff is not kept alive while they are iterated
+    assert sys.getrefcount(content) == references
+    assert count == 3
+    assert messages == ""
+    assert [(number, image.shape) for number, image in images] == [(i, page.shape) for i, page in enumerate(pages, 1)]
+
+
+def test_convert_tiff_to_images_handles_unreadable_files():
+    images, count, messages = row_render.convert_tiff_to_images(b"not a tiff", "broken.tif")
+
+    assert count == 0
+    assert list(images) == []
+    assert messages
+
+
+def test_mosaic_object_detects_circles_on_every_tiff_page(tmp_path):
+    pages = [row_bench.generate_synthetic_page("letter", 150, 4, seed=seed)[0] for seed in range(3)]
+    (tmp_path / "input").mkdir()
+    cv2.imwritemulti(str(tmp_path / "input" / "pages.tif"), pages)
+    row_mosaic.METRICS.reset()
+
+    row_mosaic.mosaic_object(
+        row_sim.LocalStorageClient(tmp_path).bucket("input"),
+        "pages.tif",
+        "test",
+        0,
+        "output",
+        row_mosaic.get_mosaic_options(),
+        upload=False,
+    )
+
+    assert row_mosaic.METRICS.counters["pages"] == 3
+    assert row_mosaic.METRICS.counters["circles"] == 12
+
+
+def test_work_units_round_trip_page_ranges():
+    assert row.parse_work_unit("plans/file.pdf#pages=51-100\n") == ("plans/file.pdf", (51, 100))
+    assert row.parse_work_unit("plans/file.pdf") == ("plans/file.pdf", None)
+    assert row.format_work_unit("file.pdf", (1, 50)) == "file.pdf#pages=1-50"
+    assert row.split_into_page_ranges("file.pdf", 120, 50) == [
+        "file.pdf#pages=1-50",
+        "file.pdf#pages=51-100",
+        "file.pdf#pages=101-120",
+    ]
+    assert row.split_into_page_ranges("file.pdf", 50, 50) == ["file.pdf"]
+
+    with pytest.raises(ValueError):
+        row.parse_work_unit("file.pdf#pages=5-2")
+
+
+def test_detection_cache_rebuilds_mosaics_without_detecting_again(tmp_path):
+    pages = [row_bench.generate_synthetic_page("letter", 150, 4, seed=seed)[0] for seed in range(2)]
+    (tmp_path / "input").mkdir()
+    cv2.imwritemulti(str(tmp_path / "input" / "pages.tif"), pages)
+    bucket = row_sim.LocalStorageClient(tmp_path).bucket("input")
+    options = row_mosaic.get_mosaic_options()
+    cache = row_cache.DetectionCache(row_store.LocalStore(tmp_path / "cache"), options)
+    row_mosaic.METRICS.reset()
+
+    first = row_mosaic.mosaic_object(bucket, "pages.tif", "test", 0, "output", options, None, False, cache)
+    second = row_mosaic.mosaic_object(bucket, "pages.tif", "test", 0, "output", options, None, False, cache)
+    other = row_cache.DetectionCache(row_store.LocalStore(tmp_path / "cache"), row_mosaic.get_mosaic_options(dpi=200))
+
+    assert np.array_equal(first, second)
+    assert cache.summary() == {"hits": 1, "misses": 1, "hit rate": 0.5}
+    assert row_mosaic.METRICS.counters["pages_cached"] == 2
+    assert row_mosaic.METRICS.histograms["hough_seconds"]["count"] == 2
+    assert other.load(other.get_source(bucket, "pages.tif")) is None
+
+
+def test_unreadable_pages_keep_the_page_numbers_and_are_not_cached(tmp_path, monkeypatch):
+    pages = [row_bench.generate_synthetic_page("letter", 150, 4, seed=seed)[0] for seed in range(2)]
+    (tmp_path / "input").mkdir()
+    cv2.imwritemulti(str(tmp_path / "input" / "pages.tif"), pages)
+    bucket = row_sim.LocalStorageClient(tmp_path).bucket("input")
+    options = row_mosaic.get_mosaic_options()
+    cache = row_cache.DetectionCache(row_store.LocalStore(tmp_path / "cache"), options)
+    convert = row_render.convert_tiff_to_images
+    manifests = []
+
+    def skip_the_first_page(*args):
+        images, count, messages = convert(*args)
+
+        return ((number, image) for number, image in images if number > 1), count, messages
+
+    monkeypatch.setattr(row_render, "convert_tiff_to_images", skip_the_first_page)
+    row_mosaic.mosaic_object(
+        bucket,
+        "pages.tif",
+        "test",
+        0,
+        "output",
+        options,
+        None,
+        False,
+        cache,
+        handle=lambda *args: manifests.append(args[2]),
+    )
+
+    assert {tile["page"] for tile in manifests[0]["tiles"]} == {2}
+    assert cache.load(cache.get_source(bucket, "pages.tif")) is None
+
+
+def test_page_range_units_mosaic_partials_that_merge_into_one_mosaic(tmp_path, monkeypatch):
+    pages = [
+        row_bench.generate_synthetic_page("letter", 150, count, seed=seed)[0]
+        for seed, count in enumerate([4] * 4 + [0])
+    ]
+    (tmp_path / "input").mkdir()
+    cv2.imwritemulti(str(tmp_path / "input" / "pages.tif"), pages)
+    client = row_sim.LocalStorageClient(tmp_path)
+    monkeypatch.setattr(row, "STORAGE_CLIENT", client, raising=False)
+    options = row_mosaic.get_mosaic_options()
+
+    units = row_mosaic.split_index_by_pages(client.bucket("input"), ["pages.tif"], pages_per_unit=2, min_bytes=0)
+    row_mosaic.METRICS.reset()
+
+    for unit in units[:2]:
+        row_mosaic.mosaic_object(client.bucket("input"), unit, "test", 0, "output", options)
+
+    waiting = row_merge.merge_partial_mosaics("test", "output", units)
+    row_mosaic.mosaic_object(client.bucket("input"), units[2], "test", 0, "output", options)
+
+    partials = [blob.name for blob in client.list_blobs("output", prefix="test/mosaics/")]
+    summary = row_merge.merge_partial_mosaics("test", "output", units)
+    merged = [blob.name for blob in client.list_blobs("output", prefix="test/mosaics/")]
+
+    assert units == ["pages.tif#pages=1-2", "pages.tif#pages=3-4", "pages.tif#pages=5-5"]
+    assert row_mosaic.METRICS.counters["pages"] == 5
+    assert row_mosaic.METRICS.counters["page_ranges"] == 3
+    assert waiting == {"merged": 0, "kept": 0, "incomplete": 1, "partials": 0}
+    assert partials == ["test/mosaics/pages.tif#pages=1-2", "test/mosaics/pages.tif#pages=3-4"]
+    assert summary == {"merged": 1, "kept": 0, "incomplete": 0, "partials": 2}
+    assert merged == ["test/mosaics/pages.tif"]
+    assert list(client.list_blobs("output", prefix="test/units/")) == []
+    assert [blob.name for blob in client.list_blobs("output", prefix="test/manifests/")] == [
+        "test/manifests/pages.tif.json"
+    ]
+
+    manifest = json.loads(client.bucket("output").blob("test/manifests/pages.tif.json").download_as_bytes())
+
+    assert [tile["page"] for tile in manifest["tiles"]] == [1] * 4 + [2] * 4 + [3] * 4 + [4] * 4
+    assert manifest["tiles"][-1]["box"][3] <= manifest["height"]
+
+
+def test_merge_partial_mosaics_keeps_partials_that_can_not_be_read(tmp_path, monkeypatch):
+    client = row_sim.LocalStorageClient(tmp_path)
+    monkeypatch.setattr(row, "STORAGE_CLIENT", client, raising=False)
+    bucket = client.bucket("output")
+    bucket.blob("test/mosaics/a.pdf#pages=1-2").upload_from_string(
+        cv2.imencode(".png", np.zeros((5, 5), np.uint8))[1].tobytes()
+    )
+    bucket.blob("test/mosaics/a.pdf#pages=3-4").upload_from_string(b"not an image")
+
+    for unit in ["a.pdf#pages=1-2", "a.pdf#pages=3-4"]:
+        bucket.blob(f"test/units/{unit}").upload_from_string(b"")
+
+    summary = row_merge.merge_partial_mosaics("test", "output", ["a.pdf#pages=1-2", "a.pdf#pages=3-4"])
+
+    assert summary == {"merged": 0, "kept": 1, "incomplete": 0, "partials": 0}
+    assert [blob.name for blob in client.list_blobs("output", prefix="test/mosaics/")] == [
+        "test/mosaics/a.pdf#pages=1-2",
+        "test/mosaics/a.pdf#pages=3-4",
+    ]
+
+
+def test_merge_partial_results_joins_text_in_page_order():
+    frame = pd.DataFrame(
+        [
+            ["a.pdf#pages=51-60", "second"],
+            ["b.pdf", "whole"],
+            ["a.pdf#pages=1-50", "first"],
+        ],
+        columns=["file_name", "text"],
+    )
+
+    merged = row_ocr.merge_partial_results(frame)
+
+    assert merged.to_dict("records") == [
+        {"file_name": "a.pdf", "text": "first\nsecond"},
+        {"file_name": "b.pdf", "text": "whole"},
+    ]
+
+
+def test_sqlite_queue_leases_each_item_once_and_retries_failures(tmp_path):
+    queue = row_queue.SqliteQueue(tmp_path / "queue.sqlite", max_attempts=2)
+
+    assert queue.add(["a.pdf", "b.pdf", "a.pdf", ""]) == 2
+
+    first, second = queue.lease("one"), queue.lease("two")
+
+    assert {first, second} == {"a.pdf", "b.pdf"}
+    assert queue.lease("three") is None
+
+    queue.complete(first)
+    queue.fail(second)
+
+    assert queue.lease("three") == second
+
+    queue.fail(second)
+
+    assert queue.lease("three") is None
+    assert queue.counts() == {"pending": 0, "leased": 0, "done": 1, "failed": 1}
+
+    queue.close()
+
+
+def test_sqlite_queue_releases_expired_leases(tmp_path):
+    queue = row_queue.SqliteQueue(tmp_path / "queue.sqlite", lease_seconds=-1)
+    queue.add(["a.pdf"])
+
+    assert queue.lease("one") == "a.pdf"
+    assert queue.lease("two") == "a.pdf"
+
+    queue.close()
+
+
+def test_bucket_queue_leases_each_item_once_and_retries_failures(tmp_path):
+    client = row_sim.LocalStorageClient(tmp_path)
+    queue = row_queue.get_queue("gs://bucket/queue", client)
+    queue.add(["a.pdf", "b.pdf", "c.pdf"])
+    workers = [row_queue.BucketQueue(client, "gs://bucket/queue") for _ in range(3)]
+
+    leased = [worker.lease(f"worker-{i}") for i, worker in enumerate(workers)]
+
+    assert sorted(leased) == ["a.pdf", "b.pdf", "c.pdf"]
+    assert workers[0].lease("worker-0") is None
+
+    workers[0].complete(leased[0])
+    workers[1].fail(leased[1])
+
+    assert workers[2].lease("worker-2") == leased[1]
+    assert queue.counts() == {"pending": 0, "leased": 2, "done": 1, "failed": 0}
+
+    workers[2].fail(leased[1])
+    scanned = workers[2].scanned
+
+    assert workers[2].lease("worker-2") == leased[1]
+    assert workers[2].lease("worker-2") is None
+    assert workers[2].scanned == scanned
+
+
+def test_bucket_queue_skips_the_items_other_workers_leased(tmp_path):
+    client = row_sim.LocalStorageClient(tmp_path)
+    queue = row_queue.get_queue("gs://bucket/queue", client)
+    queue.add(f"{index}.pdf" for index in range(200))
+
+    first = row_queue.BucketQueue(client, "gs://bucket/queue")
+    leased = [first.lease("worker-0") for _ in range(150)]
+
+    second = row_queue.BucketQueue(client, "gs://bucket/queue")
+    requests = client.requests
+    rest = [second.lease("worker-1") for _ in range(50)]
+
+    #: the items blob, a lease for each item and the claims that were beaten to an item
+    assert client.requests - requests < 60
+    assert sorted(leased + rest) == sorted(f"{index}.pdf" for index in range(200))
+
+
+def test_drain_stops_at_the_time_budget_and_completes_after_flushing(tmp_path):
+    queue = row_queue.SqliteQueue(tmp_path / "queue.sqlite")
+    queue.add([f"{i}.pdf" for i in range(5)])
+    flushed = []
+
+    def handle(name):
+        if name == "1.pdf":
+            raise ValueError("unreadable")
+
+    def flush():
+        flushed.append(queue.counts()["done"])
+
+    summary = row_queue.drain(queue, handle, "worker", flush=flush, flush_every=2)
+
+    assert summary["items"] == 4
+    assert summary["failed"] == row_queue.MAX_ATTEMPTS
+    assert flushed[:2] == [0, 2]
+    assert queue.counts()["failed"] == 1
+    assert row_queue.drain(queue, handle, "worker", seconds=0)["items"] == 0
+
+    queue.close()
+
+
+def test_drain_gives_items_back_when_the_flush_fails(tmp_path):
+    queue = row_queue.SqliteQueue(tmp_path / "queue.sqlite")
+    queue.add(["0.pdf", "1.pdf"])
+    calls = []
+
+    def flush():
+        calls.append(len(calls))
+
+        if len(calls) == 1:
+            raise ValueError("ocr failed")
+
+    summary = row_queue.drain(queue, lambda _: None, "worker", flush=flush, flush_every=2)
+
+    assert summary["failed"] == 2
+    assert summary["items"] == 2
+    assert queue.counts()["done"] == 2
+
+    queue.close()
+
+
+def test_mosaic_queued_objects_mosaics_every_object(tmp_path, monkeypatch):
+    client = row_sim.LocalStorageClient(tmp_path)
+    monkeypatch.setattr(row, "STORAGE_CLIENT", client, raising=False)
+    index = row_sim.create_synthetic_run(tmp_path, 3, distinct=1, sheets=[("letter", 100)])
+    queue = row.get_work_queue(str(tmp_path / "queue.sqlite"))
+    queue.add((index / "index.txt").read_text(encoding="utf-8").splitlines())
+
+    summary = row_mosaic.mosaic_queued_objects("test", "gs://input", "output", queue, 0)
+
+    names = [blob.name for blob in client.list_blobs("output", prefix="test/mosaics/")]
+
+    assert summary["items"] == 3
+    assert len(names) == 3
+    assert queue.counts()["done"] == 3
+
+    queue.close()
+
+
+def test_detection_service_returns_circles_and_a_mosaic():
+    page, labels = row_bench.generate_synthetic_page("letter", 100, 4, seed=1)
+    payload = ("page.png", cv2.imencode(".png", page)[1].tobytes())
+    server = row_service.create_server(0, workers=1)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+
+    try:
+        with urlopen(Request(f"{url}/detect?name=page.png&codec=png", data=payload[1])) as response:
+            result = json.loads(response.read())
+
+        with pytest.raises(HTTPError) as error:
+            urlopen(Request(f"{url}/detect?codec=gif", data=payload[1]))
+
+        load = row_service.generate_load(url, [payload], requests=4, concurrency=2)
+        health = server.service.health()
+    finally:
+        server.shutdown()
+        server.server_close()
+        server.service.close()
+
+    mosaic = cv2.imdecode(np.frombuffer(base64.b64decode(result["mosaic"]), dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+
+    assert row_bench.match_circles(result["pages"][0]["circles"], labels)["recall"] == 1
+    assert result["mosaic mime type"] == "image/png"
+    assert mosaic is not None
+    assert error.value.code == 400
+    assert health["in flight"] == 0
+    assert load["statuses"] == {200: 4}
+    assert 0 < load["latency p50"] <= load["latency max"]
+
+
+def test_percentile_uses_the_nearest_rank():
+    assert row_service.percentile([], 50) == 0
+    assert row_service.percentile([4, 1, 3, 2], 50) == 2
+    assert row_service.percentile(list(range(1, 101)), 99) == 99
+
+
+def test_find_parcel_numbers_normalizes_the_numbers():
+    assert row_parcels.find_parcel_numbers("PARCEL 0015 and 15 : e\n123A\n45:2E abc12 1234567") == [
+        "15",
+        "15:E",
+        "123A",
+        "45:2E",
+    ]
+
+
+def test_parcel_index_finds_the_results_mentioning_a_parcel(tmp_path):
+    pd.DataFrame(
+        {"file_name": ["run/mosaics/a.pdf", "run/mosaics/b.pdf"], "text": ["0015\n15\n16:E", "16 : E\n200"]}
+    ).to_parquet(tmp_path / "task-0.gz", compression="gzip")
+    pd.DataFrame({"file_name": ["run/mosaics/c.tif"], "text": [None]}).to_parquet(
+        tmp_path / "task-1.gz", compression="gzip"
+    )
+
+    manifest = row_parcels.build_parcel_index(tmp_path)
+    index = row_parcels.ParcelIndex(tmp_path / row_parcels.INDEX_FOLDER)
+
+    assert manifest["documents"] == 3
+    assert manifest["parcels"] == 3
+    assert index.lookup("15") == [{"file_name": "run/mosaics/a.pdf", "file": "task-0.gz", "row": 0}]
+    assert [mention["file_name"] for mention in index.lookup("16:e")] == ["run/mosaics/a.pdf", "run/mosaics/b.pdf"]
+    assert index.lookup("999") == []
+
+    with pytest.raises(ValueError):
+        index.lookup("no parcel")
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+"""
+UDOT Right of Way (ROW) Parcel Number Extraction
+Search the circle detection parameters on labeled pages for settings that are faster without losing circles
+"""
+
+import json
+import logging
+import random
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from multiprocessing import get_context
+from os import cpu_count
+from time import perf_counter
+
+import cv2
+
+import row
+import row_bench
+import row_detect
+import row_mosaic
+
+#: the resolution the labeled pages were rendered at. lower render resolutions are tried by shrinking the pages
+SAMPLE_DPI = 300
+
+#: the values searched for each parameter. the radius ranges are searched by which range is tried first, see
+#: `get_multiplier_orders`. the inset only changes the crops and the circle limit only matters on pathological pages
+#: so they keep their defaults
+SEARCH_SPACE = {
+    "dpi": (300, 250, 200, 150),
+    "blur": (3, 5, 7),
+    "param1": (30, 50, 80),
+    "param2": (30, 40, 50, 60),
+}
+
+#: the number of parameter sets tried when the search space is larger
+TRIALS = 60
+
+#: the pages scaled to each resolution in a tuning worker
+_SAMPLE = {}
+
+
+def get_multiplier_orders(multipliers):
+    """the radius range tables to search. the ranges are tried from the end of the table, so moving the range that
+    finds most circles to the end skips the ranges that would have found nothing
+
+    Args:
+        multipliers (list): the [ratio, fudge] radius ranges
+
+    Returns:
+        list(list): the table as it is and the table with each other range moved to the end
+    """
+    orders = [list(multipliers)]
+
+    for index in range(len(multipliers) - 1):
+        orders.append(multipliers[:index] + multipliers[index + 1 :] + [multipliers[index]])
+
+    return orders
+
+
+def get_trials(trials=TRIALS, seed=0, sample_dpi=SAMPLE_DPI):
+    """choose the parameter sets to try. the defaults are always the first so the others can be compared to them
+
+    Args:
+        trials (int): the most parameter sets to try. every combination is tried when there are fewer
+        seed (int): the seed for sampling the combinations
+        sample_dpi (int): the resolution of the labeled pages. higher resolutions are not searched
+
+    Returns:
+        list(dict): the dpi and detection parameters of each trial
+    """
+    space = {**SEARCH_SPACE, "dpi": tuple(dpi for dpi in SEARCH_SPACE["dpi"] if dpi <= sample_dpi)}
+    space["multipliers"] = get_multiplier_orders(row_detect.DETECTION_PARAMETERS["multipliers"])
+
+    default = {
+        "dpi": sample_dpi,
+        **{key: row_detect.DETECTION_PARAMETERS[key] for key in space if key != "dpi"},
+    }
+    combinations = [dict(zip(space, values)) for values in product(*space.values())]
+    combinations = [combination for combination in combinations if combination != default]
+
+    if len(combinations) > trials - 1:
+        combinations = random.Random(seed).sample(combinations, max(trials - 1, 0))
+
+    return [default] + combinations
+
+
+def _initialize_worker(pages, detector, repeat, sample_dpi):
+    logging.getLogger().setLevel(logging.WARNING)
+
+    _SAMPLE.clear()
+    _SAMPLE.update({"pages": pages, "detector": detector, "repeat": repeat, "sample dpi": sample_dpi})
+
+
+def _scale_pages(dpi):
+    if dpi not in _SAMPLE:
+        scale = dpi / _SAMPLE["sample dpi"]
+        scaled = []
+
+        for page, labels in _SAMPLE["pages"]:
+            if scale != 1:
+                page = cv2.resize(page, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+                if not isinstance(labels, int):
+                    labels = [tuple(value * scale for value in label[:3]) for label in labels]
+
+            scaled.append((page, labels))
+
+        _SAMPLE[dpi] = scaled
+
+    return _SAMPLE[dpi]
+
+
+def evaluate_trial(trial):
+    """detect the circles on every sample page with the trial's parameters
+
+    Args:
+        trial (dict): the dpi and detection parameters from `get_trials`
+
+    Returns:
+        dict: the trial with the seconds and the detection counts, recall and precision over the sample
+    """
+    parameters = {key: value for key, value in trial.items() if key != "dpi"}
+    result = {**trial, "seconds": 0.0, "true positives": 0, "false positives": 0, "false negatives": 0}
+
+    for page, labels in _scale_pages(trial["dpi"]):
+        timings = []
+
+        for _ in range(_SAMPLE["repeat"]):
+            start = perf_counter()
+            circles, _ = row_detect.detect_circles(page, _SAMPLE["detector"], parameters=parameters)
+            timings.append(perf_counter() - start)
+
+        detection = row_bench.match_circles(circles, labels)
+        result["seconds"] += min(timings)
+
+        for key in ("true positives", "false positives", "false negatives"):
+            result[key] += detection[key]
+
+    found = result["true positives"] + result["false positives"]
+    labeled = result["true positives"] + result["false negatives"]
+    result["recall"] = result["true positives"] / labeled if labeled else 1.0
+    result["precision"] = result["true positives"] / found if found else 1.0
+
+    return result
+
+
+def get_pareto_front(results):
+    """find the trials no other trial beats on runtime, recall and precision at once
+
+    Args:
+        results (list): the trial results from `evaluate_trial`
+
+    Returns:
+        list(dict): the trials on the front from the fastest to the slowest
+    """
+
+    def dominates(one, other):
+        at_least_as_good = (
+            one["seconds"] <= other["seconds"]
+            and one["recall"] >= other["recall"]
+            and one["precision"] >= other["precision"]
+        )
+        better = (
+            one["seconds"] < other["seconds"]
+            or one["recall"] > other["recall"]
+            or one["precision"] > other["precision"]
+        )
+
+        return at_least_as_good and better
+
+    front = [result for result in results if not any(dominates(other, result) for other in results)]
+
+    return sorted(front, key=lambda result: result["seconds"])
+
+
+def tune_detection(
+    pages, detector="hough", trials=TRIALS, workers=None, repeat=1, seed=0, sample_dpi=SAMPLE_DPI, tolerance=0.0
+):
+    """search the detection parameters on a labeled sample and choose the fastest trial on the pareto front whose
+    recall and precision are within the tolerance of the default parameters
+
+    Args:
+        pages (list): (name, page, labels) tuples from `row_bench.load_labeled_pages`
+        detector (str): one of the `CIRCLE_DETECTORS`
+        trials (int): the most parameter sets to try
+        workers (int): the number of processes evaluating trials. defaults to the cpu count
+        repeat (int): the number of timed runs per page. the fastest is kept
+        seed (int): the seed for sampling the parameter sets
+        sample_dpi (int): the resolution the sample pages were rendered at
+        tolerance (float): the recall and precision the chosen trial may give up compared to the defaults
+
+    Returns:
+        dict: every trial, the pareto front and the profile for the chosen trial
+    """
+    if not pages:
+        raise ValueError("there are no labeled pages to tune on")
+
+    workers = workers or cpu_count() or 1
+    sample = [(page, labels) for _, page, labels in pages]
+    candidates = get_trials(trials, seed, sample_dpi)
+    start = perf_counter()
+
+    logging.info("tuning %s on %i pages with %i trials and %i workers", detector, len(sample), len(candidates), workers)
+
+    if workers == 1:
+        _initialize_worker(sample, detector, repeat, sample_dpi)
+        results = [evaluate_trial(trial) for trial in candidates]
+        _SAMPLE.clear()
+    else:
+        #: spawn the workers so they do not fork opencv's threads
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=get_context("spawn"),
+            initializer=_initialize_worker,
+            initargs=(sample, detector, repeat, sample_dpi),
+        ) as executor:
+            results = list(executor.map(evaluate_trial, candidates))
+
+    default = results[0]
+    front = get_pareto_front(results)
+    chosen = next(
+        result
+        for result in front
+        if result["recall"] >= default["recall"] - tolerance and result["precision"] >= default["precision"] - tolerance
+    )
+
+    profile = {
+        "version": row_mosaic.DETECTION_PROFILE_VERSION,
+        "detector": detector,
+        "dpi": chosen["dpi"],
+        "parameters": {
+            **row_detect.DETECTION_PARAMETERS,
+            **{key: chosen[key] for key in row_detect.DETECTION_PARAMETERS if key in chosen},
+        },
+        "tuned": {
+            "pages": len(sample),
+            "trials": len(results),
+            "seconds": chosen["seconds"],
+            "recall": chosen["recall"],
+            "precision": chosen["precision"],
+            "default seconds": default["seconds"],
+            "default recall": default["recall"],
+            "default precision": default["precision"],
+        },
+    }
+
+    logging.info("tuned %s in %.1f seconds: %s", detector, perf_counter() - start, profile["tuned"])
+
+    return {"trials": results, "front": front, "default": default, "chosen": chosen, "profile": profile}
+
+
+def save_profile(profile, location):
+    """write a detection profile for the `detection_profile` mosaic option
+
+    Args:
+        profile (dict): the profile from `tune_detection`
+        location (str): the json file or `gs://bucket-name/prefix/profile.json` object to write
+    """
+    folder, _, key = str(location).rpartition("/")
+    row.get_record_store(folder or ".").put(key, json.dumps(profile, indent=2).encode("utf-8"))
+
+    logging.info("saved the detection profile to %s", location)